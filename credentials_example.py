@@ -5,6 +5,16 @@ class DbConfig(object):
     schema = 'public'
     user = 'postgres'
     password = 'secret'
+    # optional: connection pool size, statement timeout in milliseconds
+    # (0: no timeout), number of prepared statements cached per connection
+    pool_min_size = 5
+    pool_max_size = 10
+    statement_timeout = 0
+    statement_cache_size = 100
+    # optional: log queries of the api slower than profile_threshold milliseconds
+    # (None: off), run EXPLAIN (ANALYZE, BUFFERS) for a fraction of them
+    profile_threshold = None
+    profile_explain_rate = 0.0
 
 class BasicAuth(object):
     url = 'http://localhost:8080'
@@ -22,6 +32,21 @@ class MinioConfig(object):
     bucket = ''
     access_key = ''
     secret_key = ''
+    # optional: proxy read size, objects above the threshold are fetched in
+    # parts of part_size bytes with up to parallel_parts concurrent requests
+    chunk_size = 262144
+    parallel_threshold = 33554432
+    part_size = 8388608
+    parallel_parts = 4
+    # optional: lifetime of presigned download URLs in seconds, region of the
+    # S3 service (saves looking it up before presigning)
+    presign_expiry = 300
+    region = None
+    # optional: local disk cache of objects, revalidated after cache_revalidate seconds
+    cache_dir = '/tmp/mitwelten-files'
+    cache_size = 2147483648
+    cache_max_object_size = 268435456
+    cache_revalidate = 300
 
 db = DbConfig()
 ba = BasicAuth()
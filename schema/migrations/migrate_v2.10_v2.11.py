@@ -0,0 +1,52 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('adding priority to prod.birdnet_tasks')
+cursor.execute('ALTER TABLE prod.birdnet_tasks ADD COLUMN IF NOT EXISTS priority bigint NOT NULL DEFAULT 0')
+
+print('adding max_running to prod.birdnet_configs')
+cursor.execute('ALTER TABLE prod.birdnet_configs ADD COLUMN IF NOT EXISTS max_running integer')
+
+print('creating table prod.birdnet_node_weights')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS prod.birdnet_node_weights
+(
+    node_id integer NOT NULL,
+    weight real NOT NULL DEFAULT 1 CHECK (weight > 0),
+    PRIMARY KEY (node_id)
+)
+''')
+cursor.execute('''
+ALTER TABLE IF EXISTS prod.birdnet_node_weights
+    ADD FOREIGN KEY (node_id)
+    REFERENCES prod.nodes (node_id) MATCH SIMPLE
+    ON UPDATE NO ACTION
+    ON DELETE CASCADE
+''')
+
+print('replacing birdnet_tasks_pending_idx by birdnet_tasks_state_priority_idx')
+cursor.execute('''
+CREATE INDEX IF NOT EXISTS birdnet_tasks_state_priority_idx
+    ON prod.birdnet_tasks USING btree
+    (state ASC NULLS LAST, priority ASC NULLS LAST, scheduled_on ASC NULLS LAST)
+''')
+cursor.execute('DROP INDEX IF EXISTS prod.birdnet_tasks_pending_idx')
+
+cursor.execute('GRANT ALL ON prod.birdnet_node_weights TO mitwelten_internal, mitwelten_rest')
+cursor.execute('GRANT UPDATE (max_running) ON prod.birdnet_configs TO mitwelten_rest')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
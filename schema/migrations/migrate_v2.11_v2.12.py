@@ -0,0 +1,49 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('creating table prod.birdnet_queue_jobs')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_jobs
+(
+    job_id serial,
+    action character varying(32) NOT NULL,
+    selection jsonb NOT NULL,
+    state character varying(16) NOT NULL DEFAULT 'pending', -- pending, running, cancelled, interrupted, failed, done
+    last_task_id integer NOT NULL DEFAULT 0, -- tasks are processed in ascending order, resumed after this one
+    total integer,
+    processed integer NOT NULL DEFAULT 0,
+    results_deleted bigint NOT NULL DEFAULT 0,
+    error text,
+    created_at timestamptz NOT NULL DEFAULT current_timestamp,
+    updated_at timestamptz NOT NULL DEFAULT current_timestamp,
+    finished_at timestamptz,
+    PRIMARY KEY (job_id)
+)
+''')
+cursor.execute('GRANT ALL ON prod.birdnet_queue_jobs TO mitwelten_internal, mitwelten_rest')
+cursor.execute('GRANT UPDATE ON prod.birdnet_queue_jobs_job_id_seq TO mitwelten_internal, mitwelten_rest')
+cursor.execute('GRANT DELETE ON prod.birdnet_results TO mitwelten_rest')
+
+# reset jobs delete results as mitwelten_rest, firing the species rollup trigger
+# on birdnet_results: delete the first result the way they do, rolled back
+print('checking result deletes as mitwelten_rest')
+cursor.execute('SAVEPOINT rest_results_check')
+cursor.execute('SET LOCAL ROLE mitwelten_rest')
+cursor.execute('DELETE FROM prod.birdnet_results WHERE result_id = (SELECT min(result_id) FROM prod.birdnet_results)')
+cursor.execute('ROLLBACK TO SAVEPOINT rest_results_check')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
@@ -0,0 +1,294 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('creating tables prod.birdnet_queue_stats, prod.birdnet_queue_durations')
+# BirdNET queue statistics per deployment, see birdnet_queue_stats_*()
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_stats
+(
+    deployment_id integer NOT NULL,
+    time_min timestamptz, -- eligible files
+    time_max timestamptz,
+    tasks_done integer NOT NULL DEFAULT 0, -- tasks in state 2
+    runtime_sum interval NOT NULL DEFAULT '0',
+    runtime_min interval,
+    runtime_max interval,
+    scheduled_on_min timestamptz,
+    scheduled_on_max timestamptz,
+    end_on_min timestamptz,
+    end_on_max timestamptz,
+    results integer NOT NULL DEFAULT 0,
+    results_conf_09 integer NOT NULL DEFAULT 0, -- confidence > 0.9
+    PRIMARY KEY (deployment_id)
+)
+''')
+# eligible files per deployment and duration, for the most common duration
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_durations
+(
+    deployment_id integer NOT NULL,
+    duration double precision NOT NULL,
+    count integer NOT NULL,
+    PRIMARY KEY (deployment_id, duration)
+)
+''')
+cursor.execute('GRANT ALL ON prod.birdnet_queue_stats, prod.birdnet_queue_durations TO mitwelten_internal')
+cursor.execute('GRANT SELECT ON prod.birdnet_queue_stats, prod.birdnet_queue_durations TO mitwelten_rest')
+
+print('creating queue statistics maintenance functions')
+# queue statistics: files, completed tasks and results of the audio files
+# eligible for BirdNET (48 kHz, at least 3 seconds) per deployment. counts and
+# sums follow all changes, the minima and maxima only widen: after deleting
+# or resetting, or after moving files between deployments, they are exact
+# again once rebuilt with birdnet_queue_stats_refresh()
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_files()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT *, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT *, -1 AS sign FROM old_rows'
+        ELSE 'SELECT *, -1 AS sign FROM old_rows UNION ALL SELECT *, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (
+        SELECT deployment_id, duration, time, sign FROM (%s) c
+        WHERE sample_rate = 48000 AND duration >= 3
+    ),
+    durations AS (
+        INSERT INTO prod.birdnet_queue_durations AS d (deployment_id, duration, count)
+        SELECT deployment_id, duration, sum(sign) FROM changed
+        GROUP BY deployment_id, duration
+        HAVING sum(sign) != 0
+        ON CONFLICT (deployment_id, duration) DO UPDATE
+        SET count = d.count + excluded.count
+    )
+    INSERT INTO prod.birdnet_queue_stats AS s (deployment_id, time_min, time_max)
+    SELECT deployment_id, min(time), max(time) FROM changed
+    WHERE sign > 0
+    GROUP BY deployment_id
+    ON CONFLICT (deployment_id) DO UPDATE
+    SET time_min = least(s.time_min, excluded.time_min),
+        time_max = greatest(s.time_max, excluded.time_max)
+    $sql$, changed);
+    RETURN NULL;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_tasks()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT *, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT *, -1 AS sign FROM old_rows'
+        ELSE 'SELECT *, -1 AS sign FROM old_rows UNION ALL SELECT *, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (
+        SELECT f.deployment_id, c.scheduled_on, c.end_on, c.end_on - c.pickup_on AS runtime, c.sign
+        FROM (%s) c
+        JOIN prod.files_audio f ON f.file_id = c.file_id
+        WHERE c.state = 2 AND f.sample_rate = 48000 AND f.duration >= 3
+    )
+    INSERT INTO prod.birdnet_queue_stats AS s (deployment_id, tasks_done, runtime_sum,
+        runtime_min, runtime_max, scheduled_on_min, scheduled_on_max, end_on_min, end_on_max)
+    SELECT deployment_id, sum(sign), coalesce(sum(sign * runtime), '0'),
+        min(runtime) FILTER (WHERE sign > 0), max(runtime) FILTER (WHERE sign > 0),
+        min(scheduled_on) FILTER (WHERE sign > 0), max(scheduled_on) FILTER (WHERE sign > 0),
+        min(end_on) FILTER (WHERE sign > 0), max(end_on) FILTER (WHERE sign > 0)
+    FROM changed
+    GROUP BY deployment_id
+    ON CONFLICT (deployment_id) DO UPDATE
+    SET tasks_done = s.tasks_done + excluded.tasks_done,
+        runtime_sum = s.runtime_sum + excluded.runtime_sum,
+        runtime_min = least(s.runtime_min, excluded.runtime_min),
+        runtime_max = greatest(s.runtime_max, excluded.runtime_max),
+        scheduled_on_min = least(s.scheduled_on_min, excluded.scheduled_on_min),
+        scheduled_on_max = greatest(s.scheduled_on_max, excluded.scheduled_on_max),
+        end_on_min = least(s.end_on_min, excluded.end_on_min),
+        end_on_max = greatest(s.end_on_max, excluded.end_on_max)
+    $sql$, changed);
+    RETURN NULL;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_results()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT file_id, confidence, 1 AS sign FROM new_rows'
+        ELSE 'SELECT file_id, confidence, -1 AS sign FROM old_rows'
+    END;
+    EXECUTE format($sql$
+    INSERT INTO prod.birdnet_queue_stats AS s (deployment_id, results, results_conf_09)
+    SELECT f.deployment_id, sum(c.sign), coalesce(sum(c.sign) FILTER (WHERE c.confidence > 0.9), 0)
+    FROM (%s) c
+    JOIN prod.files_audio f ON f.file_id = c.file_id
+    WHERE f.sample_rate = 48000 AND f.duration >= 3
+    GROUP BY f.deployment_id
+    ON CONFLICT (deployment_id) DO UPDATE
+    SET results = s.results + excluded.results,
+        results_conf_09 = s.results_conf_09 + excluded.results_conf_09
+    $sql$, changed);
+    RETURN NULL;
+END;
+$$
+''')
+# rebuild the queue statistics of the deployments from scratch, all if NULL
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_refresh(deployment_ids integer[] DEFAULT NULL)
+    RETURNS void
+    LANGUAGE sql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+    -- block the statistics triggers until the rebuilt rows are committed
+    LOCK TABLE prod.birdnet_queue_stats, prod.birdnet_queue_durations IN SHARE ROW EXCLUSIVE MODE;
+    DELETE FROM prod.birdnet_queue_durations
+    WHERE deployment_ids IS NULL OR deployment_id = any(deployment_ids);
+    DELETE FROM prod.birdnet_queue_stats
+    WHERE deployment_ids IS NULL OR deployment_id = any(deployment_ids);
+    INSERT INTO prod.birdnet_queue_durations (deployment_id, duration, count)
+    SELECT deployment_id, duration, count(*)
+    FROM prod.files_audio
+    WHERE sample_rate = 48000 AND duration >= 3
+        AND (deployment_ids IS NULL OR deployment_id = any(deployment_ids))
+    GROUP BY 1, 2;
+    WITH eligible AS (
+        SELECT file_id, deployment_id, time FROM prod.files_audio
+        WHERE sample_rate = 48000 AND duration >= 3
+            AND (deployment_ids IS NULL OR deployment_id = any(deployment_ids))
+    ),
+    file_stats AS (
+        SELECT deployment_id, min(time) AS time_min, max(time) AS time_max
+        FROM eligible
+        GROUP BY deployment_id
+    ),
+    task_stats AS (
+        SELECT e.deployment_id, count(*) AS tasks_done, sum(t.end_on - t.pickup_on) AS runtime_sum,
+            min(t.end_on - t.pickup_on) AS runtime_min, max(t.end_on - t.pickup_on) AS runtime_max,
+            min(t.scheduled_on) AS scheduled_on_min, max(t.scheduled_on) AS scheduled_on_max,
+            min(t.end_on) AS end_on_min, max(t.end_on) AS end_on_max
+        FROM prod.birdnet_tasks t
+        JOIN eligible e ON e.file_id = t.file_id
+        WHERE t.state = 2
+        GROUP BY e.deployment_id
+    ),
+    result_stats AS (
+        SELECT e.deployment_id, count(*) AS results, count(*) FILTER (WHERE r.confidence > 0.9) AS results_conf_09
+        FROM prod.birdnet_results r
+        JOIN eligible e ON e.file_id = r.file_id
+        GROUP BY e.deployment_id
+    )
+    INSERT INTO prod.birdnet_queue_stats (deployment_id, time_min, time_max, tasks_done, runtime_sum,
+        runtime_min, runtime_max, scheduled_on_min, scheduled_on_max, end_on_min, end_on_max,
+        results, results_conf_09)
+    SELECT f.deployment_id, f.time_min, f.time_max, coalesce(t.tasks_done, 0), coalesce(t.runtime_sum, '0'),
+        t.runtime_min, t.runtime_max, t.scheduled_on_min, t.scheduled_on_max, t.end_on_min, t.end_on_max,
+        coalesce(r.results, 0), coalesce(r.results_conf_09, 0)
+    FROM file_stats f
+    LEFT JOIN task_stats t ON t.deployment_id = f.deployment_id
+    LEFT JOIN result_stats r ON r.deployment_id = f.deployment_id;
+$$
+''')
+
+# the refresh runs as definer, it may only be called by the api
+cursor.execute('REVOKE EXECUTE ON FUNCTION prod.birdnet_queue_stats_refresh(integer[]) FROM PUBLIC')
+cursor.execute('GRANT EXECUTE ON FUNCTION prod.birdnet_queue_stats_refresh(integer[]) TO mitwelten_internal, mitwelten_rest')
+
+print('creating queue statistics triggers')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_files_insert
+    AFTER INSERT ON prod.files_audio
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_files()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_files_update
+    AFTER UPDATE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_files()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_files_delete
+    AFTER DELETE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_files()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_tasks_insert
+    AFTER INSERT ON prod.birdnet_tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_tasks()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_tasks_update
+    AFTER UPDATE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_tasks()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_tasks_delete
+    AFTER DELETE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_tasks()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_results_insert
+    AFTER INSERT ON prod.birdnet_results
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_results()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_results_delete
+    AFTER DELETE ON prod.birdnet_results
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_results()
+''')
+
+print('computing queue statistics')
+cursor.execute('SELECT prod.birdnet_queue_stats_refresh()')
+
+# reset jobs delete results as mitwelten_rest, firing the rollup and statistics
+# triggers on birdnet_results: delete the first result the way they do, rolled back
+print('checking result deletes as mitwelten_rest')
+cursor.execute('SAVEPOINT rest_results_check')
+cursor.execute('SET LOCAL ROLE mitwelten_rest')
+cursor.execute('DELETE FROM prod.birdnet_results WHERE result_id = (SELECT min(result_id) FROM prod.birdnet_results)')
+cursor.execute('ROLLBACK TO SAVEPOINT rest_results_check')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
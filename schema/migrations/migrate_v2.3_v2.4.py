@@ -0,0 +1,54 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+# keyset pagination of /results_full/ requires the result_id in the view,
+# columns can only be appended when replacing a view
+print('adding result_id to prod.birdnet_inferred_species_file_taxonomy')
+cursor.execute('''
+CREATE OR REPLACE VIEW prod.birdnet_inferred_species_file_taxonomy
+    AS
+    SELECT r.species,
+        r.confidence,
+        d.location,
+        f.object_name,
+        f.time AS object_time,
+        r.time_start AS time_start_relative,
+        f.duration AS duration,
+        f.time + ((r.time_start || ' seconds')::interval) AS time_start,
+        d1.image_url,
+        d1.label_de  species_de,
+        d1.label_en  species_en,
+        d2.label_sci genus,
+        d3.label_sci family,
+        d4.label_sci class,
+        d5.label_sci phylum,
+        d6.label_sci kingdom,
+        r.result_id
+    FROM prod.birdnet_results r
+    LEFT JOIN prod.files_audio     f  ON r.file_id    = f.file_id
+    LEFT JOIN prod.taxonomy_data d1 ON r.species    = d1.label_sci
+    LEFT JOIN prod.taxonomy_tree   t  ON d1.datum_id  = t.species_id
+    LEFT JOIN prod.taxonomy_data d2 ON t.genus_id   = d2.datum_id
+    LEFT JOIN prod.taxonomy_data d3 ON t.family_id  = d3.datum_id
+    LEFT JOIN prod.taxonomy_data d4 ON t.class_id   = d4.datum_id
+    LEFT JOIN prod.taxonomy_data d5 ON t.phylum_id  = d5.datum_id
+    LEFT JOIN prod.taxonomy_data d6 ON t.kingdom_id = d6.datum_id
+    LEFT JOIN prod.deployments     d ON f.deployment_id = d.deployment_id
+    WHERE t.species_id IS NOT NULL
+''')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
@@ -0,0 +1,165 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('creating prod.birdnet_species_rollup')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS prod.birdnet_species_rollup
+(
+    species character varying(255) NOT NULL,
+    day date NOT NULL,
+    deployment_id integer NOT NULL,
+    confidence_bucket smallint NOT NULL, -- floor(confidence * 100)
+    count integer NOT NULL,
+    time_min timestamptz NOT NULL,
+    time_max timestamptz NOT NULL,
+    PRIMARY KEY (species, day, deployment_id, confidence_bucket)
+)
+''')
+cursor.execute('''
+CREATE INDEX IF NOT EXISTS birdnet_species_rollup_day_idx
+    ON prod.birdnet_species_rollup USING btree
+    (day ASC NULLS LAST)
+''')
+
+print('creating rollup maintenance functions')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_insert()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+BEGIN
+    -- serialize with birdnet_species_rollup_delete() per rollup key, in a fixed order
+    PERFORM pg_advisory_xact_lock(k) FROM (
+        SELECT DISTINCT hashtext(n.species || '/' || to_char(((f.time + ((n.time_start || ' seconds')::interval)) AT TIME ZONE 'UTC')::date, 'YYYY-MM-DD') || '/' || f.deployment_id) AS k
+        FROM new_rows n
+        JOIN prod.files_audio f ON n.file_id = f.file_id
+        ORDER BY k
+    ) keys;
+
+    INSERT INTO prod.birdnet_species_rollup AS s
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT r.species, (r.time AT TIME ZONE 'UTC')::date, r.deployment_id, r.confidence_bucket,
+        count(*), min(r.time), max(r.time)
+    FROM (
+        SELECT n.species, f.deployment_id,
+            f.time + ((n.time_start || ' seconds')::interval) AS time,
+            floor(n.confidence::numeric * 100)::smallint AS confidence_bucket
+        FROM new_rows n
+        JOIN prod.files_audio f ON n.file_id = f.file_id
+    ) r
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (species, day, deployment_id, confidence_bucket) DO UPDATE
+    SET count = s.count + excluded.count,
+        time_min = least(s.time_min, excluded.time_min),
+        time_max = greatest(s.time_max, excluded.time_max);
+    RETURN NULL;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_delete()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+BEGIN
+    CREATE TEMPORARY TABLE birdnet_species_rollup_affected ON COMMIT DROP AS
+    SELECT DISTINCT o.species, f.deployment_id,
+        ((f.time + ((o.time_start || ' seconds')::interval)) AT TIME ZONE 'UTC')::date AS day
+    FROM old_rows o
+    JOIN prod.files_audio f ON o.file_id = f.file_id;
+
+    -- serialize with birdnet_species_rollup_insert() per rollup key, in a fixed
+    -- order: the recount below then sees the results of concurrent inserts
+    PERFORM pg_advisory_xact_lock(k) FROM (
+        SELECT DISTINCT hashtext(species || '/' || to_char(day, 'YYYY-MM-DD') || '/' || deployment_id) AS k
+        FROM birdnet_species_rollup_affected
+        ORDER BY k
+    ) keys;
+
+    DELETE FROM prod.birdnet_species_rollup s
+    USING birdnet_species_rollup_affected a
+    WHERE s.species = a.species AND s.day = a.day AND s.deployment_id = a.deployment_id;
+
+    INSERT INTO prod.birdnet_species_rollup
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT r.species, r.day, r.deployment_id, r.confidence_bucket,
+        count(*), min(r.time), max(r.time)
+    FROM (
+        SELECT o.species, f.deployment_id,
+            f.time + ((o.time_start || ' seconds')::interval) AS time,
+            ((f.time + ((o.time_start || ' seconds')::interval)) AT TIME ZONE 'UTC')::date AS day,
+            floor(o.confidence::numeric * 100)::smallint AS confidence_bucket
+        FROM prod.birdnet_results o
+        JOIN prod.files_audio f ON o.file_id = f.file_id
+        WHERE o.species IN (SELECT species FROM birdnet_species_rollup_affected)
+    ) r
+    JOIN birdnet_species_rollup_affected a
+        ON r.species = a.species AND r.day = a.day AND r.deployment_id = a.deployment_id
+    GROUP BY 1, 2, 3, 4;
+
+    DROP TABLE birdnet_species_rollup_affected;
+    RETURN NULL;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_refresh()
+    RETURNS void
+    LANGUAGE sql
+    AS $$
+    TRUNCATE prod.birdnet_species_rollup;
+    INSERT INTO prod.birdnet_species_rollup
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT r.species, (r.time AT TIME ZONE 'UTC')::date, r.deployment_id, r.confidence_bucket,
+        count(*), min(r.time), max(r.time)
+    FROM (
+        SELECT o.species, f.deployment_id,
+            f.time + ((o.time_start || ' seconds')::interval) AS time,
+            floor(o.confidence::numeric * 100)::smallint AS confidence_bucket
+        FROM prod.birdnet_results o
+        JOIN prod.files_audio f ON o.file_id = f.file_id
+    ) r
+    GROUP BY 1, 2, 3, 4;
+$$
+''')
+
+print('creating triggers on prod.birdnet_results')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_species_rollup_insert
+    AFTER INSERT ON prod.birdnet_results
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_species_rollup_insert()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_species_rollup_delete
+    AFTER DELETE ON prod.birdnet_results
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_species_rollup_delete()
+''')
+
+print('granting read access to the rollup')
+cursor.execute('GRANT SELECT ON prod.birdnet_species_rollup TO mitwelten_rest, mitwelten_public')
+cursor.execute('GRANT ALL ON prod.birdnet_species_rollup TO mitwelten_internal')
+
+print('populating prod.birdnet_species_rollup')
+cursor.execute('select prod.birdnet_species_rollup_refresh()')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
@@ -0,0 +1,206 @@
+import sys
+import psycopg2 as pg
+from tqdm import tqdm
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+BATCH_SIZE = 100000
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('adding absolute detection time to prod.birdnet_results')
+cursor.execute('ALTER TABLE prod.birdnet_results ADD COLUMN IF NOT EXISTS time timestamptz')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_results_set_time()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF NEW.time IS NULL THEN
+        SELECT f.time + ((NEW.time_start || ' seconds')::interval) INTO NEW.time
+        FROM prod.files_audio f
+        WHERE f.file_id = NEW.file_id;
+    END IF;
+    RETURN NEW;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_results_set_time
+    BEFORE INSERT ON prod.birdnet_results
+    FOR EACH ROW EXECUTE FUNCTION prod.birdnet_results_set_time()
+''')
+if not MIGRATION_COMPLETE:
+    connection.commit()
+
+# backfill in batches to keep transactions short
+print('populating prod.birdnet_results.time')
+cursor.execute('select min(result_id), max(result_id) from prod.birdnet_results')
+min_id, max_id = cursor.fetchone()
+if min_id != None:
+    for lower in tqdm(range(min_id, max_id + 1, BATCH_SIZE), ascii=True):
+        cursor.execute('''
+        update prod.birdnet_results r
+        set time = f.time + ((r.time_start || ' seconds')::interval)
+        from prod.files_audio f
+        where f.file_id = r.file_id and r.time is null and r.result_id >= %s and r.result_id < %s
+        ''', (lower, lower + BATCH_SIZE))
+        if not MIGRATION_COMPLETE:
+            connection.commit()
+
+cursor.execute('ALTER TABLE prod.birdnet_results ALTER COLUMN time SET NOT NULL')
+
+print('creating index on prod.birdnet_results (species, time)')
+cursor.execute('''
+CREATE INDEX IF NOT EXISTS birdnet_results_species_time_idx
+    ON prod.birdnet_results USING btree
+    (species ASC NULLS LAST, time ASC NULLS LAST)
+    INCLUDE (confidence)
+''')
+
+print('reading detection time in views')
+cursor.execute('''
+CREATE OR REPLACE VIEW prod.birdnet_inferred_species
+    AS
+    SELECT o.species,
+        o.confidence,
+        o.time AS time_start
+    FROM prod.birdnet_results o
+''')
+cursor.execute('''
+CREATE OR REPLACE VIEW prod.birdnet_inferred_species_file_taxonomy
+    AS
+    SELECT r.species,
+        r.confidence,
+        d.location,
+        f.object_name,
+        f.time AS object_time,
+        r.time_start AS time_start_relative,
+        f.duration AS duration,
+        r.time AS time_start,
+        d1.image_url,
+        d1.label_de  species_de,
+        d1.label_en  species_en,
+        d2.label_sci genus,
+        d3.label_sci family,
+        d4.label_sci class,
+        d5.label_sci phylum,
+        d6.label_sci kingdom,
+        r.result_id
+    FROM prod.birdnet_results r
+    LEFT JOIN prod.files_audio     f  ON r.file_id    = f.file_id
+    LEFT JOIN prod.taxonomy_data d1 ON r.species    = d1.label_sci
+    LEFT JOIN prod.taxonomy_tree   t  ON d1.datum_id  = t.species_id
+    LEFT JOIN prod.taxonomy_data d2 ON t.genus_id   = d2.datum_id
+    LEFT JOIN prod.taxonomy_data d3 ON t.family_id  = d3.datum_id
+    LEFT JOIN prod.taxonomy_data d4 ON t.class_id   = d4.datum_id
+    LEFT JOIN prod.taxonomy_data d5 ON t.phylum_id  = d5.datum_id
+    LEFT JOIN prod.taxonomy_data d6 ON t.kingdom_id = d6.datum_id
+    LEFT JOIN prod.deployments     d ON f.deployment_id = d.deployment_id
+    WHERE t.species_id IS NOT NULL
+''')
+
+print('reading detection time in species rollup maintenance functions')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_insert()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+BEGIN
+    -- serialize with birdnet_species_rollup_delete() per rollup key, in a fixed order
+    PERFORM pg_advisory_xact_lock(k) FROM (
+        SELECT DISTINCT hashtext(n.species || '/' || to_char((n.time AT TIME ZONE 'UTC')::date, 'YYYY-MM-DD') || '/' || f.deployment_id) AS k
+        FROM new_rows n
+        JOIN prod.files_audio f ON n.file_id = f.file_id
+        ORDER BY k
+    ) keys;
+
+    INSERT INTO prod.birdnet_species_rollup AS s
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT n.species, (n.time AT TIME ZONE 'UTC')::date, f.deployment_id,
+        floor(n.confidence::numeric * 100)::smallint,
+        count(*), min(n.time), max(n.time)
+    FROM new_rows n
+    JOIN prod.files_audio f ON n.file_id = f.file_id
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (species, day, deployment_id, confidence_bucket) DO UPDATE
+    SET count = s.count + excluded.count,
+        time_min = least(s.time_min, excluded.time_min),
+        time_max = greatest(s.time_max, excluded.time_max);
+    RETURN NULL;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_delete()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+BEGIN
+    CREATE TEMPORARY TABLE birdnet_species_rollup_affected ON COMMIT DROP AS
+    SELECT DISTINCT o.species, f.deployment_id, (o.time AT TIME ZONE 'UTC')::date AS day
+    FROM old_rows o
+    JOIN prod.files_audio f ON o.file_id = f.file_id;
+
+    -- serialize with birdnet_species_rollup_insert() per rollup key, in a fixed
+    -- order: the recount below then sees the results of concurrent inserts
+    PERFORM pg_advisory_xact_lock(k) FROM (
+        SELECT DISTINCT hashtext(species || '/' || to_char(day, 'YYYY-MM-DD') || '/' || deployment_id) AS k
+        FROM birdnet_species_rollup_affected
+        ORDER BY k
+    ) keys;
+
+    DELETE FROM prod.birdnet_species_rollup s
+    USING birdnet_species_rollup_affected a
+    WHERE s.species = a.species AND s.day = a.day AND s.deployment_id = a.deployment_id;
+
+    -- range scan on birdnet_results_species_time_idx
+    INSERT INTO prod.birdnet_species_rollup
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT o.species, a.day, a.deployment_id,
+        floor(o.confidence::numeric * 100)::smallint,
+        count(*), min(o.time), max(o.time)
+    FROM birdnet_species_rollup_affected a
+    JOIN prod.birdnet_results o ON o.species = a.species
+        AND o.time >= a.day::timestamp AT TIME ZONE 'UTC'
+        AND o.time < (a.day + 1)::timestamp AT TIME ZONE 'UTC'
+    JOIN prod.files_audio f ON o.file_id = f.file_id AND f.deployment_id = a.deployment_id
+    GROUP BY 1, 2, 3, 4;
+
+    DROP TABLE birdnet_species_rollup_affected;
+    RETURN NULL;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_refresh()
+    RETURNS void
+    LANGUAGE sql
+    AS $$
+    TRUNCATE prod.birdnet_species_rollup;
+    INSERT INTO prod.birdnet_species_rollup
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT o.species, (o.time AT TIME ZONE 'UTC')::date, f.deployment_id,
+        floor(o.confidence::numeric * 100)::smallint,
+        count(*), min(o.time), max(o.time)
+    FROM prod.birdnet_results o
+    JOIN prod.files_audio f ON o.file_id = f.file_id
+    GROUP BY 1, 2, 3, 4;
+$$
+''')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
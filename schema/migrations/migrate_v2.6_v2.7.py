@@ -0,0 +1,181 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('creating indices on prod.sensordata_env/pax (deployment_id, time)')
+cursor.execute('''
+CREATE INDEX IF NOT EXISTS sensordata_env_deployment_id_time_idx
+    ON prod.sensordata_env USING btree
+    (deployment_id ASC NULLS LAST, time DESC NULLS LAST)
+''')
+cursor.execute('''
+CREATE INDEX IF NOT EXISTS sensordata_pax_deployment_id_time_idx
+    ON prod.sensordata_pax USING btree
+    (deployment_id ASC NULLS LAST, time DESC NULLS LAST)
+''')
+
+for table in ['sensordata_env', 'sensordata_pax']:
+    print(f'converting prod.{table} to hypertable, this may take a while')
+    cursor.execute(f"SELECT create_hypertable('prod.{table}', 'time', chunk_time_interval => interval '7 days', migrate_data => true, if_not_exists => true)")
+    print(f'enabling compression of prod.{table} chunks older than 30 days')
+    cursor.execute(f'''
+    ALTER TABLE prod.{table} SET (
+        timescaledb.compress,
+        timescaledb.compress_segmentby = 'deployment_id',
+        timescaledb.compress_orderby = 'time DESC'
+    )
+    ''')
+    cursor.execute(f"SELECT add_compression_policy('prod.{table}', interval '30 days', if_not_exists => true)")
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+    # continuous aggregates can not be created or refreshed inside a transaction block
+    connection.autocommit = True
+
+    print('creating continuous aggregates')
+    print('- prod.sensordata_env_hourly')
+    cursor.execute('''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_env_hourly
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+        AS
+        SELECT deployment_id,
+            time_bucket(interval '1 hour', time) AS time,
+            sum(temperature) AS temperature_sum,
+            count(temperature) AS temperature_count,
+            min(temperature) AS temperature_min,
+            max(temperature) AS temperature_max,
+            sum(humidity) AS humidity_sum,
+            count(humidity) AS humidity_count,
+            min(humidity) AS humidity_min,
+            max(humidity) AS humidity_max,
+            sum(moisture) AS moisture_sum,
+            count(moisture) AS moisture_count,
+            min(moisture) AS moisture_min,
+            max(moisture) AS moisture_max,
+            sum(voltage) AS voltage_sum,
+            count(voltage) AS voltage_count,
+            min(voltage) AS voltage_min,
+            max(voltage) AS voltage_max
+        FROM prod.sensordata_env
+        GROUP BY deployment_id, time_bucket(interval '1 hour', time)
+        WITH NO DATA
+    ''')
+    print('- prod.sensordata_env_daily')
+    cursor.execute('''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_env_daily
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+        AS
+        SELECT deployment_id,
+            time_bucket(interval '1 day', time) AS time,
+            sum(temperature) AS temperature_sum,
+            count(temperature) AS temperature_count,
+            min(temperature) AS temperature_min,
+            max(temperature) AS temperature_max,
+            sum(humidity) AS humidity_sum,
+            count(humidity) AS humidity_count,
+            min(humidity) AS humidity_min,
+            max(humidity) AS humidity_max,
+            sum(moisture) AS moisture_sum,
+            count(moisture) AS moisture_count,
+            min(moisture) AS moisture_min,
+            max(moisture) AS moisture_max,
+            sum(voltage) AS voltage_sum,
+            count(voltage) AS voltage_count,
+            min(voltage) AS voltage_min,
+            max(voltage) AS voltage_max
+        FROM prod.sensordata_env
+        GROUP BY deployment_id, time_bucket(interval '1 day', time)
+        WITH NO DATA
+    ''')
+    print('- prod.sensordata_pax_hourly')
+    cursor.execute('''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_pax_hourly
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+        AS
+        SELECT deployment_id,
+            time_bucket(interval '1 hour', time) AS time,
+            sum(pax) AS pax_sum,
+            count(pax) AS pax_count,
+            min(pax) AS pax_min,
+            max(pax) AS pax_max,
+            sum(voltage) AS voltage_sum,
+            count(voltage) AS voltage_count,
+            min(voltage) AS voltage_min,
+            max(voltage) AS voltage_max
+        FROM prod.sensordata_pax
+        GROUP BY deployment_id, time_bucket(interval '1 hour', time)
+        WITH NO DATA
+    ''')
+    print('- prod.sensordata_pax_daily')
+    cursor.execute('''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_pax_daily
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+        AS
+        SELECT deployment_id,
+            time_bucket(interval '1 day', time) AS time,
+            sum(pax) AS pax_sum,
+            count(pax) AS pax_count,
+            min(pax) AS pax_min,
+            max(pax) AS pax_max,
+            sum(voltage) AS voltage_sum,
+            count(voltage) AS voltage_count,
+            min(voltage) AS voltage_min,
+            max(voltage) AS voltage_max
+        FROM prod.sensordata_pax
+        GROUP BY deployment_id, time_bucket(interval '1 day', time)
+        WITH NO DATA
+    ''')
+    cursor.execute('''
+    SELECT add_continuous_aggregate_policy('prod.sensordata_env_hourly',
+        start_offset => interval '3 days',
+        end_offset => interval '1 hour',
+        schedule_interval => interval '1 hour',
+        if_not_exists => true)
+    ''')
+    cursor.execute('''
+    SELECT add_continuous_aggregate_policy('prod.sensordata_env_daily',
+        start_offset => interval '7 days',
+        end_offset => interval '1 day',
+        schedule_interval => interval '1 day',
+        if_not_exists => true)
+    ''')
+    cursor.execute('''
+    SELECT add_continuous_aggregate_policy('prod.sensordata_pax_hourly',
+        start_offset => interval '3 days',
+        end_offset => interval '1 hour',
+        schedule_interval => interval '1 hour',
+        if_not_exists => true)
+    ''')
+    cursor.execute('''
+    SELECT add_continuous_aggregate_policy('prod.sensordata_pax_daily',
+        start_offset => interval '7 days',
+        end_offset => interval '1 day',
+        schedule_interval => interval '1 day',
+        if_not_exists => true)
+    ''')
+    cursor.execute('''
+    GRANT SELECT ON
+      prod.sensordata_env_hourly,
+      prod.sensordata_env_daily,
+      prod.sensordata_pax_hourly,
+      prod.sensordata_pax_daily
+    TO mitwelten_rest, mitwelten_public
+    ''')
+
+    print('materializing continuous aggregates, this may take a while')
+    for view in ['sensordata_env_hourly', 'sensordata_env_daily', 'sensordata_pax_hourly', 'sensordata_pax_daily']:
+        print(f'- prod.{view}')
+        cursor.execute(f"CALL refresh_continuous_aggregate('prod.{view}', NULL, NULL)")
+
+cursor.close()
+connection.close()
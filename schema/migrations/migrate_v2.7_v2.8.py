@@ -0,0 +1,42 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('creating table prod.files_image_derived')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS prod.files_image_derived
+(
+    file_id integer NOT NULL,
+    size smallint NOT NULL,
+    object_name text NOT NULL,
+    file_size integer NOT NULL,
+    resolution integer[] NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY (file_id, size)
+)
+''')
+cursor.execute('''
+ALTER TABLE IF EXISTS prod.files_image_derived
+    ADD FOREIGN KEY (file_id)
+    REFERENCES prod.files_image (file_id) MATCH SIMPLE
+    ON UPDATE NO ACTION
+    ON DELETE CASCADE
+    NOT VALID
+''')
+cursor.execute('GRANT ALL ON prod.files_image_derived TO mitwelten_internal, mitwelten_rest')
+cursor.execute('GRANT SELECT ON prod.files_image_derived TO mitwelten_public')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
@@ -0,0 +1,190 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('creating table prod.birdnet_queue_progress')
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_progress
+(
+    deployment_id integer NOT NULL,
+    state integer NOT NULL, -- birdnet_tasks.state, -1: not queued
+    count integer NOT NULL,
+    size bigint NOT NULL,
+    PRIMARY KEY (deployment_id, state)
+)
+''')
+cursor.execute('GRANT ALL ON prod.birdnet_queue_progress TO mitwelten_internal')
+cursor.execute('GRANT SELECT ON prod.birdnet_queue_progress TO mitwelten_rest')
+
+print('creating queue progress maintenance functions')
+# queue progress: audio files eligible for BirdNET (48 kHz, at least 3 seconds)
+# per deployment and task state, files without task are counted in state -1.
+# concurrent transactions queueing the first tasks of the same file may skew
+# the not queued count, rebuild with birdnet_queue_progress_refresh()
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_progress_files()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+    deployment_ids text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT *, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT *, -1 AS sign FROM old_rows'
+        ELSE 'SELECT *, -1 AS sign FROM old_rows UNION ALL SELECT *, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (%s),
+    delta AS (
+        SELECT c.deployment_id, coalesce(t.state, -1) AS state, c.sign AS count, c.sign * c.file_size::bigint AS size
+        FROM changed c
+        LEFT JOIN prod.birdnet_tasks t ON t.file_id = c.file_id
+        WHERE c.sample_rate = 48000 AND c.duration >= 3
+    ),
+    applied AS (
+        INSERT INTO prod.birdnet_queue_progress AS p (deployment_id, state, count, size)
+        SELECT deployment_id, state, sum(count), sum(size) FROM delta
+        GROUP BY deployment_id, state
+        HAVING sum(count) != 0 OR sum(size) != 0
+        ON CONFLICT (deployment_id, state) DO UPDATE
+        SET count = p.count + excluded.count, size = p.size + excluded.size
+        RETURNING deployment_id
+    )
+    SELECT string_agg(DISTINCT deployment_id::text, ',') FROM applied
+    $sql$, changed) INTO deployment_ids;
+    IF deployment_ids IS NOT NULL THEN
+        PERFORM pg_notify('birdnet_queue_progress', deployment_ids);
+    END IF;
+    RETURN NULL;
+END;
+$$
+''')
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_progress_tasks()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+    deployment_ids text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT file_id, state, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT file_id, state, -1 AS sign FROM old_rows'
+        ELSE 'SELECT file_id, state, -1 AS sign FROM old_rows UNION ALL SELECT file_id, state, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (%s),
+    files AS (
+        SELECT c.file_id, sum(c.sign) AS added,
+            (SELECT count(*) FROM prod.birdnet_tasks t WHERE t.file_id = c.file_id) AS tasks
+        FROM changed c
+        GROUP BY c.file_id
+    ),
+    delta AS (
+        SELECT f.deployment_id, d.state, d.sign AS count, d.sign * f.file_size::bigint AS size
+        FROM (
+            SELECT file_id, state, sign FROM changed
+            UNION ALL
+            -- files leaving or entering the state 'not queued'
+            SELECT file_id, -1, (tasks = 0)::integer - (tasks - added = 0)::integer FROM files
+        ) d
+        JOIN prod.files_audio f ON f.file_id = d.file_id
+        WHERE f.sample_rate = 48000 AND f.duration >= 3 AND d.sign != 0
+    ),
+    applied AS (
+        INSERT INTO prod.birdnet_queue_progress AS p (deployment_id, state, count, size)
+        SELECT deployment_id, state, sum(count), sum(size) FROM delta
+        GROUP BY deployment_id, state
+        HAVING sum(count) != 0 OR sum(size) != 0
+        ON CONFLICT (deployment_id, state) DO UPDATE
+        SET count = p.count + excluded.count, size = p.size + excluded.size
+        RETURNING deployment_id
+    )
+    SELECT string_agg(DISTINCT deployment_id::text, ',') FROM applied
+    $sql$, changed) INTO deployment_ids;
+    IF deployment_ids IS NOT NULL THEN
+        PERFORM pg_notify('birdnet_queue_progress', deployment_ids);
+    END IF;
+    RETURN NULL;
+END;
+$$
+''')
+# rebuild the queue progress from scratch
+cursor.execute('''
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_progress_refresh()
+    RETURNS void
+    LANGUAGE sql
+    AS $$
+    TRUNCATE prod.birdnet_queue_progress;
+    INSERT INTO prod.birdnet_queue_progress (deployment_id, state, count, size)
+    SELECT f.deployment_id, coalesce(t.state, -1), count(*), sum(f.file_size)
+    FROM prod.files_audio f
+    LEFT JOIN prod.birdnet_tasks t ON t.file_id = f.file_id
+    WHERE f.sample_rate = 48000 AND f.duration >= 3
+    GROUP BY 1, 2;
+    SELECT pg_notify('birdnet_queue_progress', '');
+$$
+''')
+
+print('creating queue progress triggers')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_files_insert
+    AFTER INSERT ON prod.files_audio
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_files()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_files_update
+    AFTER UPDATE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_files()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_files_delete
+    AFTER DELETE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_files()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_tasks_insert
+    AFTER INSERT ON prod.birdnet_tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_tasks()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_tasks_update
+    AFTER UPDATE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_tasks()
+''')
+cursor.execute('''
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_tasks_delete
+    AFTER DELETE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_tasks()
+''')
+
+print('computing queue progress')
+cursor.execute('SELECT prod.birdnet_queue_progress_refresh()')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
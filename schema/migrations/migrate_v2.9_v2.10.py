@@ -0,0 +1,54 @@
+import sys
+import psycopg2 as pg
+
+sys.path.append('../../')
+import credentials as crd
+
+# Set to True once the migration has been applied, do not run it again.
+MIGRATION_COMPLETE = False
+
+connection = pg.connect(host=crd.db.host,port=crd.db.port,database=crd.db.database,user=crd.db.user,password=crd.db.password)
+cursor = connection.cursor()
+
+print('adding lease_until to prod.birdnet_tasks')
+cursor.execute('ALTER TABLE prod.birdnet_tasks ADD COLUMN IF NOT EXISTS lease_until timestamptz')
+
+print('creating indexes for task claims')
+cursor.execute('''
+CREATE INDEX IF NOT EXISTS birdnet_tasks_pending_idx
+    ON prod.birdnet_tasks USING btree
+    (scheduled_on ASC NULLS LAST, task_id ASC NULLS LAST)
+    WHERE state = 0
+''')
+cursor.execute('''
+CREATE INDEX IF NOT EXISTS birdnet_tasks_lease_until_idx
+    ON prod.birdnet_tasks USING btree
+    (lease_until ASC NULLS LAST)
+    WHERE state = 1
+''')
+
+print('granting task claims and completion to mitwelten_rest')
+cursor.execute('GRANT UPDATE ON prod.birdnet_tasks TO mitwelten_rest')
+cursor.execute('GRANT INSERT ON prod.birdnet_results TO mitwelten_rest')
+cursor.execute('GRANT UPDATE ON prod.birdnet_results_result_id_seq TO mitwelten_rest')
+
+# insert a result of an existing task the way /queue/complete does, rolled back:
+# this fires the species rollup triggers, running as definer since v2.5
+print('checking result inserts as mitwelten_rest')
+cursor.execute('SAVEPOINT rest_results_check')
+cursor.execute('SET LOCAL ROLE mitwelten_rest')
+cursor.execute('SELECT task_id, file_id FROM prod.birdnet_tasks LIMIT 1')
+task = cursor.fetchone()
+if task != None:
+    cursor.execute('''
+    INSERT INTO prod.birdnet_results (task_id, file_id, time_start, time_end, confidence, species)
+    VALUES (%s, %s, 0, 3, 0.5, 'migration check')
+    ''', task)
+cursor.execute('ROLLBACK TO SAVEPOINT rest_results_check')
+
+if not MIGRATION_COMPLETE:
+    print('committing...')
+    connection.commit()
+
+cursor.close()
+connection.close()
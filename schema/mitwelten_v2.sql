@@ -1,5 +1,5 @@
 --
--- Mitwelten Database - Schema V2.3
+-- Mitwelten Database - Schema V2.13
 --
 
 BEGIN;
@@ -16,6 +16,7 @@ CREATE TABLE IF NOT EXISTS prod.birdnet_configs
     config_id serial,
     config jsonb NOT NULL,
     comment text,
+    max_running integer, -- quota of running tasks claimed through the api, NULL: unlimited
     created_at timestamptz NOT NULL DEFAULT current_timestamp,
     updated_at timestamptz NOT NULL DEFAULT current_timestamp,
     PRIMARY KEY (config_id),
@@ -67,6 +68,17 @@ CREATE TABLE IF NOT EXISTS prod.files_image
     UNIQUE (sha256)
 );
 
+CREATE TABLE IF NOT EXISTS prod.files_image_derived
+(
+    file_id integer NOT NULL,
+    size smallint NOT NULL,
+    object_name text NOT NULL,
+    file_size integer NOT NULL,
+    resolution integer[] NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY (file_id, size)
+);
+
 CREATE TABLE IF NOT EXISTS prod.birdnet_results
 (
     result_id serial,
@@ -76,9 +88,61 @@ CREATE TABLE IF NOT EXISTS prod.birdnet_results
     time_end real NOT NULL,
     confidence real NOT NULL,
     species character varying(255) NOT NULL,
+    time timestamptz NOT NULL, -- set by trigger: files_audio.time + time_start
     PRIMARY KEY (result_id)
 );
 
+-- species detections per day, deployment and confidence bucket,
+-- maintained by triggers on birdnet_results
+CREATE TABLE IF NOT EXISTS prod.birdnet_species_rollup
+(
+    species character varying(255) NOT NULL,
+    day date NOT NULL,
+    deployment_id integer NOT NULL,
+    confidence_bucket smallint NOT NULL, -- floor(confidence * 100)
+    count integer NOT NULL,
+    time_min timestamptz NOT NULL,
+    time_max timestamptz NOT NULL,
+    PRIMARY KEY (species, day, deployment_id, confidence_bucket)
+);
+
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_progress
+(
+    deployment_id integer NOT NULL,
+    state integer NOT NULL, -- birdnet_tasks.state, -1: not queued
+    count integer NOT NULL,
+    size bigint NOT NULL,
+    PRIMARY KEY (deployment_id, state)
+);
+
+-- BirdNET queue statistics per deployment, see birdnet_queue_stats_*()
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_stats
+(
+    deployment_id integer NOT NULL,
+    time_min timestamptz, -- eligible files
+    time_max timestamptz,
+    tasks_done integer NOT NULL DEFAULT 0, -- tasks in state 2
+    runtime_sum interval NOT NULL DEFAULT '0',
+    runtime_min interval,
+    runtime_max interval,
+    scheduled_on_min timestamptz,
+    scheduled_on_max timestamptz,
+    end_on_min timestamptz,
+    end_on_max timestamptz,
+    results integer NOT NULL DEFAULT 0,
+    results_conf_09 integer NOT NULL DEFAULT 0, -- confidence > 0.9
+    PRIMARY KEY (deployment_id)
+);
+
+-- eligible files per deployment and duration, for the most common duration
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_durations
+(
+    deployment_id integer NOT NULL,
+    duration double precision NOT NULL,
+    count integer NOT NULL,
+    PRIMARY KEY (deployment_id, duration)
+);
+
 CREATE TABLE IF NOT EXISTS prod.birdnet_species_occurrence
 (
     id serial,
@@ -102,10 +166,38 @@ CREATE TABLE IF NOT EXISTS prod.birdnet_tasks
     scheduled_on timestamptz NOT NULL,
     pickup_on timestamptz,
     end_on timestamptz,
+    lease_until timestamptz, -- running tasks claimed through the api return to pending after
+    priority bigint NOT NULL DEFAULT 0, -- claimed in ascending order
     PRIMARY KEY (task_id),
     CONSTRAINT unique_task_in_batch UNIQUE (file_id, config_id, batch_id)
 );
 
+-- chunked background operations on the BirdNET queue (resets)
+CREATE TABLE IF NOT EXISTS prod.birdnet_queue_jobs
+(
+    job_id serial,
+    action character varying(32) NOT NULL,
+    selection jsonb NOT NULL,
+    state character varying(16) NOT NULL DEFAULT 'pending', -- pending, running, cancelled, interrupted, failed, done
+    last_task_id integer NOT NULL DEFAULT 0, -- tasks are processed in ascending order, resumed after this one
+    total integer,
+    processed integer NOT NULL DEFAULT 0,
+    results_deleted bigint NOT NULL DEFAULT 0,
+    error text,
+    created_at timestamptz NOT NULL DEFAULT current_timestamp,
+    updated_at timestamptz NOT NULL DEFAULT current_timestamp,
+    finished_at timestamptz,
+    PRIMARY KEY (job_id)
+);
+
+-- share of the BirdNET queue per node, relative to the default weight 1
+CREATE TABLE IF NOT EXISTS prod.birdnet_node_weights
+(
+    node_id integer NOT NULL,
+    weight real NOT NULL DEFAULT 1 CHECK (weight > 0),
+    PRIMARY KEY (node_id)
+);
+
 CREATE TABLE IF NOT EXISTS prod.nodes
 (
     node_id serial,
@@ -325,6 +417,12 @@ ALTER TABLE IF EXISTS prod.birdnet_tasks
     ON UPDATE NO ACTION
     ON DELETE RESTRICT;
 
+ALTER TABLE IF EXISTS prod.birdnet_node_weights
+    ADD FOREIGN KEY (node_id)
+    REFERENCES prod.nodes (node_id) MATCH SIMPLE
+    ON UPDATE NO ACTION
+    ON DELETE CASCADE;
+
 ALTER TABLE IF EXISTS prod.deployments
     ADD FOREIGN KEY (node_id)
     REFERENCES prod.nodes (node_id) MATCH SIMPLE
@@ -384,6 +482,13 @@ ALTER TABLE IF EXISTS prod.files_entry
     ON DELETE CASCADE
     NOT VALID;
 
+ALTER TABLE IF EXISTS prod.files_image_derived
+    ADD FOREIGN KEY (file_id)
+    REFERENCES prod.files_image (file_id) MATCH SIMPLE
+    ON UPDATE NO ACTION
+    ON DELETE CASCADE
+    NOT VALID;
+
 ALTER TABLE IF EXISTS prod.image_results
   ADD FOREIGN KEY (config_id)
   REFERENCES prod.pollinator_inference_config (config_id) MATCH SIMPLE
@@ -450,6 +555,55 @@ CREATE INDEX IF NOT EXISTS taxonomy_labels_label_sci_idx
     ON prod.taxonomy_labels USING btree
     (label_sci ASC NULLS LAST);
 
+-- time range scans of detections per species
+CREATE INDEX IF NOT EXISTS birdnet_results_species_time_idx
+    ON prod.birdnet_results USING btree
+    (species ASC NULLS LAST, time ASC NULLS LAST)
+    INCLUDE (confidence);
+
+-- claiming tasks in order of priority and scheduling
+CREATE INDEX IF NOT EXISTS birdnet_tasks_state_priority_idx
+    ON prod.birdnet_tasks USING btree
+    (state ASC NULLS LAST, priority ASC NULLS LAST, scheduled_on ASC NULLS LAST);
+
+-- expired leases of running tasks
+CREATE INDEX IF NOT EXISTS birdnet_tasks_lease_until_idx
+    ON prod.birdnet_tasks USING btree
+    (lease_until ASC NULLS LAST)
+    WHERE state = 1;
+
+-- time range selection of the species rollup
+CREATE INDEX IF NOT EXISTS birdnet_species_rollup_day_idx
+    ON prod.birdnet_species_rollup USING btree
+    (day ASC NULLS LAST);
+
+-- time range scans of sensor data per deployment
+CREATE INDEX IF NOT EXISTS sensordata_env_deployment_id_time_idx
+    ON prod.sensordata_env USING btree
+    (deployment_id ASC NULLS LAST, time DESC NULLS LAST);
+
+CREATE INDEX IF NOT EXISTS sensordata_pax_deployment_id_time_idx
+    ON prod.sensordata_pax USING btree
+    (deployment_id ASC NULLS LAST, time DESC NULLS LAST);
+
+-- sensor data is chunked by time, chunks older than 30 days are compressed
+SELECT create_hypertable('prod.sensordata_env', 'time', chunk_time_interval => interval '7 days', if_not_exists => true);
+SELECT create_hypertable('prod.sensordata_pax', 'time', chunk_time_interval => interval '7 days', if_not_exists => true);
+
+ALTER TABLE prod.sensordata_env SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'deployment_id',
+    timescaledb.compress_orderby = 'time DESC'
+);
+ALTER TABLE prod.sensordata_pax SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'deployment_id',
+    timescaledb.compress_orderby = 'time DESC'
+);
+
+SELECT add_compression_policy('prod.sensordata_env', interval '30 days', if_not_exists => true);
+SELECT add_compression_policy('prod.sensordata_pax', interval '30 days', if_not_exists => true);
+
 CREATE OR REPLACE VIEW prod.birdnet_input
     AS
     SELECT f.file_id,
@@ -468,9 +622,8 @@ CREATE OR REPLACE VIEW prod.birdnet_inferred_species
     AS
     SELECT o.species,
         o.confidence,
-        f.time + ((o.time_start || ' seconds')::interval) AS time_start
-    FROM prod.birdnet_results o
-    LEFT JOIN prod.files_audio f ON o.file_id = f.file_id;
+        o.time AS time_start
+    FROM prod.birdnet_results o;
 
 CREATE OR REPLACE VIEW prod.birdnet_inferred_species_day
     AS
@@ -488,7 +641,7 @@ CREATE OR REPLACE VIEW prod.birdnet_inferred_species_file_taxonomy
         f.time AS object_time,
         r.time_start AS time_start_relative,
         f.duration AS duration,
-        f.time + ((r.time_start || ' seconds')::interval) AS time_start,
+        r.time AS time_start,
         d1.image_url,
         d1.label_de  species_de,
         d1.label_en  species_en,
@@ -496,7 +649,8 @@ CREATE OR REPLACE VIEW prod.birdnet_inferred_species_file_taxonomy
         d3.label_sci family,
         d4.label_sci class,
         d5.label_sci phylum,
-        d6.label_sci kingdom
+        d6.label_sci kingdom,
+        r.result_id
 
     FROM prod.birdnet_results r
 
@@ -530,6 +684,478 @@ CREATE OR REPLACE VIEW prod.data_records
     SELECT file_id AS record_id, deployment_id, 'image' AS type
     FROM prod.files_image;
 
+-- absolute detection timestamp of a result, derived from the time of the file
+CREATE OR REPLACE FUNCTION prod.birdnet_results_set_time()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF NEW.time IS NULL THEN
+        SELECT f.time + ((NEW.time_start || ' seconds')::interval) INTO NEW.time
+        FROM prod.files_audio f
+        WHERE f.file_id = NEW.file_id;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE TRIGGER birdnet_results_set_time
+    BEFORE INSERT ON prod.birdnet_results
+    FOR EACH ROW EXECUTE FUNCTION prod.birdnet_results_set_time();
+
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_insert()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+BEGIN
+    -- serialize with birdnet_species_rollup_delete() per rollup key, in a fixed order
+    PERFORM pg_advisory_xact_lock(k) FROM (
+        SELECT DISTINCT hashtext(n.species || '/' || to_char((n.time AT TIME ZONE 'UTC')::date, 'YYYY-MM-DD') || '/' || f.deployment_id) AS k
+        FROM new_rows n
+        JOIN prod.files_audio f ON n.file_id = f.file_id
+        ORDER BY k
+    ) keys;
+
+    INSERT INTO prod.birdnet_species_rollup AS s
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT n.species, (n.time AT TIME ZONE 'UTC')::date, f.deployment_id,
+        floor(n.confidence::numeric * 100)::smallint,
+        count(*), min(n.time), max(n.time)
+    FROM new_rows n
+    JOIN prod.files_audio f ON n.file_id = f.file_id
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (species, day, deployment_id, confidence_bucket) DO UPDATE
+    SET count = s.count + excluded.count,
+        time_min = least(s.time_min, excluded.time_min),
+        time_max = greatest(s.time_max, excluded.time_max);
+    RETURN NULL;
+END;
+$$;
+
+-- recompute the groups affected by deleted results, deletes are rare (queue resets)
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_delete()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+BEGIN
+    CREATE TEMPORARY TABLE birdnet_species_rollup_affected ON COMMIT DROP AS
+    SELECT DISTINCT o.species, f.deployment_id, (o.time AT TIME ZONE 'UTC')::date AS day
+    FROM old_rows o
+    JOIN prod.files_audio f ON o.file_id = f.file_id;
+
+    -- serialize with birdnet_species_rollup_insert() per rollup key, in a fixed
+    -- order: the recount below then sees the results of concurrent inserts
+    PERFORM pg_advisory_xact_lock(k) FROM (
+        SELECT DISTINCT hashtext(species || '/' || to_char(day, 'YYYY-MM-DD') || '/' || deployment_id) AS k
+        FROM birdnet_species_rollup_affected
+        ORDER BY k
+    ) keys;
+
+    DELETE FROM prod.birdnet_species_rollup s
+    USING birdnet_species_rollup_affected a
+    WHERE s.species = a.species AND s.day = a.day AND s.deployment_id = a.deployment_id;
+
+    -- range scan on birdnet_results_species_time_idx
+    INSERT INTO prod.birdnet_species_rollup
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT o.species, a.day, a.deployment_id,
+        floor(o.confidence::numeric * 100)::smallint,
+        count(*), min(o.time), max(o.time)
+    FROM birdnet_species_rollup_affected a
+    JOIN prod.birdnet_results o ON o.species = a.species
+        AND o.time >= a.day::timestamp AT TIME ZONE 'UTC'
+        AND o.time < (a.day + 1)::timestamp AT TIME ZONE 'UTC'
+    JOIN prod.files_audio f ON o.file_id = f.file_id AND f.deployment_id = a.deployment_id
+    GROUP BY 1, 2, 3, 4;
+
+    DROP TABLE birdnet_species_rollup_affected;
+    RETURN NULL;
+END;
+$$;
+
+-- rebuild the species rollup from scratch
+CREATE OR REPLACE FUNCTION prod.birdnet_species_rollup_refresh()
+    RETURNS void
+    LANGUAGE sql
+    AS $$
+    TRUNCATE prod.birdnet_species_rollup;
+    INSERT INTO prod.birdnet_species_rollup
+        (species, day, deployment_id, confidence_bucket, count, time_min, time_max)
+    SELECT o.species, (o.time AT TIME ZONE 'UTC')::date, f.deployment_id,
+        floor(o.confidence::numeric * 100)::smallint,
+        count(*), min(o.time), max(o.time)
+    FROM prod.birdnet_results o
+    JOIN prod.files_audio f ON o.file_id = f.file_id
+    GROUP BY 1, 2, 3, 4;
+$$;
+
+CREATE OR REPLACE TRIGGER birdnet_species_rollup_insert
+    AFTER INSERT ON prod.birdnet_results
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_species_rollup_insert();
+
+CREATE OR REPLACE TRIGGER birdnet_species_rollup_delete
+    AFTER DELETE ON prod.birdnet_results
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_species_rollup_delete();
+
+-- queue progress: audio files eligible for BirdNET (48 kHz, at least 3 seconds)
+-- per deployment and task state, files without task are counted in state -1.
+-- concurrent transactions queueing the first tasks of the same file may skew
+-- the not queued count, rebuild with birdnet_queue_progress_refresh()
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_progress_files()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+    deployment_ids text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT *, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT *, -1 AS sign FROM old_rows'
+        ELSE 'SELECT *, -1 AS sign FROM old_rows UNION ALL SELECT *, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (%s),
+    delta AS (
+        SELECT c.deployment_id, coalesce(t.state, -1) AS state, c.sign AS count, c.sign * c.file_size::bigint AS size
+        FROM changed c
+        LEFT JOIN prod.birdnet_tasks t ON t.file_id = c.file_id
+        WHERE c.sample_rate = 48000 AND c.duration >= 3
+    ),
+    applied AS (
+        INSERT INTO prod.birdnet_queue_progress AS p (deployment_id, state, count, size)
+        SELECT deployment_id, state, sum(count), sum(size) FROM delta
+        GROUP BY deployment_id, state
+        HAVING sum(count) != 0 OR sum(size) != 0
+        ON CONFLICT (deployment_id, state) DO UPDATE
+        SET count = p.count + excluded.count, size = p.size + excluded.size
+        RETURNING deployment_id
+    )
+    SELECT string_agg(DISTINCT deployment_id::text, ',') FROM applied
+    $sql$, changed) INTO deployment_ids;
+    IF deployment_ids IS NOT NULL THEN
+        PERFORM pg_notify('birdnet_queue_progress', deployment_ids);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_progress_tasks()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+    deployment_ids text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT file_id, state, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT file_id, state, -1 AS sign FROM old_rows'
+        ELSE 'SELECT file_id, state, -1 AS sign FROM old_rows UNION ALL SELECT file_id, state, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (%s),
+    files AS (
+        SELECT c.file_id, sum(c.sign) AS added,
+            (SELECT count(*) FROM prod.birdnet_tasks t WHERE t.file_id = c.file_id) AS tasks
+        FROM changed c
+        GROUP BY c.file_id
+    ),
+    delta AS (
+        SELECT f.deployment_id, d.state, d.sign AS count, d.sign * f.file_size::bigint AS size
+        FROM (
+            SELECT file_id, state, sign FROM changed
+            UNION ALL
+            -- files leaving or entering the state 'not queued'
+            SELECT file_id, -1, (tasks = 0)::integer - (tasks - added = 0)::integer FROM files
+        ) d
+        JOIN prod.files_audio f ON f.file_id = d.file_id
+        WHERE f.sample_rate = 48000 AND f.duration >= 3 AND d.sign != 0
+    ),
+    applied AS (
+        INSERT INTO prod.birdnet_queue_progress AS p (deployment_id, state, count, size)
+        SELECT deployment_id, state, sum(count), sum(size) FROM delta
+        GROUP BY deployment_id, state
+        HAVING sum(count) != 0 OR sum(size) != 0
+        ON CONFLICT (deployment_id, state) DO UPDATE
+        SET count = p.count + excluded.count, size = p.size + excluded.size
+        RETURNING deployment_id
+    )
+    SELECT string_agg(DISTINCT deployment_id::text, ',') FROM applied
+    $sql$, changed) INTO deployment_ids;
+    IF deployment_ids IS NOT NULL THEN
+        PERFORM pg_notify('birdnet_queue_progress', deployment_ids);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- rebuild the queue progress from scratch
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_progress_refresh()
+    RETURNS void
+    LANGUAGE sql
+    AS $$
+    TRUNCATE prod.birdnet_queue_progress;
+    INSERT INTO prod.birdnet_queue_progress (deployment_id, state, count, size)
+    SELECT f.deployment_id, coalesce(t.state, -1), count(*), sum(f.file_size)
+    FROM prod.files_audio f
+    LEFT JOIN prod.birdnet_tasks t ON t.file_id = f.file_id
+    WHERE f.sample_rate = 48000 AND f.duration >= 3
+    GROUP BY 1, 2;
+    SELECT pg_notify('birdnet_queue_progress', '');
+$$;
+
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_files_insert
+    AFTER INSERT ON prod.files_audio
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_files();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_files_update
+    AFTER UPDATE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_files();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_files_delete
+    AFTER DELETE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_files();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_tasks_insert
+    AFTER INSERT ON prod.birdnet_tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_tasks();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_tasks_update
+    AFTER UPDATE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_tasks();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_progress_tasks_delete
+    AFTER DELETE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_progress_tasks();
+
+-- queue statistics: files, completed tasks and results of the audio files
+-- eligible for BirdNET (48 kHz, at least 3 seconds) per deployment. counts and
+-- sums follow all changes, the minima and maxima only widen: after deleting
+-- or resetting, or after moving files between deployments, they are exact
+-- again once rebuilt with birdnet_queue_stats_refresh()
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_files()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT *, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT *, -1 AS sign FROM old_rows'
+        ELSE 'SELECT *, -1 AS sign FROM old_rows UNION ALL SELECT *, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (
+        SELECT deployment_id, duration, time, sign FROM (%s) c
+        WHERE sample_rate = 48000 AND duration >= 3
+    ),
+    durations AS (
+        INSERT INTO prod.birdnet_queue_durations AS d (deployment_id, duration, count)
+        SELECT deployment_id, duration, sum(sign) FROM changed
+        GROUP BY deployment_id, duration
+        HAVING sum(sign) != 0
+        ON CONFLICT (deployment_id, duration) DO UPDATE
+        SET count = d.count + excluded.count
+    )
+    INSERT INTO prod.birdnet_queue_stats AS s (deployment_id, time_min, time_max)
+    SELECT deployment_id, min(time), max(time) FROM changed
+    WHERE sign > 0
+    GROUP BY deployment_id
+    ON CONFLICT (deployment_id) DO UPDATE
+    SET time_min = least(s.time_min, excluded.time_min),
+        time_max = greatest(s.time_max, excluded.time_max)
+    $sql$, changed);
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_tasks()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT *, 1 AS sign FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT *, -1 AS sign FROM old_rows'
+        ELSE 'SELECT *, -1 AS sign FROM old_rows UNION ALL SELECT *, 1 AS sign FROM new_rows'
+    END;
+    EXECUTE format($sql$
+    WITH changed AS (
+        SELECT f.deployment_id, c.scheduled_on, c.end_on, c.end_on - c.pickup_on AS runtime, c.sign
+        FROM (%s) c
+        JOIN prod.files_audio f ON f.file_id = c.file_id
+        WHERE c.state = 2 AND f.sample_rate = 48000 AND f.duration >= 3
+    )
+    INSERT INTO prod.birdnet_queue_stats AS s (deployment_id, tasks_done, runtime_sum,
+        runtime_min, runtime_max, scheduled_on_min, scheduled_on_max, end_on_min, end_on_max)
+    SELECT deployment_id, sum(sign), coalesce(sum(sign * runtime), '0'),
+        min(runtime) FILTER (WHERE sign > 0), max(runtime) FILTER (WHERE sign > 0),
+        min(scheduled_on) FILTER (WHERE sign > 0), max(scheduled_on) FILTER (WHERE sign > 0),
+        min(end_on) FILTER (WHERE sign > 0), max(end_on) FILTER (WHERE sign > 0)
+    FROM changed
+    GROUP BY deployment_id
+    ON CONFLICT (deployment_id) DO UPDATE
+    SET tasks_done = s.tasks_done + excluded.tasks_done,
+        runtime_sum = s.runtime_sum + excluded.runtime_sum,
+        runtime_min = least(s.runtime_min, excluded.runtime_min),
+        runtime_max = greatest(s.runtime_max, excluded.runtime_max),
+        scheduled_on_min = least(s.scheduled_on_min, excluded.scheduled_on_min),
+        scheduled_on_max = greatest(s.scheduled_on_max, excluded.scheduled_on_max),
+        end_on_min = least(s.end_on_min, excluded.end_on_min),
+        end_on_max = greatest(s.end_on_max, excluded.end_on_max)
+    $sql$, changed);
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_results()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+DECLARE
+    changed text;
+BEGIN
+    changed := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT file_id, confidence, 1 AS sign FROM new_rows'
+        ELSE 'SELECT file_id, confidence, -1 AS sign FROM old_rows'
+    END;
+    EXECUTE format($sql$
+    INSERT INTO prod.birdnet_queue_stats AS s (deployment_id, results, results_conf_09)
+    SELECT f.deployment_id, sum(c.sign), coalesce(sum(c.sign) FILTER (WHERE c.confidence > 0.9), 0)
+    FROM (%s) c
+    JOIN prod.files_audio f ON f.file_id = c.file_id
+    WHERE f.sample_rate = 48000 AND f.duration >= 3
+    GROUP BY f.deployment_id
+    ON CONFLICT (deployment_id) DO UPDATE
+    SET results = s.results + excluded.results,
+        results_conf_09 = s.results_conf_09 + excluded.results_conf_09
+    $sql$, changed);
+    RETURN NULL;
+END;
+$$;
+
+-- rebuild the queue statistics of the deployments from scratch, all if NULL
+CREATE OR REPLACE FUNCTION prod.birdnet_queue_stats_refresh(deployment_ids integer[] DEFAULT NULL)
+    RETURNS void
+    LANGUAGE sql
+    SECURITY DEFINER
+    SET search_path = prod, pg_temp
+    AS $$
+    -- block the statistics triggers until the rebuilt rows are committed
+    LOCK TABLE prod.birdnet_queue_stats, prod.birdnet_queue_durations IN SHARE ROW EXCLUSIVE MODE;
+    DELETE FROM prod.birdnet_queue_durations
+    WHERE deployment_ids IS NULL OR deployment_id = any(deployment_ids);
+    DELETE FROM prod.birdnet_queue_stats
+    WHERE deployment_ids IS NULL OR deployment_id = any(deployment_ids);
+    INSERT INTO prod.birdnet_queue_durations (deployment_id, duration, count)
+    SELECT deployment_id, duration, count(*)
+    FROM prod.files_audio
+    WHERE sample_rate = 48000 AND duration >= 3
+        AND (deployment_ids IS NULL OR deployment_id = any(deployment_ids))
+    GROUP BY 1, 2;
+    WITH eligible AS (
+        SELECT file_id, deployment_id, time FROM prod.files_audio
+        WHERE sample_rate = 48000 AND duration >= 3
+            AND (deployment_ids IS NULL OR deployment_id = any(deployment_ids))
+    ),
+    file_stats AS (
+        SELECT deployment_id, min(time) AS time_min, max(time) AS time_max
+        FROM eligible
+        GROUP BY deployment_id
+    ),
+    task_stats AS (
+        SELECT e.deployment_id, count(*) AS tasks_done, sum(t.end_on - t.pickup_on) AS runtime_sum,
+            min(t.end_on - t.pickup_on) AS runtime_min, max(t.end_on - t.pickup_on) AS runtime_max,
+            min(t.scheduled_on) AS scheduled_on_min, max(t.scheduled_on) AS scheduled_on_max,
+            min(t.end_on) AS end_on_min, max(t.end_on) AS end_on_max
+        FROM prod.birdnet_tasks t
+        JOIN eligible e ON e.file_id = t.file_id
+        WHERE t.state = 2
+        GROUP BY e.deployment_id
+    ),
+    result_stats AS (
+        SELECT e.deployment_id, count(*) AS results, count(*) FILTER (WHERE r.confidence > 0.9) AS results_conf_09
+        FROM prod.birdnet_results r
+        JOIN eligible e ON e.file_id = r.file_id
+        GROUP BY e.deployment_id
+    )
+    INSERT INTO prod.birdnet_queue_stats (deployment_id, time_min, time_max, tasks_done, runtime_sum,
+        runtime_min, runtime_max, scheduled_on_min, scheduled_on_max, end_on_min, end_on_max,
+        results, results_conf_09)
+    SELECT f.deployment_id, f.time_min, f.time_max, coalesce(t.tasks_done, 0), coalesce(t.runtime_sum, '0'),
+        t.runtime_min, t.runtime_max, t.scheduled_on_min, t.scheduled_on_max, t.end_on_min, t.end_on_max,
+        coalesce(r.results, 0), coalesce(r.results_conf_09, 0)
+    FROM file_stats f
+    LEFT JOIN task_stats t ON t.deployment_id = f.deployment_id
+    LEFT JOIN result_stats r ON r.deployment_id = f.deployment_id;
+$$;
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_files_insert
+    AFTER INSERT ON prod.files_audio
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_files();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_files_update
+    AFTER UPDATE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_files();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_files_delete
+    AFTER DELETE ON prod.files_audio
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_files();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_tasks_insert
+    AFTER INSERT ON prod.birdnet_tasks
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_tasks();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_tasks_update
+    AFTER UPDATE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_tasks();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_tasks_delete
+    AFTER DELETE ON prod.birdnet_tasks
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_tasks();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_results_insert
+    AFTER INSERT ON prod.birdnet_results
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_results();
+
+CREATE OR REPLACE TRIGGER birdnet_queue_stats_results_delete
+    AFTER DELETE ON prod.birdnet_results
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION prod.birdnet_queue_stats_results();
+
 CREATE SERVER IF NOT EXISTS auth;
 FOREIGN DATA WRAPPER postgres_fdw
 OPTIONS (host 'localhost', dbname 'mitwelten_auth', port '5432');
@@ -566,7 +1192,8 @@ GRANT ALL ON
   prod.tags,
   prod.mm_tags_entries,
   prod.mm_tags_deployments,
-  prod.files_entry
+  prod.files_entry,
+  prod.files_image_derived
 TO mitwelten_rest;
 
 GRANT SELECT ON
@@ -574,11 +1201,29 @@ GRANT SELECT ON
   prod.files_audio,
   prod.files_image,
   prod.birdnet_results,
+  prod.birdnet_species_rollup,
+  prod.birdnet_queue_progress,
+  prod.birdnet_queue_stats,
+  prod.birdnet_queue_durations,
   prod.birdnet_species_occurrence,
   prod.birdnet_tasks
 TO mitwelten_rest;
 
+-- task claims and completion of the BirdNET workers
+GRANT UPDATE ON prod.birdnet_tasks TO mitwelten_rest;
+GRANT INSERT ON prod.birdnet_results TO mitwelten_rest;
+GRANT ALL ON prod.birdnet_node_weights TO mitwelten_rest;
+GRANT ALL ON prod.birdnet_queue_jobs TO mitwelten_rest;
+GRANT DELETE ON prod.birdnet_results TO mitwelten_rest;
+GRANT UPDATE (max_running) ON prod.birdnet_configs TO mitwelten_rest;
+
+-- the statistics refresh runs as definer, it may only be called by the api
+REVOKE EXECUTE ON FUNCTION prod.birdnet_queue_stats_refresh(integer[]) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION prod.birdnet_queue_stats_refresh(integer[]) TO mitwelten_internal, mitwelten_rest;
+
 GRANT UPDATE ON
+  prod.birdnet_queue_jobs_job_id_seq,
+  prod.birdnet_results_result_id_seq,
   prod.entries_entry_id_seq,
   prod.files_entry_file_id_seq,
   prod.nodes_node_id_seq,
@@ -598,3 +1243,121 @@ GRANT UPDATE ON
 TO mitwelten_upload;
 
 GRANT SELECT ON ALL TABLES IN SCHEMA prod TO mitwelten_public;
+
+-- continuous aggregates of sensor data, these can not be created inside a transaction block
+-- the columns <name>_sum and <name>_count allow re-bucketing into wider averages
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_env_hourly
+    WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+    AS
+    SELECT deployment_id,
+        time_bucket(interval '1 hour', time) AS time,
+        sum(temperature) AS temperature_sum,
+        count(temperature) AS temperature_count,
+        min(temperature) AS temperature_min,
+        max(temperature) AS temperature_max,
+        sum(humidity) AS humidity_sum,
+        count(humidity) AS humidity_count,
+        min(humidity) AS humidity_min,
+        max(humidity) AS humidity_max,
+        sum(moisture) AS moisture_sum,
+        count(moisture) AS moisture_count,
+        min(moisture) AS moisture_min,
+        max(moisture) AS moisture_max,
+        sum(voltage) AS voltage_sum,
+        count(voltage) AS voltage_count,
+        min(voltage) AS voltage_min,
+        max(voltage) AS voltage_max
+    FROM prod.sensordata_env
+    GROUP BY deployment_id, time_bucket(interval '1 hour', time)
+    WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('prod.sensordata_env_hourly',
+    start_offset => interval '3 days',
+    end_offset => interval '1 hour',
+    schedule_interval => interval '1 hour',
+    if_not_exists => true);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_env_daily
+    WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+    AS
+    SELECT deployment_id,
+        time_bucket(interval '1 day', time) AS time,
+        sum(temperature) AS temperature_sum,
+        count(temperature) AS temperature_count,
+        min(temperature) AS temperature_min,
+        max(temperature) AS temperature_max,
+        sum(humidity) AS humidity_sum,
+        count(humidity) AS humidity_count,
+        min(humidity) AS humidity_min,
+        max(humidity) AS humidity_max,
+        sum(moisture) AS moisture_sum,
+        count(moisture) AS moisture_count,
+        min(moisture) AS moisture_min,
+        max(moisture) AS moisture_max,
+        sum(voltage) AS voltage_sum,
+        count(voltage) AS voltage_count,
+        min(voltage) AS voltage_min,
+        max(voltage) AS voltage_max
+    FROM prod.sensordata_env
+    GROUP BY deployment_id, time_bucket(interval '1 day', time)
+    WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('prod.sensordata_env_daily',
+    start_offset => interval '7 days',
+    end_offset => interval '1 day',
+    schedule_interval => interval '1 day',
+    if_not_exists => true);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_pax_hourly
+    WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+    AS
+    SELECT deployment_id,
+        time_bucket(interval '1 hour', time) AS time,
+        sum(pax) AS pax_sum,
+        count(pax) AS pax_count,
+        min(pax) AS pax_min,
+        max(pax) AS pax_max,
+        sum(voltage) AS voltage_sum,
+        count(voltage) AS voltage_count,
+        min(voltage) AS voltage_min,
+        max(voltage) AS voltage_max
+    FROM prod.sensordata_pax
+    GROUP BY deployment_id, time_bucket(interval '1 hour', time)
+    WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('prod.sensordata_pax_hourly',
+    start_offset => interval '3 days',
+    end_offset => interval '1 hour',
+    schedule_interval => interval '1 hour',
+    if_not_exists => true);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS prod.sensordata_pax_daily
+    WITH (timescaledb.continuous, timescaledb.materialized_only = false)
+    AS
+    SELECT deployment_id,
+        time_bucket(interval '1 day', time) AS time,
+        sum(pax) AS pax_sum,
+        count(pax) AS pax_count,
+        min(pax) AS pax_min,
+        max(pax) AS pax_max,
+        sum(voltage) AS voltage_sum,
+        count(voltage) AS voltage_count,
+        min(voltage) AS voltage_min,
+        max(voltage) AS voltage_max
+    FROM prod.sensordata_pax
+    GROUP BY deployment_id, time_bucket(interval '1 day', time)
+    WITH NO DATA;
+
+SELECT add_continuous_aggregate_policy('prod.sensordata_pax_daily',
+    start_offset => interval '7 days',
+    end_offset => interval '1 day',
+    schedule_interval => interval '1 day',
+    if_not_exists => true);
+
+GRANT SELECT ON
+  prod.sensordata_env_hourly,
+  prod.sensordata_env_daily,
+  prod.sensordata_pax_hourly,
+  prod.sensordata_pax_daily
+TO mitwelten_rest, mitwelten_public;
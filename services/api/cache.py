@@ -0,0 +1,140 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from api.config import metadata_cache_ttl
+from api.database import database
+from api.metrics import named_query
+from api.tables import deployments, nodes
+
+from asyncpg.types import Range
+from sqlalchemy.sql import select
+
+# ------------------------------------------------------------------------------
+# METADATA CACHE
+# ------------------------------------------------------------------------------
+
+def bound(ts: Optional[datetime]) -> Optional[datetime]:
+    '''
+    Normalize a range bound to an aware timestamp, `None` for infinity
+    '''
+    if ts == None or ts.replace(tzinfo=None) in (datetime.min, datetime.max):
+        return None
+    return ts if ts.tzinfo != None else ts.replace(tzinfo=timezone.utc)
+
+def period_contains(period: Range, ts: datetime) -> bool:
+    '''
+    Equivalent of `period @> ts`
+    '''
+    if period.isempty:
+        return False
+    lower, upper = bound(period.lower), bound(period.upper)
+    ts = bound(ts)
+    if lower != None and (ts < lower or (ts == lower and not period.lower_inc)):
+        return False
+    if upper != None and (ts > upper or (ts == upper and not period.upper_inc)):
+        return False
+    return True
+
+def period_overlaps(period: Range, time_from: Optional[datetime], time_to: Optional[datetime]) -> bool:
+    '''
+    Equivalent of `period && tstzrange(time_from, time_to)`, unbounded if `None`
+    '''
+    if period.isempty:
+        return False
+    lower, upper = bound(period.lower), bound(period.upper)
+    time_from, time_to = bound(time_from), bound(time_to)
+    if time_to != None and lower != None and lower >= time_to:
+        return False
+    if time_from != None and upper != None and (upper < time_from or (upper == time_from and not period.upper_inc)):
+        return False
+    return True
+
+class MetadataCache:
+    '''
+    In-process cache of the small and rarely changing tables `nodes` and
+    `deployments`. The tables are reloaded as a whole after `ttl` seconds or
+    after `invalidate()` has been called by a write path. `invalidate()` only
+    affects the worker process handling the write, the other workers serve
+    their copy until it expires, so changes show up there within `ttl`.
+    '''
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = asyncio.Lock()
+        self.loaded_at = None
+        self.generation = 0
+        self.nodes_by_label = {}
+        self.nodes_by_id = {}
+        self.deployments_by_id = {}
+        self.deployments_by_node = {}
+
+    def invalidate(self):
+        self.loaded_at = None
+        self.generation += 1
+
+    def stale(self) -> bool:
+        return self.loaded_at == None or time.monotonic() - self.loaded_at > self.ttl
+
+    async def load(self):
+        if not self.stale():
+            return
+        async with self.lock:
+            if not self.stale():
+                return
+            loaded_at = time.monotonic()
+            generation = self.generation
+            with named_query('metadata_cache'):
+                node_records = await database.fetch_all(select(nodes))
+                deployment_records = await database.fetch_all(select(deployments))
+            # processed values (i.e. location as dict) are read by key
+            node_list = [{c: r[c] for c in nodes.columns.keys()} for r in node_records]
+            deployment_list = [{c: r[c] for c in deployments.columns.keys()} for r in deployment_records]
+            self.nodes_by_label = {n['node_label']: n for n in node_list}
+            self.nodes_by_id = {n['node_id']: n for n in node_list}
+            self.deployments_by_id = {d['deployment_id']: d for d in deployment_list}
+            self.deployments_by_node = {}
+            for d in deployment_list:
+                self.deployments_by_node.setdefault(d['node_id'], []).append(d)
+            # keep it stale if invalidated while loading
+            if generation == self.generation:
+                self.loaded_at = loaded_at
+
+    async def node(self, node_label: str) -> Optional[dict]:
+        await self.load()
+        return self.nodes_by_label.get(node_label)
+
+    async def node_by_id(self, node_id: int) -> Optional[dict]:
+        await self.load()
+        return self.nodes_by_id.get(node_id)
+
+    async def deployment(self, deployment_id: int) -> Optional[dict]:
+        await self.load()
+        return self.deployments_by_id.get(deployment_id)
+
+    async def node_deployments(self, node_id: int) -> List[dict]:
+        await self.load()
+        return self.deployments_by_node.get(node_id, [])
+
+    async def deployment_at(self, node_label: str, ts: datetime) -> Optional[dict]:
+        '''
+        Deployment of the node covering the timestamp `ts`
+        '''
+        node = await self.node(node_label)
+        if node == None:
+            return None
+        for d in self.deployments_by_node.get(node['node_id'], []):
+            if period_contains(d['period'], ts):
+                return d
+        return None
+
+    async def deployed(self, time_from: Optional[datetime] = None, time_to: Optional[datetime] = None) -> List[tuple]:
+        '''
+        Deployments overlapping the time range, paired with their node
+        '''
+        await self.load()
+        return [(d, self.nodes_by_id.get(d['node_id'])) for d in self.deployments_by_id.values()
+            if period_overlaps(d['period'], time_from, time_to)]
+
+metadata_cache = MetadataCache(metadata_cache_ttl)
@@ -1,6 +1,60 @@
+import os
 import sys
+import tempfile
 sys.path.append('../')
 
 import credentials as crd
 
 s3_file_url_regex = r'^https:\/\/minio\.campusderkuenste\.ch\/ixdm-mitwelten\/viz_app\/.+$'
+
+# seconds until the node / deployment metadata cache is reloaded, this bounds
+# how long other worker processes serve metadata changed by a write
+metadata_cache_ttl = 300
+
+# MinIO proxy, see MinioConfig in credentials_example.py
+minio_chunk_size = getattr(crd.minio, 'chunk_size', 256 * 1024)
+minio_parallel_threshold = getattr(crd.minio, 'parallel_threshold', 32 * 1024 * 1024)
+minio_part_size = getattr(crd.minio, 'part_size', 8 * 1024 * 1024)
+minio_parallel_parts = getattr(crd.minio, 'parallel_parts', 4)
+minio_presign_expiry = getattr(crd.minio, 'presign_expiry', 300)
+
+# local disk cache of S3 objects
+files_cache_dir = getattr(crd.minio, 'cache_dir', os.path.join(tempfile.gettempdir(), 'mitwelten-files'))
+files_cache_size = getattr(crd.minio, 'cache_size', 2 * 1024 ** 3)
+files_cache_max_object_size = getattr(crd.minio, 'cache_max_object_size', 256 * 1024 ** 2)
+files_cache_revalidate = getattr(crd.minio, 'cache_revalidate', 300)
+
+# image previews: edge lengths in pixels, JPEG quality and resizing processes
+preview_sizes = (160, 320, 640, 1280)
+preview_quality = 80
+preview_workers = 2
+
+# seconds between refreshes of the realm signing keys, number of verified tokens to remember
+oidc_keys_refresh_interval = 900
+oidc_token_cache_size = 1024
+
+# S3 storage client timeouts in seconds
+storage_connect_timeout = getattr(crd.minio, 'connect_timeout', 5)
+storage_read_timeout = getattr(crd.minio, 'read_timeout', 60)
+
+# queries slower than profile_threshold milliseconds are logged (None: off),
+# the given fraction of them with their query plan, see DbConfig in credentials_example.py
+profile_threshold = getattr(crd.db, 'profile_threshold', None)
+profile_explain_rate = getattr(crd.db, 'profile_explain_rate', 0)
+
+# queue progress stream: minimum seconds between updates, seconds between keep-alive comments
+queue_progress_interval = 1
+queue_progress_keepalive = 15
+
+# BirdNET task claims: default lease in seconds, seconds between returning expired leases to pending
+queue_lease_duration = 900
+queue_lease_reap_interval = 60
+
+# queue jobs: tasks per chunk, seconds of pause between chunks, seconds without
+# progress until a running job is considered dead and may be resumed
+queue_job_chunk_size = 500
+queue_job_pause = 0.1
+queue_job_stale_after = 300
+
+# seconds each dependency check of the readiness endpoint may take
+readiness_timeout = 3
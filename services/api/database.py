@@ -1,6 +1,105 @@
+import time
+
 import databases
 
 from api.config import crd
+from api.metrics import (
+    db_pool_acquire_seconds, db_pool_idle, db_pool_in_use, db_pool_max_size,
+    db_pool_size, db_pool_waiting, observe_query
+)
+from api.profiler import profiler
+
+class InstrumentedPool:
+    '''
+    Proxy of the asyncpg pool, recording connections in use, waiting tasks
+    and acquire latency
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        db_pool_size.set_function(pool.get_size)
+        db_pool_max_size.set_function(pool.get_max_size)
+        db_pool_idle.set_function(pool.get_idle_size)
+
+    async def acquire(self):
+        db_pool_waiting.inc()
+        start = time.perf_counter()
+        try:
+            connection = await self.pool.acquire()
+        finally:
+            db_pool_waiting.dec()
+            db_pool_acquire_seconds.observe(time.perf_counter() - start)
+        db_pool_in_use.inc()
+        return connection
+
+    async def release(self, connection):
+        try:
+            return await self.pool.release(connection)
+        finally:
+            db_pool_in_use.dec()
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+class InstrumentedDatabase(databases.Database):
+    '''
+    Database recording execution time and returned rows of each query,
+    labelled by the name set with `api.metrics.named_query()` or by the
+    method and route of the request. Slow queries are passed on to the
+    profiler.
+    '''
+
+    async def connect(self) -> None:
+        await super().connect()
+        self._backend._pool = InstrumentedPool(self._backend._pool)
+
+    def observe(self, start: float, rows: int, query, values):
+        elapsed = observe_query(start, rows)
+        profiler.record(self, elapsed, rows, query, values)
+
+    async def fetch_all(self, query, values=None):
+        start = time.perf_counter()
+        records = await super().fetch_all(query, values)
+        self.observe(start, len(records), query, values)
+        return records
+
+    async def fetch_one(self, query, values=None):
+        start = time.perf_counter()
+        record = await super().fetch_one(query, values)
+        self.observe(start, 0 if record == None else 1, query, values)
+        return record
+
+    async def fetch_val(self, query, values=None, column=0):
+        start = time.perf_counter()
+        value = await super().fetch_val(query, values, column)
+        self.observe(start, 1, query, values)
+        return value
+
+    async def execute(self, query, values=None):
+        start = time.perf_counter()
+        result = await super().execute(query, values)
+        self.observe(start, 0, query, values)
+        return result
+
+    async def execute_many(self, query, values):
+        start = time.perf_counter()
+        result = await super().execute_many(query, values)
+        self.observe(start, 0, query, values)
+        return result
+
+    async def iterate(self, query, values=None):
+        start = time.perf_counter()
+        rows = 0
+        async for record in super().iterate(query, values):
+            rows += 1
+            yield record
+        self.observe(start, rows, query, values)
 
 DATABASE_URL = f'postgresql://{crd.db.user}:{crd.db.password}@{crd.db.host}:{crd.db.port}/{crd.db.database}'
-database = databases.Database(DATABASE_URL, min_size=5, max_size=10)
+database = InstrumentedDatabase(
+    DATABASE_URL,
+    min_size=getattr(crd.db, 'pool_min_size', 5),
+    max_size=getattr(crd.db, 'pool_max_size', 10),
+    statement_cache_size=getattr(crd.db, 'statement_cache_size', 100),
+    server_settings={'statement_timeout': str(getattr(crd.db, 'statement_timeout', 0))},
+)
@@ -1,30 +1,139 @@
+import asyncio
+import base64
+import binascii
+import hashlib
 import secrets
+import time
+from collections import OrderedDict
 from datetime import timedelta
 from itertools import filterfalse
 from typing import Optional
 
-from api.config import crd
+from api.config import crd, oidc_keys_refresh_interval, oidc_token_cache_size
 
 from asyncpg.pgproto.types import Point as PgPoint
 from asyncpg.types import Range
 from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2AuthorizationCodeBearer
+from jose import JWTError, jwt
 from keycloak import KeycloakOpenID
 from sqlalchemy import func
 from sqlalchemy.types import UserDefinedType
+from starlette.concurrency import run_in_threadpool
 
 keycloak_openid = KeycloakOpenID(
     server_url=crd.oidc.KC_SERVER_URL,
     client_id=crd.oidc.KC_CLIENT_ID,
     realm_name=crd.oidc.KC_REALM_NAME,
     client_secret_key=crd.oidc.KC_CLIENT_SECRET,
+    timeout=10,
 )
 
-crd.oidc.KC_PUBLIC_KEY = (
-    '-----BEGIN PUBLIC KEY-----\n'
-    + keycloak_openid.public_key()
-    + '\n-----END PUBLIC KEY-----'
-)
+class KeyCache:
+    '''
+    Realm signing keys (JWKS) by key id. Refreshed periodically in the
+    background and on demand when a token is signed with an unknown key,
+    which happens after key rotation.
+    '''
+
+    def __init__(self, refresh_interval: float, min_refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.refreshed_at = None
+        self.attempted_at = None # successful or not
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    async def refresh(self, force: bool = False):
+        async with self.lock:
+            # rate limit forced refreshes, i.e. for tokens with made up key ids,
+            # also while the realm is unreachable
+            now = time.monotonic()
+            if self.attempted_at != None and now - self.attempted_at < self.min_refresh_interval:
+                return
+            if not force and self.refreshed_at != None and now - self.refreshed_at < self.refresh_interval:
+                return
+            self.attempted_at = now
+            certs = await run_in_threadpool(keycloak_openid.certs)
+            self.keys = {k['kid']: k for k in certs['keys'] if k.get('use', 'sig') == 'sig'}
+            self.refreshed_at = time.monotonic()
+
+    async def get(self, kid: str) -> Optional[dict]:
+        if kid not in self.keys:
+            await self.refresh(force=True)
+        return self.keys.get(kid)
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f'Failed to refresh realm keys: {e}')
+                await asyncio.sleep(self.min_refresh_interval)
+            else:
+                await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self.task == None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+class TokenCache:
+    '''
+    Bounded LRU of verified token claims by token hash, valid until `exp`
+    '''
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.tokens = OrderedDict()
+
+    def key(self, token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self.key(token)
+        auth = self.tokens.get(key)
+        if auth == None:
+            return None
+        if auth['exp'] <= time.time():
+            del self.tokens[key]
+            return None
+        self.tokens.move_to_end(key)
+        return auth
+
+    def add(self, token: str, auth: dict):
+        self.tokens[self.key(token)] = auth
+        if len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+
+realm_keys = KeyCache(refresh_interval=oidc_keys_refresh_interval, min_refresh_interval=30)
+verified_tokens = TokenCache(max_size=oidc_token_cache_size)
+
+async def verify_token(token: str) -> dict:
+    '''
+    Verify signature and expiry of a token, once per token
+    '''
+    auth = verified_tokens.get(token)
+    if auth != None:
+        return auth
+    key = await realm_keys.get(jwt.get_unverified_header(token)['kid'])
+    if key == None:
+        raise JWTError('Unknown signing key')
+    auth = keycloak_openid.decode_token(
+        token,
+        key=key,
+        algorithms=['RS256'],
+        options={'verify_signature': True, 'verify_aud': False, 'verify_exp': True},
+    )
+    if 'exp' not in auth:
+        raise JWTError('Token without expiry')
+    verified_tokens.add(token, auth)
+    return auth
 
 oauth2_scheme = OAuth2AuthorizationCodeBearer(
     authorizationUrl=f'{crd.oidc.KC_SERVER_URL}realms/{crd.oidc.KC_REALM_NAME}/protocol/openid-connect/auth',
@@ -33,11 +142,7 @@ oauth2_scheme = OAuth2AuthorizationCodeBearer(
 
 async def check_oid_authentication(token: str = Depends(oauth2_scheme)):
     try:
-        auth = keycloak_openid.decode_token(
-            token,
-            key=crd.oidc.KC_PUBLIC_KEY,
-            options={'verify_signature': True, 'verify_aud': False, 'exp': True},
-        )
+        auth = await verify_token(token)
         if 'internal' not in auth['realm_access']['roles']:
             raise
     except:
@@ -80,6 +185,19 @@ def unique_everseen(iterable, key=None):
                 seen_add(k)
                 yield element
 
+def encode_cursor(key: int) -> str:
+    '''Encode a keyset pagination key as opaque token'''
+    return base64.urlsafe_b64encode(str(key).encode()).decode().rstrip('=')
+
+def decode_cursor(token: str) -> int:
+    '''Decode a token created by `encode_cursor`, an empty token starts at the beginning'''
+    if token == '':
+        return 0
+    try:
+        return int(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
 def from_inclusive_range(period: Range) -> Range:
     return Range(period.lower, None if period.upper == None else period.upper - timedelta(days=1))
 
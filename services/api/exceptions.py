@@ -4,3 +4,6 @@ class RecordsDependencyException(BaseException):
 
 class NodeNotDeployedException(BaseException):
     ...
+
+class JobCancelledException(BaseException):
+    ...
@@ -0,0 +1,185 @@
+import fcntl
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from api.config import (
+    files_cache_dir, files_cache_max_object_size, files_cache_revalidate,
+    files_cache_size
+)
+
+from starlette.concurrency import run_in_threadpool
+
+# ------------------------------------------------------------------------------
+# LOCAL DISK CACHE FOR S3 OBJECTS
+# ------------------------------------------------------------------------------
+
+LOCK_FILE = '.lock'
+
+# seconds after which a partially written file is considered abandoned
+PART_MAX_AGE = 3600
+
+class FileCache:
+    '''
+    Size bounded, least recently used on-disk cache of S3 objects, keyed by
+    object name and ETag. The directory is shared by all worker processes: its
+    content is the state of the cache, hits update the modification time of
+    a file and eviction scans the directory under a file lock. Object metadata
+    (stat) is kept in memory per process and revalidated against S3 after
+    `revalidate` seconds.
+    '''
+
+    def __init__(self, directory: str, max_size: int, max_object_size: int, revalidate: float):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        self.revalidate = revalidate
+        self.stats = OrderedDict()   # object_name -> (stat, time of validation)
+        self.filling = set()         # keys being written by this process
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, object_name: str, etag: str) -> str:
+        return hashlib.sha256(f'{object_name}\0{etag}'.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def cached_stat(self, object_name: str):
+        '''
+        Stat of the object if validated less than `revalidate` seconds ago
+        '''
+        if object_name in self.stats:
+            stat, validated_at = self.stats[object_name]
+            if time.monotonic() - validated_at < self.revalidate:
+                return stat
+        return None
+
+    def store_stat(self, object_name: str, stat):
+        self.stats.pop(object_name, None)
+        self.stats[object_name] = (stat, time.monotonic())
+        if len(self.stats) > 65536:
+            self.stats.popitem(last=False)
+
+    def touch(self, path: str) -> bool:
+        '''
+        Mark the file as recently used, `False` if it does not exist
+        '''
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    async def lookup(self, object_name: str, etag: str) -> Optional[str]:
+        '''
+        Path of the cached object, counting the hit or miss
+        '''
+        path = self.path(self.key(object_name, etag))
+        if await run_in_threadpool(self.touch, path):
+            self.hits += 1
+            return path
+        self.misses += 1
+        return None
+
+    def cacheable(self, object_name: str, etag: str, size: int) -> bool:
+        return size <= self.max_object_size and self.key(object_name, etag) not in self.filling
+
+    def store(self, part: str, key: str):
+        os.replace(part, self.path(key))
+        self.evict()
+
+    def discard(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def fill(self, object_name: str, etag: str, content):
+        '''
+        Pass through the chunks of the full object while writing them to the
+        cache, the file is added once the object has been read completely
+        '''
+        key = self.key(object_name, etag)
+        if key in self.filling:
+            async for chunk in content:
+                yield chunk
+            return
+        self.filling.add(key)
+        part = self.path(key) + f'.{os.getpid()}.part'
+        f = await run_in_threadpool(open, part, 'wb')
+        complete = False
+        try:
+            async for chunk in content:
+                await run_in_threadpool(f.write, chunk)
+                yield chunk
+            complete = True
+        finally:
+            await run_in_threadpool(f.close)
+            self.filling.discard(key)
+            if complete:
+                await run_in_threadpool(self.store, part, key)
+            else:
+                await run_in_threadpool(self.discard, part)
+
+    async def prefetch(self, object_name: str, etag: str, content):
+        '''
+        Read the full object into the cache, i.e. after serving a range of it
+        '''
+        key = self.key(object_name, etag)
+        if key in self.filling or await run_in_threadpool(os.path.isfile, self.path(key)):
+            return
+        async for _ in self.fill(object_name, etag, content):
+            pass
+
+    def scan(self) -> list:
+        '''
+        Cached files as (modification time, path, size), removing partially
+        written files abandoned by dead processes
+        '''
+        files = []
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name == LOCK_FILE or not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.part'):
+                    if now - st.st_mtime > PART_MAX_AGE:
+                        self.discard(entry.path)
+                    continue
+                files.append((st.st_mtime, entry.path, st.st_size))
+        return files
+
+    def evict(self):
+        '''
+        Remove the least recently used files until the directory fits into
+        `max_size`, serialized between the processes sharing the directory
+        '''
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            files = self.scan()
+            size = sum(f[2] for f in files)
+            for _, path, file_size in sorted(files):
+                if size <= self.max_size:
+                    break
+                self.discard(path)
+                size -= file_size
+
+    def summary(self) -> dict:
+        files = self.scan()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(files),
+            'size': sum(f[2] for f in files),
+            'max_size': self.max_size,
+        }
+
+files_cache = FileCache(files_cache_dir, files_cache_size, files_cache_max_object_size, files_cache_revalidate)
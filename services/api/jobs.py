@@ -0,0 +1,196 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+from api.config import crd, queue_job_chunk_size, queue_job_pause, queue_job_stale_after
+from api.database import database
+from api.exceptions import JobCancelledException
+from api.metrics import named_query
+from api.tables import birdnet_input, queue_jobs, tasks
+
+from asyncpg.exceptions import DeadlockDetectedError
+from sqlalchemy import Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import and_, any_, bindparam, func, insert, or_, select, text, update
+
+# ------------------------------------------------------------------------------
+# QUEUE JOBS
+# ------------------------------------------------------------------------------
+
+# attempts of a chunk ending in a deadlock until the job fails
+DEADLOCK_RETRIES = 3
+
+# task states to reset per action, None for any state
+reset_states = {
+    'reset_failed': 3,
+    'reset_all': None,
+}
+
+def job_record(record) -> dict:
+    job = {c: record[c] for c in queue_jobs.columns.keys()}
+    if isinstance(job['selection'], str):
+        job['selection'] = json.loads(job['selection'])
+    return job
+
+def job_criteria(action: str, selection: dict) -> list:
+    '''
+    Tasks selected by the job: nodes (all if empty), recording time range and config
+    '''
+    criteria = []
+    if len(selection['node_labels']):
+        criteria.append(birdnet_input.c.node_label.in_(selection['node_labels']))
+    if selection['time_from'] != None:
+        criteria.append(birdnet_input.c.time >= datetime.fromisoformat(selection['time_from']))
+    if selection['time_to'] != None:
+        criteria.append(birdnet_input.c.time < datetime.fromisoformat(selection['time_to']))
+    if selection['config_id'] != None:
+        criteria.append(tasks.c.config_id == selection['config_id'])
+    if reset_states[action] != None:
+        criteria.append(tasks.c.state == reset_states[action])
+    return criteria
+
+class QueueJobRunner:
+    '''
+    Reset tasks in the background, in transactions of `chunk_size` tasks in
+    ascending order: delete the results of the tasks (by `task_id`, using
+    `birdnet_results_tasks_fk_index`) and return the tasks to pending. The
+    position and progress are stored with the job after each chunk, so a
+    cancelled, interrupted or failed job can be resumed where it stopped.
+    Cancelling rolls back the chunk in progress, in any worker process.
+
+    Tasks locked by others (i.e. being completed) are waited for rather than
+    skipped, the keyset would pass them for good. Chunks deadlocking with
+    such a transaction are retried.
+    '''
+
+    def __init__(self, chunk_size: int, pause: float, stale_after: float):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.stale_after = stale_after
+        self.tasks = {}
+
+    async def get(self, job_id: int) -> Optional[dict]:
+        record = await database.fetch_one(select(queue_jobs).where(queue_jobs.c.job_id == job_id))
+        return job_record(record) if record != None else None
+
+    async def list(self, limit: int) -> list:
+        records = await database.fetch_all(select(queue_jobs).order_by(queue_jobs.c.job_id.desc()).limit(limit))
+        return [job_record(r) for r in records]
+
+    async def create(self, action: str, selection: dict) -> dict:
+        query = insert(queue_jobs).values(action=action, selection=selection).returning(queue_jobs.c.job_id)
+        job_id = await database.execute(query)
+        return await self.resume(job_id)
+
+    async def resume(self, job_id: int) -> Optional[dict]:
+        '''
+        Start the job unless it is done or running, returns `None` otherwise
+        '''
+        stale = func.now() - timedelta(seconds=self.stale_after)
+        query = update(queue_jobs).\
+            where(queue_jobs.c.job_id == job_id, or_(
+                queue_jobs.c.state.in_(['pending', 'cancelled', 'interrupted', 'failed']),
+                and_(queue_jobs.c.state == 'running', queue_jobs.c.updated_at < stale))).\
+            values(state='running', error=None, finished_at=None, updated_at=func.now()).\
+            returning(*queue_jobs.c)
+        record = await database.fetch_one(query)
+        if record == None:
+            return None
+        job = job_record(record)
+        task = asyncio.create_task(self.run(job))
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+        return job
+
+    async def cancel(self, job_id: int) -> Optional[dict]:
+        query = update(queue_jobs).\
+            where(queue_jobs.c.job_id == job_id, queue_jobs.c.state.in_(['pending', 'running'])).\
+            values(state='cancelled', updated_at=func.now()).\
+            returning(*queue_jobs.c)
+        record = await database.fetch_one(query)
+        return job_record(record) if record != None else None
+
+    async def finish(self, job_id: int, state: str, error: Optional[str] = None):
+        await database.execute(update(queue_jobs).\
+            where(queue_jobs.c.job_id == job_id, queue_jobs.c.state == 'running').\
+            values(state=state, error=error, finished_at=func.now(), updated_at=func.now()))
+
+    async def reset_chunk(self, job_id: int, selected, delete_results_query, last: int) -> list:
+        '''
+        Reset the next chunk of tasks after `last`, returns their ids
+        '''
+        async with database.transaction():
+            chunk = await database.fetch_all(selected.\
+                where(tasks.c.task_id > last).\
+                order_by(tasks.c.task_id).\
+                limit(self.chunk_size).\
+                with_for_update(of=tasks))
+            task_ids = [r['task_id'] for r in chunk]
+            if len(task_ids) == 0:
+                return task_ids
+            chunk_ids = bindparam('task_ids', task_ids, type_=ARRAY(Integer))
+            deleted = await database.fetch_val(delete_results_query.bindparams(chunk_ids))
+            await database.execute(update(tasks).\
+                where(tasks.c.task_id == any_(chunk_ids)).\
+                values(state=0, pickup_on=None, end_on=None, lease_until=None))
+            # record the progress, unless cancelled meanwhile
+            progress = await database.fetch_one(update(queue_jobs).\
+                where(queue_jobs.c.job_id == job_id, queue_jobs.c.state == 'running').\
+                values(last_task_id=task_ids[-1], processed=queue_jobs.c.processed + len(task_ids),
+                    results_deleted=queue_jobs.c.results_deleted + deleted, updated_at=func.now()).\
+                returning(queue_jobs.c.job_id))
+            if progress == None:
+                raise JobCancelledException()
+        return task_ids
+
+    async def run(self, job: dict):
+        job_id = job['job_id']
+        criteria = job_criteria(job['action'], job['selection'])
+        selected = select(tasks.c.task_id).select_from(tasks.join(birdnet_input)).where(*criteria)
+        delete_results_query = text(f'''
+        with deleted as (
+            delete from {crd.db.schema}.birdnet_results where task_id = any(:task_ids) returning 1
+        )
+        select count(*) from deleted
+        ''')
+        try:
+            with named_query(f'queue_job.{job["action"]}'):
+                if job['total'] == None:
+                    total = await database.fetch_val(select(func.count()).select_from(selected.subquery()))
+                    await database.execute(update(queue_jobs).where(queue_jobs.c.job_id == job_id).values(total=total))
+                last = job['last_task_id']
+                deadlocks = 0
+                while True:
+                    try:
+                        task_ids = await self.reset_chunk(job_id, selected, delete_results_query, last)
+                    except DeadlockDetectedError:
+                        deadlocks += 1
+                        if deadlocks >= DEADLOCK_RETRIES:
+                            raise
+                        await asyncio.sleep(self.pause)
+                        continue
+                    if len(task_ids) == 0:
+                        break
+                    deadlocks = 0
+                    last = task_ids[-1]
+                    await asyncio.sleep(self.pause)
+            await self.finish(job_id, 'done')
+        except JobCancelledException:
+            print(f'queue job {job_id} cancelled')
+        except asyncio.CancelledError:
+            await self.finish(job_id, 'interrupted')
+            raise
+        except Exception as e:
+            print(f'queue job {job_id} failed: {e}')
+            await self.finish(job_id, 'failed', str(e) or type(e).__name__)
+
+    async def stop(self):
+        '''
+        Interrupt the jobs running in this process, they can be resumed later
+        '''
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+queue_jobs_runner = QueueJobRunner(queue_job_chunk_size, queue_job_pause, queue_job_stale_after)
@@ -0,0 +1,52 @@
+import asyncio
+
+from api.config import crd, queue_lease_reap_interval
+from api.database import database
+from api.metrics import named_query
+
+from sqlalchemy.sql import text
+
+# ------------------------------------------------------------------------------
+# BIRDNET TASK LEASES
+# ------------------------------------------------------------------------------
+
+class LeaseReaper:
+    '''
+    Return running tasks with an expired lease to pending, every `interval`
+    seconds. Tasks picked up without lease (outside the api) are left alone.
+    '''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.task = None
+
+    async def reap(self) -> int:
+        query = text(f'''
+        update {crd.db.schema}.birdnet_tasks set state = 0, pickup_on = null, lease_until = null
+        where state = 1 and lease_until < now()
+        returning task_id
+        ''')
+        with named_query('lease_reaper'):
+            expired = await database.fetch_all(query)
+        if len(expired):
+            print(f'returned {len(expired)} tasks with expired lease to pending')
+        return len(expired)
+
+    async def run(self):
+        while True:
+            try:
+                await self.reap()
+            except Exception as e:
+                print(f'reaping expired leases failed: {e}')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task == None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+lease_reaper = LeaseReaper(queue_lease_reap_interval)
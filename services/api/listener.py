@@ -0,0 +1,72 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from api.database import DATABASE_URL
+
+import asyncpg
+
+# ------------------------------------------------------------------------------
+# POSTGRES NOTIFICATIONS
+# ------------------------------------------------------------------------------
+
+class NotificationListener:
+    '''
+    Dedicated connection LISTENing on `channel`, setting the event of each
+    subscriber on notification. Connected while there are subscribers,
+    reconnecting after connection loss.
+    '''
+
+    def __init__(self, channel: str, check_interval: float = 15):
+        self.channel = channel
+        self.check_interval = check_interval
+        self.subscribers = set()
+        self.task = None
+
+    def notify(self, *args):
+        for event in self.subscribers:
+            event.set()
+
+    @asynccontextmanager
+    async def subscribe(self):
+        '''
+        Event set on each notification, initially set
+        '''
+        event = asyncio.Event()
+        event.set()
+        self.subscribers.add(event)
+        if self.task == None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        try:
+            yield event
+        finally:
+            self.subscribers.discard(event)
+
+    async def run(self):
+        while len(self.subscribers):
+            try:
+                connection = await asyncpg.connect(DATABASE_URL)
+                try:
+                    await connection.add_listener(self.channel, self.notify)
+                    # notifications might have been missed while reconnecting
+                    self.notify()
+                    while len(self.subscribers):
+                        await asyncio.sleep(self.check_interval)
+                        await connection.fetchval('select 1')
+                finally:
+                    await connection.close(timeout=5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'listener on {self.channel} failed: {e}')
+                await asyncio.sleep(self.check_interval)
+
+    async def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.task = None
+
+queue_progress_listener = NotificationListener('birdnet_queue_progress')
@@ -1,13 +1,24 @@
+import asyncio
+
+from api import previews
+from api.config import readiness_timeout
 from api.database import database
-from api.dependencies import check_oid_authentication, crd
+from api.dependencies import check_authentication, check_oid_authentication, crd, realm_keys
+from api.jobs import queue_jobs_runner
+from api.leases import lease_reaper
+from api.listener import queue_progress_listener
+from api.metrics import MetricsMiddleware
+from api.profiler import RequestIdMiddleware
 from api.routers import (
     birdnet, data, deployments, geo, entries, ingest, minio, nodes, queue, tags,
     taxonomy, validators
 )
+from api.storage import check_storage, probe_storage
 
 from fastapi import Depends, FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 tags_metadata = [
     {
@@ -54,6 +65,10 @@ tags_metadata = [
         'name': 'files',
         'description': 'File up- and download (images, audio, etc.)',
     },
+    {
+        'name': 'health',
+        'description': 'Service status',
+    },
 ]
 
 app = FastAPI(
@@ -86,6 +101,9 @@ if crd.DEV == True:
         allow_headers=['*'],
 )
 
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestIdMiddleware)
+
 app.include_router(birdnet.router)
 app.include_router(data.router)
 app.include_router(deployments.router)
@@ -109,15 +127,60 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 @app.on_event('startup')
 async def startup():
     await database.connect()
+    realm_keys.start()
+    lease_reaper.start()
+    asyncio.create_task(probe_storage())
 
 @app.on_event('shutdown')
 async def shutdown():
+    await queue_progress_listener.stop()
+    await queue_jobs_runner.stop()
     await database.disconnect()
+    previews.shutdown()
+    realm_keys.stop()
+    lease_reaper.stop()
 
 @app.get('/login', tags=['authentication'])
 async def login(auth: dict = Depends(check_oid_authentication)):
     return auth
 
+@app.get('/metrics', include_in_schema=False, dependencies=[Depends(check_authentication)])
+async def metrics():
+    '''
+    Prometheus metrics of this worker process, requires basic authentication
+    '''
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get('/ready', tags=['health'])
+async def ready():
+    '''
+    ## Readiness of the API and its dependencies
+
+    Checks the database, the S3 storage bucket and the identity provider
+    (realm signing keys), each with a timeout. Responds with `503` if any
+    of them is unavailable.
+    '''
+    async def check_database():
+        try:
+            await asyncio.wait_for(database.fetch_val('select 1'), readiness_timeout)
+        except Exception as e:
+            return str(e) or type(e).__name__
+
+    async def check_keycloak():
+        try:
+            await asyncio.wait_for(realm_keys.refresh(), readiness_timeout)
+        except Exception as e:
+            return str(e) or type(e).__name__
+        if len(realm_keys.keys) == 0:
+            return 'No realm signing keys'
+
+    errors = dict(zip(['database', 'storage', 'keycloak'], await asyncio.gather(
+        check_database(), check_storage(readiness_timeout), check_keycloak()
+    )))
+    content = {name: 'ok' if error == None else error for name, error in errors.items()}
+    ready = all(error == None for error in errors.values())
+    return JSONResponse(content={'ready': ready, **content}, status_code=200 if ready else 503)
+
 @app.get('/', include_in_schema=False)
 async def root():
     return { 'name': 'Mitwelten Data API', 'version': '3.0' }
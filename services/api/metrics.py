@@ -0,0 +1,130 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import Gauge, Histogram
+
+# ------------------------------------------------------------------------------
+# PROMETHEUS METRICS
+# ------------------------------------------------------------------------------
+
+db_pool_size = Gauge('db_pool_size', 'Connections opened by the pool')
+db_pool_max_size = Gauge('db_pool_max_size', 'Maximum number of connections of the pool')
+db_pool_idle = Gauge('db_pool_idle', 'Idle connections in the pool')
+db_pool_in_use = Gauge('db_pool_in_use', 'Connections acquired from the pool')
+db_pool_waiting = Gauge('db_pool_waiting', 'Tasks waiting to acquire a connection')
+db_pool_acquire_seconds = Histogram(
+    'db_pool_acquire_seconds',
+    'Time to acquire a connection from the pool',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+
+db_query_seconds = Histogram(
+    'db_query_seconds',
+    'Query execution time, including reading the result',
+    ['query'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+db_query_rows = Histogram(
+    'db_query_rows',
+    'Rows returned per query',
+    ['query'],
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000),
+)
+
+http_request_seconds = Histogram(
+    'http_request_seconds',
+    'Request latency until the response has been sent completely',
+    ['method', 'route', 'status'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+http_request_size_bytes = Histogram(
+    'http_request_size_bytes',
+    'Request body size, as declared in the Content-Length header',
+    ['method', 'route'],
+    buckets=(0, 256, 4096, 65536, 1048576, 16777216, 268435456),
+)
+http_response_size_bytes = Histogram(
+    'http_response_size_bytes',
+    'Response body size',
+    ['method', 'route', 'status'],
+    buckets=(0, 256, 4096, 65536, 1048576, 16777216, 268435456),
+)
+
+# ASGI scope of the request being handled, the route is added once matched
+request_scope: ContextVar[Optional[dict]] = ContextVar('request_scope', default=None)
+# name of the query set by `named_query()`
+query_name: ContextVar[Optional[str]] = ContextVar('query_name', default=None)
+
+def route_template(scope: Optional[dict]) -> str:
+    '''
+    Path template of the matched route (i.e. `/data/{node_label}`)
+    '''
+    route = scope.get('route') if scope != None else None
+    return getattr(route, 'path', 'unmatched')
+
+@contextmanager
+def named_query(name: str):
+    '''
+    Label the queries run within the context with `name`, instead of the
+    method and route of the request
+    '''
+    token = query_name.set(name)
+    try:
+        yield
+    finally:
+        query_name.reset(token)
+
+def current_query_name() -> str:
+    name = query_name.get()
+    if name != None:
+        return name
+    scope = request_scope.get()
+    if scope == None:
+        return 'background'
+    return f'{scope["method"]} {route_template(scope)}'
+
+def observe_query(start: float, rows: int) -> float:
+    elapsed = time.perf_counter() - start
+    name = current_query_name()
+    db_query_seconds.labels(name).observe(elapsed)
+    db_query_rows.labels(name).observe(rows)
+    return elapsed
+
+class MetricsMiddleware:
+    '''
+    Record latency, request and response size of each HTTP request,
+    labelled by the route template rather than the actual path
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                size += len(message.get('body', b''))
+            await send(message)
+
+        token = request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_scope.reset(token)
+            method, route = scope['method'], route_template(scope)
+            content_length = dict(scope['headers']).get(b'content-length')
+            if content_length != None and content_length.isdigit():
+                http_request_size_bytes.labels(method, route).observe(int(content_length))
+            http_request_seconds.labels(method, route, status).observe(time.perf_counter() - start)
+            http_response_size_bytes.labels(method, route, status).observe(size)
@@ -1,13 +1,16 @@
 from datetime import datetime
 from enum import Enum
-from typing import List, Literal, Optional, Tuple, Union
+from typing import Dict, List, Literal, Optional, Tuple, Union
 
-from api.config import s3_file_url_regex
+from api.config import queue_lease_duration, s3_file_url_regex
 
 from asyncpg.types import Range
-from pydantic import BaseModel, Field, PositiveInt, constr
+from pydantic import BaseModel, Field, PositiveInt, confloat, conint, constr
 from sqlalchemy.dialects.postgresql import TSTZRANGE
 
+# rows per INSERT statement when ingesting batches, also the size limit of batch validation
+INGEST_CHUNK_SIZE = 1000
+
 
 class TimeStampRange(BaseModel):
     '''
@@ -108,6 +111,26 @@ class ImageRequest(BaseModel):
             datetime: lambda v: v.timestamp(),
         }
 
+class ImageIngestResult(BaseModel):
+    '''
+    Outcome of ingesting one item of a batch
+    '''
+    index: int = Field(..., description='Position of the item in the batch')
+    status: Literal['inserted', 'duplicate', 'invalid', 'error']
+    file_id: Optional[int] = None
+    detail: Optional[str] = None
+
+class PresignedUrl(BaseModel):
+    '''
+    Short-lived URL to download an object directly from S3 storage
+    '''
+    object_name: str
+    url: str
+    expires: datetime
+
+class PresignRequest(BaseModel):
+    object_names: List[str] = Field(..., max_items=1000, example=['1234-5678/2022-03-04/22/1234-5678_2022-03-04T22-05-06Z.jpg'])
+
 class Result(BaseModel):
     result_id: int
     file_id: int
@@ -143,6 +166,22 @@ class ResultFull(Species):
     phylum: Optional[str] = None
     kingdom: str
 
+class ResultPage(BaseModel):
+    '''
+    Page of results in keyset pagination mode
+    '''
+    results: List[Result]
+    next: Optional[str] = Field(None, description='Cursor to request the next page with, `null` at the end of records')
+    end_of_records: bool
+
+class ResultFullPage(BaseModel):
+    '''
+    Page of results including file and taxonomy details in keyset pagination mode
+    '''
+    results: List[ResultFull]
+    next: Optional[str] = Field(None, description='Cursor to request the next page with, `null` at the end of records')
+    end_of_records: bool
+
 class RankEnum(str, Enum):
     kingdom = 'KINGDOM'
     phylum = 'PHYLUM'
@@ -247,13 +286,91 @@ class DeploymentRequest(BaseModel):
     period: TimeStampRange
     tags: Optional[List[str]] = None
 
-class QueueInputDefinition(BaseModel):
-    node_label: str # for now keep this required. TODO: implement update for all dask when node_label not present
+class QueueSelection(BaseModel):
+    '''
+    Selection of files / tasks of queue operations, all nodes if neither
+    `node_label` nor `node_labels` are given
+    '''
+    node_label: Optional[str] = None
+    node_labels: List[str] = []
+    time_from: Optional[datetime] = Field(None, alias='from', example='2022-06-22T18:00:00.000Z', description='Recorded at or after')
+    time_to: Optional[datetime] = Field(None, alias='to', example='2022-06-22T20:00:00.000Z', description='Recorded before')
+    config_id: Optional[int] = Field(None, description='Tasks of this config only')
+    dry_run: bool = Field(False, description='Count the affected files / tasks without changing them')
 
-class QueueUpdateDefinition(BaseModel):
-    node_label: str # for now keep this required. TODO: implement update for all dask when node_label not present
+    class Config:
+        allow_population_by_field_name = True
+
+class QueueInputDefinition(QueueSelection):
+    config_id: int = Field(1, description='Config to queue the files with')
+
+class QueueUpdateDefinition(QueueSelection):
     action: Literal['reset_all', 'reset_failed', 'pause', 'resume']
 
+class QueueJob(BaseModel):
+    '''
+    Queue operation running in the background, see `/queue/jobs/`
+    '''
+    job_id: int
+    action: str
+    selection: dict
+    state: Literal['pending', 'running', 'cancelled', 'interrupted', 'failed', 'done']
+    total: Optional[int] = Field(None, description='Tasks selected when the job started')
+    processed: int
+    results_deleted: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
+
+class QueueOperationResult(BaseModel):
+    affected: int
+    nodes: Dict[str, int] = Field(..., description='Affected files / tasks per node')
+    dry_run: bool
+
+class NodeWeightUpdate(BaseModel):
+    weight: confloat(gt=0, le=1000) = Field(..., description='Share of the queue relative to the default weight 1')
+
+class NodeWeight(NodeWeightUpdate):
+    node_label: str
+
+class ConfigQuota(BaseModel):
+    max_running: Optional[conint(ge=0)] = Field(..., description='Running tasks of the config claimed at most, `null` for no limit')
+
+class TaskClaimRequest(BaseModel):
+    limit: conint(ge=1, le=1000) = Field(10, description='Maximum number of tasks to claim')
+    lease: conint(ge=30, le=86400) = Field(queue_lease_duration, description='Seconds until unfinished tasks return to pending')
+
+class ClaimedTask(BaseModel):
+    '''
+    Task leased to a worker, with the file and configuration to process
+    '''
+    task_id: int
+    file_id: int
+    object_name: str
+    time: datetime
+    duration: float
+    config_id: int
+    config: dict
+    pickup_on: datetime = Field(..., description='Identifies the lease, pass it back on completion')
+    lease_until: datetime
+
+class TaskResult(BaseModel):
+    time_start: float
+    time_end: float
+    confidence: confloat(ge=0, le=1)
+    species: constr(max_length=255)
+
+class TaskCompletion(BaseModel):
+    task_id: int
+    pickup_on: datetime
+    state: Literal['complete', 'failed'] = 'complete'
+    results: List[TaskResult] = []
+
+class TaskCompletionResult(BaseModel):
+    completed: List[int]
+    rejected: List[int] = Field(..., description='Tasks not leased by the given claim (anymore), their results are discarded')
+
 class File(BaseModel):
     '''
     File uploaded through front end to S3, associated to an entry
@@ -317,6 +434,17 @@ class DatumResponse(BaseModel):
     '''
     __root__: Union[List[PaxDatum], List[EnvDatum]] = Field(..., discriminator='type')
 
+class DataBatchRequest(BaseModel):
+    '''
+    Selection of sensor data of several nodes in a shared time window
+    '''
+    node_labels: List[constr(regex=r'\d{4}-\d{4}')] = Field([], example=['2323-4242'], description='Nodes to read all deployments of')
+    deployment_ids: List[int] = Field([], example=[42], description='Deployments to read')
+    time_from: Optional[datetime] = Field(None, alias='from', example='2022-06-22T18:00:00.000Z')
+    time_to: Optional[datetime] = Field(None, alias='to', example='2022-06-22T20:00:00.000Z')
+    limit: conint(ge=1, le=65536) = Field(32768, description='Maximum number of records per node')
+    max_points: Optional[conint(ge=2, le=65536)] = Field(None, description='Downsample to at most `max_points` time buckets per node')
+
 class ApiResponse(BaseModel):
     code: Optional[int] = None
     type: Optional[str] = None
@@ -0,0 +1,42 @@
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+from api.config import preview_quality, preview_workers
+
+from PIL import Image
+
+# ------------------------------------------------------------------------------
+# IMAGE PREVIEWS
+# ------------------------------------------------------------------------------
+
+executor = None
+
+def resize(data: bytes, size: int, quality: int):
+    '''
+    Downscale an image to fit into a square of `size` pixels, encoded as JPEG.
+    Runs in a worker process.
+    '''
+    image = Image.open(io.BytesIO(data))
+    # let the JPEG decoder downscale by powers of two while decoding
+    image.draft('RGB', (size, size))
+    image = image.convert('RGB')
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue(), image.size
+
+async def render_preview(data: bytes, size: int):
+    '''
+    Downscale an image in the process pool, returns the JPEG and its resolution
+    '''
+    global executor
+    if executor == None:
+        executor = ProcessPoolExecutor(max_workers=preview_workers)
+    return await asyncio.get_running_loop().run_in_executor(executor, resize, data, size, preview_quality)
+
+def shutdown():
+    global executor
+    if executor != None:
+        executor.shutdown(cancel_futures=True)
+        executor = None
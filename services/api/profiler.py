@@ -0,0 +1,103 @@
+import asyncio
+import random
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+from api.config import profile_explain_rate, profile_threshold
+from api.metrics import current_query_name
+
+from databases.core import Connection
+
+# ------------------------------------------------------------------------------
+# SLOW QUERY PROFILER
+# ------------------------------------------------------------------------------
+
+# id of the request being handled, as passed in or returned in `X-Request-ID`
+request_id: ContextVar[Optional[str]] = ContextVar('request_id', default=None)
+
+def shorten(value, length: int = 1000) -> str:
+    text = repr(value)
+    return text if len(text) <= length else text[:length] + f'... ({len(text)} chars)'
+
+class RequestIdMiddleware:
+    '''
+    Tag each request with the id passed in the header `X-Request-ID` or a
+    new one, returned in the same header, to find the log lines of a request
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        rid = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                message.setdefault('headers', [])
+                message['headers'] = [*message['headers'], (b'x-request-id', rid.encode('latin-1'))]
+            await send(message)
+
+        token = request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id.reset(token)
+
+class QueryProfiler:
+    '''
+    Log queries taking longer than `threshold` milliseconds with their bound
+    parameters, tagged with the request id. A fraction `explain_rate` of the
+    logged queries is run again with `EXPLAIN (ANALYZE, BUFFERS)` in a read
+    only transaction on a separate connection, one at a time and after the
+    response, logging the plan.
+    '''
+
+    def __init__(self, threshold: Optional[float], explain_rate: float):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.explaining = None
+
+    def record(self, database, elapsed: float, rows: int, query, values=None):
+        if self.threshold == None or elapsed * 1000 < self.threshold:
+            return
+        rid = request_id.get() or '-'
+        sets = None
+        if isinstance(values, list): # execute_many, show the first set of values
+            sets, values = len(values), values[0] if len(values) else None
+        try:
+            sql, args, _ = database._backend.connection()._compile(Connection._build_query(query, values))
+        except Exception as e:
+            print(f'[{rid}] slow query {current_query_name()}: {elapsed * 1000:.0f} ms, not compiled: {e}')
+            return
+        print(f'[{rid}] slow query {current_query_name()}: {elapsed * 1000:.0f} ms, {rows} rows')
+        print(f'[{rid}]   {" ".join(sql.split())}')
+        print(f'[{rid}]   parameters: {shorten(args)}' + (f' (first of {sets} sets)' if sets != None else ''))
+        if sets == None and self.explain_rate > 0 and random.random() < self.explain_rate:
+            if self.explaining == None or self.explaining.done():
+                self.explaining = asyncio.create_task(self.explain(database, rid, sql, args))
+
+    async def explain(self, database, rid: str, sql: str, args: list):
+        pool = database._backend._pool
+        if pool == None:
+            return
+        connection = await pool.acquire()
+        try:
+            transaction = connection.transaction(readonly=True)
+            await transaction.start()
+            try:
+                plan = await connection.fetch(f'EXPLAIN (ANALYZE, BUFFERS) {sql}', *args)
+            finally:
+                await transaction.rollback()
+            print(f'[{rid}] query plan:')
+            for line in plan:
+                print(f'[{rid}]   {line[0]}')
+        except Exception as e:
+            print(f'[{rid}] query plan failed: {e}')
+        finally:
+            await pool.release(connection)
+
+profiler = QueryProfiler(profile_threshold, profile_explain_rate)
@@ -1,11 +1,18 @@
-from typing import List
+import csv
+import io
+import json
+import math
+from datetime import datetime, time, timedelta, timezone
+from typing import List, Literal, Optional, Union
 
 from api.database import database
-from api.models import Result, ResultFull
-from api.tables import results, results_file_taxonomy, species, species_day, taxonomy_data
+from api.dependencies import GeometryPoint, decode_cursor, encode_cursor
+from api.models import Result, ResultFull, ResultFullPage, ResultPage
+from api.tables import results, results_file_taxonomy, species_rollup, taxonomy_data
 
 from fastapi import APIRouter, Query
-from sqlalchemy.sql import and_, desc, func, select
+from fastapi.responses import StreamingResponse
+from sqlalchemy.sql import desc, func, select
 
 router = APIRouter(tags=['inferrence'])
 
@@ -13,26 +20,156 @@ router = APIRouter(tags=['inferrence'])
 # BIRDNET RESULTS
 # ------------------------------------------------------------------------------
 
-# todo: give endOfRecords (select +1, see if array is full)
-# todo: adjustable confidence
-@router.get('/results/', response_model=List[Result])
-async def read_results(offset: int = 0, pagesize: int = Query(1000, gte=0, lte=1000)):
-    query = results.select().where(results.c.confidence > 0.9).\
-        limit(pagesize).offset(offset)
+export_media_types = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+async def read_page(table, conf: float, pagesize: int, cursor: str):
+    '''
+    Read one page in keyset pagination mode, selecting one record more than
+    requested to find out if the end of records is reached
+    '''
+    query = table.select().where(table.c.confidence >= conf, table.c.result_id > decode_cursor(cursor)).\
+        order_by(table.c.result_id).limit(pagesize + 1)
+    records = await database.fetch_all(query)
+    end_of_records = len(records) <= pagesize
+    records = records[:pagesize]
+    return {
+        'results': records,
+        'next': None if end_of_records else encode_cursor(records[-1]['result_id']),
+        'end_of_records': end_of_records
+    }
+
+def export_columns(table) -> List[str]:
+    '''
+    Column names of the exported rows, location points are flattened
+    '''
+    columns = []
+    for column in table.columns:
+        if isinstance(column.type, GeometryPoint):
+            columns.extend([f'{column.name}_lat', f'{column.name}_lon'])
+        else:
+            columns.append(column.name)
+    return columns
+
+async def stream_records(table, conf: float, format: str):
+    '''
+    Stream all records above the confidence threshold as NDJSON or CSV,
+    iterating over a server-side cursor to keep memory usage constant
+    '''
+    query = table.select().where(table.c.confidence >= conf).order_by(table.c.result_id)
+    buffer = io.StringIO()
+    if format == 'csv':
+        # missing location points leave their columns empty
+        writer = csv.DictWriter(buffer, fieldnames=export_columns(table), extrasaction='ignore')
+        writer.writeheader()
+    async for record in database.iterate(query):
+        row = {}
+        for key in record:
+            value = record[key]
+            if isinstance(value, dict): # flatten location points
+                row.update({f'{key}_{k}': v for k, v in value.items()})
+            elif isinstance(value, datetime):
+                row[key] = value.isoformat()
+            else:
+                row[key] = value
+        if format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row) + '\n')
+        if buffer.tell() >= 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+@router.get('/results/', response_model=Union[ResultPage, List[Result]])
+async def read_results(
+    offset: int = 0,
+    pagesize: int = Query(1000, ge=1, le=1000),
+    conf: float = Query(0.9, ge=0, le=1),
+    cursor: Optional[str] = None,
+):
+    '''
+    ## List BirdNET results
+
+    Results are filtered by a minimum confidence of `conf`.
+
+    Passing `cursor` switches from offset to keyset pagination: Start with an
+    empty `cursor` and pass the `next` token of the returned page to read the
+    following page, until `end_of_records` is true.
+    '''
+    if cursor != None:
+        return await read_page(results, conf, pagesize, cursor)
+    query = results.select().where(results.c.confidence >= conf).\
+        order_by(results.c.result_id).limit(pagesize).offset(offset)
     return await database.fetch_all(query)
 
-# todo: adjustable confidence
-@router.get('/results_full/', response_model=List[ResultFull])
-async def read_results_full(offset: int = 0, pagesize: int = Query(1000, gte=0, lte=1000)):
-    query = results_file_taxonomy.select().where(results.c.confidence > 0.9).\
-        limit(pagesize).offset(offset)
+@router.get('/results/export/')
+async def export_results(conf: float = Query(0.9, ge=0, le=1), format: Literal['ndjson', 'csv'] = 'ndjson'):
+    '''
+    Stream all BirdNET results with a minimum confidence of `conf` in one response
+    '''
+    return StreamingResponse(stream_records(results, conf, format), media_type=export_media_types[format])
+
+@router.get('/results_full/', response_model=Union[ResultFullPage, List[ResultFull]])
+async def read_results_full(
+    offset: int = 0,
+    pagesize: int = Query(1000, ge=1, le=1000),
+    conf: float = Query(0.9, ge=0, le=1),
+    cursor: Optional[str] = None,
+):
+    '''
+    ## List BirdNET results including file and taxonomy details
+
+    Results are filtered by a minimum confidence of `conf`.
+
+    Passing `cursor` switches from offset to keyset pagination: Start with an
+    empty `cursor` and pass the `next` token of the returned page to read the
+    following page, until `end_of_records` is true.
+    '''
+    if cursor != None:
+        return await read_page(results_file_taxonomy, conf, pagesize, cursor)
+    query = results_file_taxonomy.select().where(results_file_taxonomy.c.confidence >= conf).\
+        order_by(results_file_taxonomy.c.result_id).limit(pagesize).offset(offset)
     return await database.fetch_all(query)
 
+@router.get('/results_full/export/')
+async def export_results_full(conf: float = Query(0.9, ge=0, le=1), format: Literal['ndjson', 'csv'] = 'ndjson'):
+    '''
+    Stream all BirdNET results including file and taxonomy details
+    with a minimum confidence of `conf` in one response
+    '''
+    return StreamingResponse(stream_records(results_file_taxonomy, conf, format), media_type=export_media_types[format])
+
+def confidence_bucket(conf: float) -> int:
+    '''Smallest confidence bucket of the species rollup containing only results >= `conf`'''
+    return math.ceil(round(conf * 100, 6))
+
+def rollup_day_range(start: int, end: int) -> list:
+    '''
+    Day range criteria for the species rollup: the UTC days overlapping
+    `start` (inclusive) to `end` (exclusive), unix timestamps, 0 is unbounded
+    '''
+    criteria = []
+    if start:
+        criteria.append(species_rollup.c.day >= datetime.fromtimestamp(start, timezone.utc).date())
+    if end:
+        end_time = datetime.fromtimestamp(end, timezone.utc)
+        end_day = end_time.date() if end_time.time() == time.min else end_time.date() + timedelta(days=1)
+        criteria.append(species_rollup.c.day < end_day)
+    return criteria
+
 @router.get('/species/')
 async def read_species(start: int = 0, end: int = 0, conf: float = 0.9):
-    query = select(results.c.species, func.count(results.c.species).label('count')).\
-        where(results.c.confidence >= conf).\
-        group_by(results.c.species).\
+    '''
+    ## Count of detections per species
+
+    Read from the species rollup, optionally delimited by `start` (inclusive)
+    and `end` (exclusive, unix timestamps). The rollup counts whole UTC days,
+    all days overlapping the range are included.
+    '''
+    query = select(species_rollup.c.species, func.sum(species_rollup.c.count).label('count')).\
+        where(species_rollup.c.confidence_bucket >= confidence_bucket(conf), *rollup_day_range(start, end)).\
+        group_by(species_rollup.c.species).\
         subquery(name='species')
     labelled_query = select(query).\
         outerjoin(taxonomy_data, query.c.species == taxonomy_data.c.label_sci).\
@@ -42,25 +179,59 @@ async def read_species(start: int = 0, end: int = 0, conf: float = 0.9):
 
 @router.get('/species/{spec}') # , response_model=List[Species]
 async def read_species_detail(spec: str, start: int = 0, end: int = 0, conf: float = 0.9):
-    query = select(species.c.species, func.min(species.c.time_start).label('earliest'),
-            func.max(species.c.time_start).label('latest'),
-            func.count(species.c.time_start).label('count')).\
-        where(and_(species.c.species == spec, species.c.confidence >= conf)).\
-        group_by(species.c.species).subquery(name='species')
+    '''
+    ## Detection summary of a species
+
+    Read from the species rollup, optionally delimited by `start` (inclusive)
+    and `end` (exclusive, unix timestamps). The rollup counts whole UTC days,
+    all days overlapping the range are included.
+    '''
+    query = select(species_rollup.c.species, func.min(species_rollup.c.time_min).label('earliest'),
+            func.max(species_rollup.c.time_max).label('latest'),
+            func.sum(species_rollup.c.count).label('count')).\
+        where(species_rollup.c.species == spec, species_rollup.c.confidence_bucket >= confidence_bucket(conf),
+            *rollup_day_range(start, end)).\
+        group_by(species_rollup.c.species).subquery(name='species')
     labelled_query = select(query).\
         outerjoin(taxonomy_data, query.c.species == taxonomy_data.c.label_sci).\
         with_only_columns(query, taxonomy_data.c.label_de, taxonomy_data.c.label_en, taxonomy_data.c.image_url)
     return await database.fetch_all(labelled_query)
 
+bucket_formats = {
+    'hour': 'YYYY-mm-DD"T"HH24:MI:SS"Z"',
+    'day': 'YYYY-mm-DD',
+    'week': 'YYYY-mm-DD',
+    'month': 'YYYY-mm-DD',
+}
+
 @router.get('/species/{spec}/day/') # , response_model=List[Species]
-async def read_species_day(spec: str, start: int = 0, end: int = 0, conf: float = 0.9):
-    query = select(species_day.c.species, species_day.c.date,
-            func.count(species_day.c.species).label('count')).\
-        where(and_(species_day.c.species == spec, species_day.c.confidence >= conf)).\
-        group_by(species_day.c.species, species_day.c.date).\
+async def read_species_day(
+    spec: str,
+    start: int = 0,
+    end: int = 0,
+    conf: float = 0.9,
+    bucket: Literal['hour', 'day', 'week', 'month'] = 'day'
+):
+    '''
+    ## Histogram of detections of a species
+
+    Detections are counted per `bucket` (UTC), `date` is the start of the
+    bucket. The selection can be delimited by `start` (inclusive) and `end`
+    (exclusive, unix timestamps).
+    '''
+    criteria = [results.c.species == spec, results.c.confidence >= conf]
+    if start:
+        criteria.append(results.c.time >= datetime.fromtimestamp(start, timezone.utc))
+    if end:
+        criteria.append(results.c.time < datetime.fromtimestamp(end, timezone.utc))
+    time_bucket = func.date_trunc(bucket, func.timezone('UTC', results.c.time))
+    query = select(results.c.species, time_bucket.label('bucket'), func.count().label('count')).\
+        where(*criteria).\
+        group_by(results.c.species, time_bucket).\
         subquery(name='species')
     labelled_query = select(query).\
         outerjoin(taxonomy_data, query.c.species == taxonomy_data.c.label_sci).\
-        order_by(query.c.date).\
-        with_only_columns(query, taxonomy_data.c.label_de, taxonomy_data.c.label_en)
+        order_by(query.c.bucket).\
+        with_only_columns(query.c.species, func.to_char(query.c.bucket, bucket_formats[bucket]).label('date'),
+            query.c.count, taxonomy_data.c.label_de, taxonomy_data.c.label_en)
     return await database.fetch_all(labelled_query)
@@ -1,13 +1,22 @@
-from datetime import datetime
-from typing import Optional
+import math
+import sys
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, Optional
 
+from api.cache import metadata_cache
 from api.database import database
-from api.models import DatumResponse, EnvDatum, PaxDatum
-from api.tables import data_env, data_pax, deployments, nodes
+from api.models import DataBatchRequest, DatumResponse, EnvDatum, PaxDatum
+from api.tables import (
+    data_env, data_env_daily, data_env_hourly, data_pax, data_pax_daily,
+    data_pax_hourly, deployments, nodes
+)
 
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, Response
 from pydantic import conint, constr
-from sqlalchemy.sql import between, select
+from sqlalchemy import Float
+from sqlalchemy.sql import between, cast, func, select
 
 router = APIRouter(tags=['data', 'viz'])
 
@@ -15,49 +24,266 @@ router = APIRouter(tags=['data', 'viz'])
 # DATA
 # ------------------------------------------------------------------------------
 
+COLUMNAR_MEDIA_TYPE = 'application/vnd.mitwelten.columnar'
+
+# value columns per sensor type, with array typecode (q: int64, d: float64)
+sensor_columns = {
+    'pax': [('pax', 'q'), ('voltage', 'd')],
+    'env': [('temperature', 'd'), ('humidity', 'd'), ('moisture', 'd'), ('voltage', 'd')],
+}
+
+typecode_names = {'q': 'int64', 'd': 'float64'}
+
+# continuous aggregates per sensor table with their bucket width, coarsest first
+sensor_aggregates = {
+    'sensordata_pax': [(timedelta(days=1), data_pax_daily), (timedelta(hours=1), data_pax_hourly)],
+    'sensordata_env': [(timedelta(days=1), data_env_daily), (timedelta(hours=1), data_env_hourly)],
+}
+
+def select_target(node_type: str):
+    '''
+    Select the sensor table, datum type and value columns for a node type
+    '''
+    if node_type in ['pax', 'Pax']:
+        return data_pax, PaxDatum, sensor_columns['pax']
+    elif node_type in ['env', 'HumiTemp', 'HumiTempMoisture', 'Moisture']:
+        return data_env, EnvDatum, sensor_columns['env']
+    else:
+        raise HTTPException(status_code=400, detail='Invalid node type: {}'.format(node_type))
+
+def time_criteria(column, time_from: Optional[datetime], time_to: Optional[datetime]) -> list:
+    if time_from and time_to:
+        return [between(column, time_from, time_to)]
+    elif time_from:
+        return [column >= time_from]
+    elif time_to:
+        return [column < time_to]
+    return []
+
+def select_source(target, width: timedelta):
+    '''
+    Select the coarsest continuous aggregate of `target` fitting into buckets
+    of `width`, widening `width` to a multiple of the aggregate bucket width.
+    Falls back to the raw sensor table for buckets narrower than an hour.
+    '''
+    for resolution, aggregate in sensor_aggregates[target.name]:
+        if width >= resolution:
+            return aggregate, math.ceil(width / resolution) * resolution
+    return target, width
+
+def aggregate_columns(source, columns):
+    '''
+    Select average, minimum and maximum of each value column per time bucket,
+    returning the selectables and the resulting column layout
+    '''
+    selection = []
+    layout = []
+    for name, typecode in columns:
+        if f'{name}_sum' in source.c:
+            # re-bucket a continuous aggregate, averages weighted by sample count
+            selection.extend([
+                cast(func.sum(source.c[f'{name}_sum']) / func.nullif(func.sum(source.c[f'{name}_count']), 0), Float).label(name),
+                func.min(source.c[f'{name}_min']).label(f'{name}Min'),
+                func.max(source.c[f'{name}_max']).label(f'{name}Max'),
+            ])
+        else:
+            selection.extend([
+                cast(func.avg(source.c[name]), Float).label(name),
+                func.min(source.c[name]).label(f'{name}Min'),
+                func.max(source.c[name]).label(f'{name}Max'),
+            ])
+        layout.extend([(name, 'd'), (f'{name}Min', typecode), (f'{name}Max', typecode)])
+    return selection, layout
+
+async def bucket_width(target, criterion, time_from: Optional[datetime], time_to: Optional[datetime], max_points: int) -> timedelta:
+    '''
+    Width of time buckets to return at most `max_points` points per node,
+    unbounded time ranges are delimited by the extent of the data of the
+    deployments matching `criterion`
+    '''
+    if not (time_from and time_to):
+        extent = await database.fetch_one(select(func.min(target.c.time).label('min'), func.max(target.c.time).label('max')).\
+            select_from(target.join(deployments)).\
+            where(criterion, *time_criteria(target.c.time, time_from, time_to)))
+        time_from = time_from or extent['min']
+        time_to = time_to or extent['max']
+    if time_from == None or time_to == None:
+        return timedelta(seconds=1)
+    return timedelta(seconds=max(1, math.ceil((time_to - time_from).total_seconds() / max_points)))
+
+def series_query(target, columns, criterion, time_from: Optional[datetime], time_to: Optional[datetime], width: Optional[timedelta]):
+    '''
+    Select the time series of the deployments matching `criterion`, aggregated
+    into buckets of `width` if given, returning the query and the column layout
+    '''
+    if width != None:
+        source, width = select_source(target, width)
+        time_bucket = func.time_bucket(width, source.c.time)
+        selection, columns = aggregate_columns(source, columns)
+        query = select(time_bucket.label('time'), *selection, nodes.c.node_label.label('nodeLabel')).\
+            select_from(source.outerjoin(deployments).outerjoin(nodes)).\
+            where(criterion, *time_criteria(source.c.time, time_from, time_to)).\
+            group_by(time_bucket, nodes.c.node_label).\
+            order_by(time_bucket)
+    else:
+        query = select(target.c.time, *[target.c[name] for name, _ in columns], nodes.c.node_label.label('nodeLabel')).\
+            select_from(target.outerjoin(deployments).outerjoin(nodes)).\
+            where(criterion, *time_criteria(target.c.time, time_from, time_to)).\
+            order_by(target.c.time)
+    return query, columns
+
+def pack_columns(records, columns) -> Response:
+    '''
+    Pack records into contiguous little-endian columns, one after the other:
+    `time` in milliseconds since epoch followed by the value columns. Missing
+    float values are encoded as NaN. Column layout and row count are listed in
+    the headers `X-Columns` and `X-Row-Count`.
+    '''
+    layout = [('time', 'q')] + columns
+    packed = [array('q', [int(r['time'].timestamp() * 1000) for r in records])]
+    for name, typecode in columns:
+        if typecode == 'd':
+            packed.append(array('d', [float('nan') if r[name] == None else r[name] for r in records]))
+        else:
+            packed.append(array('q', [0 if r[name] == None else r[name] for r in records]))
+    if sys.byteorder == 'big':
+        for column in packed:
+            column.byteswap()
+    return Response(
+        content=b''.join(column.tobytes() for column in packed),
+        media_type=COLUMNAR_MEDIA_TYPE,
+        headers={
+            'X-Columns': ','.join(f'{name}:{typecode_names[typecode]}' for name, typecode in layout),
+            'X-Row-Count': str(len(records)),
+        }
+    )
+
+def serialize_datum(record, node_type: str, defaults: dict) -> dict:
+    datum = {**defaults, **record, 'type': node_type}
+    datum['time'] = datum['time'].isoformat()
+    return datum
+
+def serialize_records(records, node_type: str, typeclass) -> JSONResponse:
+    '''
+    Serialize records in the shape of `typeclass`, without validating each datum
+    '''
+    defaults = {name: field.default for name, field in typeclass.__fields__.items()}
+    return JSONResponse(content=[serialize_datum(record, node_type, defaults) for record in records])
+
+@router.post('/data/batch', response_model=Dict[str, DatumResponse])
+async def list_data_batch(body: DataBatchRequest) -> Dict[str, DatumResponse]:
+    '''
+    ## List sensor / capture data of several nodes
+
+    Select the nodes by `node_labels` (all of their deployments) and/or by
+    `deployment_ids`. The data of all selected nodes is read with one query
+    per sensor type and returned in timestamp ascending order, grouped by node
+    label. `limit` and `max_points` apply per node, see `/data/{node_label}`.
+    '''
+    if len(body.node_labels) == 0 and len(body.deployment_ids) == 0:
+        raise HTTPException(status_code=400, detail='Select at least one node label or deployment id')
+
+    # resolve the selection into (deployment_id, node) pairs
+    deployed = []
+    for node_label in body.node_labels:
+        node = await metadata_cache.node(node_label)
+        if node == None:
+            raise HTTPException(status_code=404, detail='Node not found: {}'.format(node_label))
+        deployed.append((None, node))
+        deployed.extend([(d['deployment_id'], node) for d in await metadata_cache.node_deployments(node['node_id'])])
+    for deployment_id in body.deployment_ids:
+        deployment = await metadata_cache.deployment(deployment_id)
+        if deployment == None:
+            raise HTTPException(status_code=404, detail='Deployment not found: {}'.format(deployment_id))
+        node = await metadata_cache.node_by_id(deployment['node_id'])
+        if node == None:
+            raise HTTPException(status_code=404, detail='Node not found for deployment: {}'.format(deployment_id))
+        deployed.append((deployment_id, node))
+
+    # group the selected deployments by sensor table
+    node_types = {}
+    targets = {}
+    for deployment_id, node in deployed:
+        target, typeclass, columns = select_target(node['type'])
+        node_types[node['node_label']] = node['type']
+        if target.name not in targets:
+            targets[target.name] = (target, typeclass, columns, set())
+        if deployment_id != None:
+            targets[target.name][3].add(deployment_id)
+
+    typed_result = {node_label: [] for node_label in node_types}
+    for target, typeclass, columns, deployment_ids in targets.values():
+        if len(deployment_ids) == 0:
+            continue
+        criterion = deployments.c.deployment_id.in_(sorted(deployment_ids))
+        width = None
+        if body.max_points != None:
+            width = await bucket_width(target, criterion, body.time_from, body.time_to, body.max_points)
+        series = series_query(target, columns, criterion, body.time_from, body.time_to, width)[0].subquery()
+
+        # number the records per node to apply the limit
+        numbered = select(series, func.row_number().over(partition_by=series.c.nodeLabel, order_by=series.c.time).label('row_number')).subquery()
+        query = select(*[numbered.c[name] for name in series.c.keys()]).\
+            where(numbered.c.row_number <= body.limit).\
+            order_by(numbered.c.time)
+
+        defaults = {name: field.default for name, field in typeclass.__fields__.items()}
+        async for record in database.iterate(query):
+            record = record._mapping
+            typed_result[record['nodeLabel']].append(serialize_datum(record, node_types[record['nodeLabel']], defaults))
+
+    return JSONResponse(content=typed_result)
+
 @router.get('/data/{node_label}', response_model=DatumResponse)
 async def list_data(
     node_label: constr(regex=r'\d{4}-\d{4}'),
     time_from: Optional[datetime] = Query(None, alias='from', example='2022-06-22T18:00:00.000Z'),
     time_to: Optional[datetime] = Query(None, alias='to', example='2022-06-22T20:00:00.000Z'),
     limit: Optional[conint(ge=1, le=65536)] = 32768,
+    max_points: Optional[conint(ge=2, le=65536)] = None,
+    accept: Optional[str] = Header(None),
 ) -> DatumResponse:
     '''
-    List sensor / capture data in timestamp ascending order
+    ## List sensor / capture data in timestamp ascending order
+
+    At most `limit` records are returned.
+
+    ### Downsampling
+
+    With `max_points`, the series is aggregated into at most `max_points` time
+    buckets of equal width. Each datum holds the average of the bucket in the
+    value fields and minimum / maximum in the additional fields suffixed
+    `Min` / `Max` (i.e. `temperatureMin`, `temperatureMax`). `time` is the
+    start of the bucket. Buckets of an hour or wider are read from the hourly
+    or daily continuous aggregates, their width is rounded up to full hours or
+    days.
+
+    ### Columnar format
+
+    Requesting the media type `application/vnd.mitwelten.columnar` in the
+    `Accept` header returns the series as packed binary columns instead of
+    JSON: `time` (int64, milliseconds since epoch) followed by the value columns
+    of the sensor type (`pax`: int64, others: float64, NaN if missing), all in
+    little-endian byte order. The headers `X-Columns` and `X-Row-Count`
+    describe the layout.
     '''
-    typecheck = await database.fetch_one(select(nodes.c.node_id, nodes.c.type).where(nodes.c.node_label == node_label))
+    typecheck = await metadata_cache.node(node_label)
     if typecheck == None:
         raise HTTPException(status_code=404, detail='Node not found')
 
     # select the target table
-    target = None
-    if typecheck['type'] in ['pax', 'Pax']:
-        target = data_pax
-        typeclass = PaxDatum
-    elif typecheck['type'] in ['env', 'HumiTemp', 'HumiTempMoisture', 'Moisture']:
-        target = data_env
-        typeclass = EnvDatum
-    else:
-        raise HTTPException(status_code=400, detail='Invalid node type: {}'.format(typecheck['type']))
-
-    # define the join
-    query = select(target, nodes.c.node_label.label('nodeLabel')).\
-        select_from(target.outerjoin(deployments).outerjoin(nodes))
+    target, typeclass, columns = select_target(typecheck['type'])
 
-    node_selection = nodes.c.node_id == typecheck['node_id']
+    criterion = deployments.c.node_id == typecheck['node_id']
+    width = None
+    if max_points != None:
+        width = await bucket_width(target, criterion, time_from, time_to, max_points)
+    query, columns = series_query(target, columns, criterion, time_from, time_to, width)
 
-    # define time range criteria
-    if time_from and time_to:
-        query = query.where(node_selection, between(target.c.time, time_from, time_to))
-    elif time_from:
-        query = query.where(node_selection, target.c.time >= time_from)
-    elif time_to:
-        query = query.where(node_selection, target.c.time < time_to)
-    else:
-        query = query.where(node_selection)
+    result = await database.fetch_all(query=query.limit(limit))
+    # read the plain asyncpg records, the selected columns need no conversion
+    records = [r._mapping for r in result]
 
-    result = await database.fetch_all(query=query.order_by(target.c.time))
-    typed_result = []
-    for datum in result:
-        typed_result.append(typeclass(type=typecheck['type'], **datum))
-    return typed_result
+    if accept != None and COLUMNAR_MEDIA_TYPE in accept:
+        return pack_columns(records, columns)
+    return serialize_records(records, typecheck['type'], typeclass)
@@ -1,6 +1,7 @@
 from itertools import filterfalse, groupby
 from typing import List, Optional
 
+from api.cache import metadata_cache
 from api.database import database
 from api.dependencies import check_oid_authentication, from_inclusive_range, to_inclusive_range, unique_everseen
 from api.exceptions import RecordsDependencyException
@@ -77,6 +78,7 @@ async def delete_deployment(id: int) -> None:
         raise HTTPException(status_code=500, detail=str(e))
     else:
         await transaction.commit()
+        metadata_cache.invalidate()
         return True
 
 @router.post('/deployments', response_model=None, dependencies=[Depends(check_oid_authentication)])
@@ -173,3 +175,5 @@ async def upsert_deployment(body: DeploymentRequest) -> None:
     except Exception as e:
         await transaction.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+    else:
+        metadata_cache.invalidate()
@@ -1,10 +1,11 @@
+from datetime import datetime
+
 import simplekml
 
-from api.database import database
-from api.tables import deployments, nodes
+from api.cache import metadata_cache
+from api.tables import nodes
 
 from fastapi import APIRouter, Response
-from sqlalchemy.sql import LABEL_STYLE_TABLENAME_PLUS_COL, select, text
 
 router = APIRouter(tags=['kml'])
 
@@ -14,26 +15,16 @@ router = APIRouter(tags=['kml'])
 
 @router.get('/kml/{fs}/', tags=['kml'], response_class=Response(media_type="application/vnd.google-earth.kml+xml"))
 async def read_kml(fs: str):
-    query = deployments.select()
-
-    query = select(deployments.alias('d').outerjoin(nodes.alias('n'))).\
-        set_label_style(LABEL_STYLE_TABLENAME_PLUS_COL)
-
-    # if object_type != None:
-    #     query = query.where(text('n.type = :node_type').bindparams(node_id=object_type))
-
     if fs == 'fs2':
-        query = query.where(text("d.period && tstzrange('2022-01-01 00:00:00+01','2023-01-01 00:00:00+01')"))
+        deployed = await metadata_cache.deployed(datetime.fromisoformat('2022-01-01 00:00:00+01:00'), datetime.fromisoformat('2023-01-01 00:00:00+01:00'))
     elif fs == 'fs1':
-        query = query.where(text("d.period && tstzrange('2021-01-01 00:00:00+01','2022-01-01 00:00:00+01')"))
-
-    result = await database.fetch_all(query)
+        deployed = await metadata_cache.deployed(datetime.fromisoformat('2021-01-01 00:00:00+01:00'), datetime.fromisoformat('2022-01-01 00:00:00+01:00'))
+    else:
+        deployed = await metadata_cache.deployed()
 
     records = []
-    for r in result:
-        d = { c: r['d_'+c] for c in deployments.columns.keys() }
-        d['node'] = { c: r['n_'+c] for c in nodes.columns.keys() }
-        records.append(d)
+    for d, n in deployed:
+        records.append({**d, 'node': n if n != None else {c: None for c in nodes.columns.keys()}})
 
     kml = simplekml.Kml(name='Mitwelten Nodes')
     ext = simplekml.ExtendedData()
@@ -1,9 +1,15 @@
+import json
+from typing import List
+
+from api.cache import metadata_cache
 from api.database import database
 from api.dependencies import check_authentication
-from api.models import ImageRequest
+from api.models import INGEST_CHUNK_SIZE, ImageIngestResult, ImageRequest
 from api.tables import files_image
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.sql import insert, select
 
 router = APIRouter(tags=['inferrence', 'ingest'])
@@ -12,6 +18,27 @@ router = APIRouter(tags=['inferrence', 'ingest'])
 # DATA INPUT (INGEST)
 # ------------------------------------------------------------------------------
 
+def insert_images_query(rows: list):
+    return pg_insert(files_image).values(rows).\
+        on_conflict_do_nothing().\
+        returning(files_image.c.file_id, files_image.c.sha256, files_image.c.object_name)
+
+async def insert_images_rowwise(chunk: list, status: list) -> list:
+    '''
+    Insert the rows of a failed chunk one by one, each in a savepoint, marking
+    the rows failing on their own as `error`. Returns the inserted rows.
+    '''
+    returned = []
+    async with database.transaction():
+        for index, r in chunk:
+            try:
+                async with database.transaction():
+                    returned.extend(await database.fetch_all(insert_images_query([r])))
+            except Exception as e:
+                print(str(e))
+                status[index] = {'index': index, 'status': 'error', 'detail': str(e)}
+    return returned
+
 @router.get('/ingest/image/{sha256}')
 async def ingest_image(sha256: str) -> None:
     return await database.fetch_one(select(files_image).where(files_image.c.sha256 == sha256))
@@ -40,3 +67,77 @@ async def ingest_image(body: ImageRequest) -> None:
 
     else:
         await transaction.commit()
+
+@router.post('/ingest/images', dependencies=[Depends(check_authentication)], response_model=List[ImageIngestResult],
+    openapi_extra={'requestBody': {'required': True, 'content': {
+        'application/json': {'schema': {'type': 'array', 'items': {'$ref': '#/components/schemas/ImageRequest'}}},
+        'application/x-ndjson': {'schema': {'$ref': '#/components/schemas/ImageRequest'}},
+    }}})
+async def ingest_images(request: Request) -> List[ImageIngestResult]:
+    '''
+    ## Ingest a batch of images
+
+    The body is either a JSON array of `ImageRequest`s or, with the content
+    type `application/x-ndjson`, one `ImageRequest` per line.
+
+    The records are inserted with one statement per 1000 items, skipping
+    duplicates (by `sha256` or `object_name`). The response lists the
+    status of each item by its position in the batch:
+
+    - `inserted`: the record was added, `file_id` is set
+    - `duplicate`: a record with the same hash or object name already exists
+    - `invalid`: the item did not validate or refers to an unknown deployment
+    - `error`: inserting the item failed, see `detail`. When the statement
+      of a chunk fails, its items are retried one by one, so only the
+      failing items are reported.
+    '''
+    body = await request.body()
+    try:
+        if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f'Malformed body: {e}')
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail='Expected an array of images')
+
+    status = [None] * len(items)
+    records = []
+    for index, item in enumerate(items):
+        try:
+            image = ImageRequest.parse_obj(item)
+        except ValidationError as e:
+            status[index] = {'index': index, 'status': 'invalid', 'detail': str(e)}
+            continue
+        if await metadata_cache.deployment(image.deployment_id) == None:
+            status[index] = {'index': index, 'status': 'invalid', 'detail': f'Deployment not found: {image.deployment_id}'}
+            continue
+        records.append((index, {
+            'object_name': image.object_name,
+            'sha256': image.sha256,
+            'time': image.timestamp,
+            'deployment_id': image.deployment_id,
+            'file_size': image.file_size,
+            'resolution': list(image.resolution),
+        }))
+
+    for offset in range(0, len(records), INGEST_CHUNK_SIZE):
+        chunk = records[offset:offset + INGEST_CHUNK_SIZE]
+        try:
+            returned = await database.fetch_all(insert_images_query([r for _, r in chunk]))
+        except Exception as e:
+            print(str(e))
+            returned = await insert_images_rowwise(chunk, status)
+        inserted = {(r['sha256'], r['object_name']): r['file_id'] for r in returned}
+        for index, r in chunk:
+            if status[index] != None:
+                continue
+            # conflicting rows within the batch are skipped as well, the first one wins
+            key = (r['sha256'], r['object_name'])
+            if key in inserted:
+                status[index] = {'index': index, 'status': 'inserted', 'file_id': inserted.pop(key)}
+            else:
+                status[index] = {'index': index, 'status': 'duplicate'}
+
+    return status
@@ -1,12 +1,32 @@
 
-from api.config import crd
+import asyncio
+import io
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import List, Literal, Optional
+
+from api.config import (
+    crd, minio_chunk_size, minio_parallel_parts, minio_parallel_threshold,
+    minio_part_size, minio_presign_expiry, preview_sizes
+)
+from api.database import database
 from api.dependencies import check_oid_authentication
+from api.filecache import files_cache
+from api.models import PresignedUrl, PresignRequest
+from api.previews import render_preview
+from api.storage import storage
+from api.tables import files_image, files_image_derived
 
-from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import select
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 
-from minio import Minio
 from minio.error import S3Error
+from PIL import UnidentifiedImageError
 
 router = APIRouter(tags=['files', 's3'])
 
@@ -14,19 +34,68 @@ router = APIRouter(tags=['files', 's3'])
 # MINIO FILE IO
 # ------------------------------------------------------------------------------
 
-storage = Minio(
-    crd.minio.host,
-    access_key=crd.minio.access_key,
-    secret_key=crd.minio.secret_key,
-)
-bucket_exists = storage.bucket_exists(crd.minio.bucket)
-if not bucket_exists:
-    print(f'Bucket {crd.minio.bucket} does not exist.')
+def presign(object_names: List[str]) -> List[dict]:
+    '''
+    Presign download URLs, valid for `minio_presign_expiry` seconds
+    '''
+    expiry = timedelta(seconds=minio_presign_expiry)
+    expires = datetime.now(timezone.utc) + expiry
+    return [{
+        'object_name': object_name,
+        'url': storage().presigned_get_object(crd.minio.bucket, object_name, expires=expiry),
+        'expires': expires,
+    } for object_name in object_names]
+
+def parse_range(range_header: str, size: int):
+    '''
+    Parse a single byte range `bytes=start-end`, `bytes=start-` or `bytes=-suffix`
+    into (offset, length). Returns `None` if the header is invalid or can't be
+    served as single range (the full object is sent instead), raises 416 if
+    the range is valid but not satisfiable (it starts after the object).
+    '''
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+    start, _, end = ranges.strip().partition('-')
+    if not (start.isdigit() or start == '') or not (end.isdigit() or end == '') or start == end == '':
+        return None
+    if start == '':
+        # suffix range: last n bytes
+        suffix = int(end)
+        if suffix == 0 or size == 0:
+            raise HTTPException(status_code=416, detail='Range not satisfiable', headers={'Content-Range': f'bytes */{size}'})
+        offset = max(0, size - suffix)
+        last = size - 1
+    else:
+        offset = int(start)
+        if end != '' and int(end) < offset:
+            return None
+        if offset >= size:
+            raise HTTPException(status_code=416, detail='Range not satisfiable', headers={'Content-Range': f'bytes */{size}'})
+        last = min(int(end), size - 1) if end != '' else size - 1
+    return offset, last - offset + 1
+
+def read_response(response) -> bytes:
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+def read_part(object_name: str, offset: int, length: int) -> bytes:
+    return read_response(storage().get_object(crd.minio.bucket, object_name, offset=offset, length=length))
+
+def read_object(object_name: str) -> bytes:
+    return read_response(storage().get_object(crd.minio.bucket, object_name))
 
-def stream_minio_response(response):
+async def stream_object(object_name: str, offset: int, length: int):
+    '''
+    Stream a byte range of an object, blocking reads run in the thread pool
+    '''
+    response = await run_in_threadpool(storage().get_object, crd.minio.bucket, object_name, offset=offset, length=length)
     try:
         while True:
-            chunk = response.read(4096)
+            chunk = await run_in_threadpool(response.read, minio_chunk_size)
             if not chunk:
                 break
             yield chunk
@@ -34,14 +103,203 @@ def stream_minio_response(response):
         response.close()
         response.release_conn()
 
+async def stream_object_parallel(object_name: str, offset: int, length: int):
+    '''
+    Stream a byte range of an object, fetching up to `minio_parallel_parts`
+    parts of `minio_part_size` bytes concurrently, yielded in order
+    '''
+    pending = deque()
+    try:
+        for part_offset in range(offset, offset + length, minio_part_size):
+            part_length = min(minio_part_size, offset + length - part_offset)
+            pending.append(asyncio.ensure_future(run_in_threadpool(read_part, object_name, part_offset, part_length)))
+            if len(pending) >= minio_parallel_parts:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        # client disconnected
+        for task in pending:
+            task.cancel()
+
+def open_stream(object_name: str, offset: int, length: int):
+    if length > minio_parallel_threshold:
+        return stream_object_parallel(object_name, offset, length)
+    return stream_object(object_name, offset, length)
+
+async def stream_file(path: str, offset: int, length: int):
+    '''
+    Stream a byte range of a cached file
+    '''
+    f = await run_in_threadpool(open, path, 'rb')
+    try:
+        f.seek(offset)
+        while length > 0:
+            chunk = await run_in_threadpool(f.read, min(minio_chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+@router.post('/files/presign', dependencies=[Depends(check_oid_authentication)], response_model=List[PresignedUrl])
+async def post_presign(body: PresignRequest) -> List[PresignedUrl]:
+    '''
+    ## Presign download URLs for a list of objects
+
+    The URLs grant access to the objects without authentication until they
+    expire. Existence of the objects is not checked.
+    '''
+    return await run_in_threadpool(presign, body.object_names)
+
+@router.get('/files_cache/stats', dependencies=[Depends(check_oid_authentication)])
+async def get_files_cache_stats():
+    '''
+    Hit / miss counters of this worker process and size of the local file cache
+    '''
+    return await run_in_threadpool(files_cache.summary)
+
 @router.get('/files/{object_name:path}', dependencies=[Depends(check_oid_authentication)])
-async def get_download(request: Request, object_name: str):
+async def get_download(
+    request: Request,
+    object_name: str,
+    mode: Literal['proxy', 'redirect', 'url'] = 'proxy',
+    range_header: Optional[str] = Header(None, alias='Range'),
+    if_none_match: Optional[str] = Header(None),
+    if_range: Optional[str] = Header(None),
+):
+    '''
+    ## Download a file from S3 storage
+
+    Supports single byte ranges (`Range: bytes=start-end`) for seeking in
+    media, and conditional requests with `If-None-Match` / `If-Range`
+    against the `ETag` of the object.
+
+    Objects are cached on local disk, metadata is revalidated with S3
+    after a few minutes.
+
+    ### Modes
+
+    - `proxy`: the file is sent through the API
+    - `redirect`: `307` redirect to a short-lived presigned URL of the object
+    - `url`: the presigned URL as JSON (see `/files/presign`)
+
+    In the latter two modes the existence of the object is not checked.
+    '''
+    if mode != 'proxy':
+        presigned = (await run_in_threadpool(presign, [object_name]))[0]
+        if mode == 'redirect':
+            return RedirectResponse(presigned['url'], status_code=307)
+        return PresignedUrl(**presigned)
+
+    stat = files_cache.cached_stat(object_name)
+    if stat == None:
+        try:
+            stat = await run_in_threadpool(storage().stat_object, crd.minio.bucket, object_name)
+        except S3Error as e:
+            if e.code in ('NoSuchKey', 'NoSuchObject'):
+                raise HTTPException(status_code=404, detail='File not found')
+            raise HTTPException(status_code=502, detail=str(e))
+        files_cache.store_stat(object_name, stat)
+
+    etag = f'"{stat.etag}"'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': format_datetime(stat.last_modified, usegmt=True),
+    }
+    if if_none_match != None and (if_none_match.strip() == '*' or etag in [t.strip().removeprefix('W/') for t in if_none_match.split(',')]):
+        return Response(status_code=304, headers=headers)
+
+    offset, length, status_code = 0, stat.size, 200
+    if range_header != None and (if_range == None or if_range.strip() == etag):
+        byte_range = parse_range(range_header, stat.size)
+        if byte_range != None:
+            offset, length = byte_range
+            status_code = 206
+            headers['Content-Range'] = f'bytes {offset}-{offset + length - 1}/{stat.size}'
+    headers['Content-Length'] = str(length)
+
+    if length == 0:
+        return Response(status_code=status_code, headers=headers, media_type=stat.content_type)
+
+    path = await files_cache.lookup(object_name, stat.etag)
+    if path != None:
+        if status_code == 200:
+            return FileResponse(path, headers=headers, media_type=stat.content_type)
+        return StreamingResponse(stream_file(path, offset, length), status_code=status_code, headers=headers, media_type=stat.content_type)
+
+    content = open_stream(object_name, offset, length)
+    background = None
+    if files_cache.cacheable(object_name, stat.etag, stat.size):
+        if status_code == 200:
+            content = files_cache.fill(object_name, stat.etag, content)
+        else:
+            # fetch the full object once the requested range has been sent
+            background = BackgroundTask(files_cache.prefetch, object_name, stat.etag, open_stream(object_name, 0, stat.size))
+    return StreamingResponse(content, status_code=status_code, headers=headers, media_type=stat.content_type, background=background)
+
+# previews being derived, by (file_id, size)
+previews_pending = {}
+
+async def create_preview(file_id: int, size: int) -> str:
+    '''
+    Downscale the image, store it under `derived/{size}/` and record it in `files_image_derived`
+    '''
+    image = await database.fetch_one(select(files_image.c.object_name).where(files_image.c.file_id == file_id))
+    if image == None:
+        raise HTTPException(status_code=404, detail='Image not found')
     try:
-        response = storage.get_object(crd.minio.bucket, object_name)
-        return StreamingResponse(stream_minio_response(response), headers=response.headers)
+        data = await run_in_threadpool(read_object, image['object_name'])
     except S3Error as e:
-        if e.code == 'NoSuchKey':
+        if e.code in ('NoSuchKey', 'NoSuchObject'):
             raise HTTPException(status_code=404, detail='File not found')
+        raise HTTPException(status_code=502, detail=str(e))
+    try:
+        content, resolution = await render_preview(data, size)
+    except UnidentifiedImageError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+    object_name = f'derived/{size}/{image["object_name"]}'
+    await run_in_threadpool(storage().put_object, crd.minio.bucket, object_name, io.BytesIO(content), len(content), content_type='image/jpeg')
+    await database.execute(pg_insert(files_image_derived).values(
+        file_id=file_id, size=size, object_name=object_name, file_size=len(content), resolution=list(resolution)
+    ).on_conflict_do_nothing())
+    return object_name
+
+async def derive_preview(file_id: int, size: int) -> str:
+    '''
+    Create the preview once, concurrent requests wait for the same derivation
+    '''
+    key = (file_id, size)
+    if key not in previews_pending:
+        previews_pending[key] = asyncio.ensure_future(create_preview(file_id, size))
+        previews_pending[key].add_done_callback(lambda _: previews_pending.pop(key, None))
+    return await asyncio.shield(previews_pending[key])
+
+@router.get('/previews/{file_id}', dependencies=[Depends(check_oid_authentication)])
+async def get_preview(
+    request: Request,
+    file_id: int,
+    size: int = Query(320, description=f'Edge length of the bounding square in pixels, one of {", ".join(map(str, preview_sizes))}'),
+    mode: Literal['proxy', 'redirect', 'url'] = 'proxy',
+    range_header: Optional[str] = Header(None, alias='Range'),
+    if_none_match: Optional[str] = Header(None),
+    if_range: Optional[str] = Header(None),
+):
+    '''
+    ## Download a downscaled preview of an image
+
+    Previews are derived on the first request and stored in S3 under the
+    prefix `derived/{size}/`. Delivery is the same as in `/files/{object_name}`.
+    '''
+    if size not in preview_sizes:
+        raise HTTPException(status_code=400, detail='Invalid size, valid sizes are {}'.format(', '.join(map(str, preview_sizes))))
+    derived = await database.fetch_one(select(files_image_derived.c.object_name).\
+        where(files_image_derived.c.file_id == file_id, files_image_derived.c.size == size))
+    object_name = derived['object_name'] if derived != None else await derive_preview(file_id, size)
+    return await get_download(request, object_name, mode=mode, range_header=range_header, if_none_match=if_none_match, if_range=if_range)
 
 '''
 whitelist
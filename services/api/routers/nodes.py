@@ -1,6 +1,7 @@
 from typing import List, Optional
 from datetime import datetime
 
+from api.cache import metadata_cache
 from api.database import database
 from api.dependencies import check_oid_authentication
 from api.models import Node, DeployedNode
@@ -8,7 +9,7 @@ from api.tables import deployments, nodes
 
 from asyncpg.exceptions import ForeignKeyViolationError
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.sql import delete, insert, distinct, select, func, update, text, LABEL_STYLE_TABLENAME_PLUS_COL
+from sqlalchemy.sql import delete, insert, distinct, select, func, update
 from sqlalchemy.sql.functions import current_timestamp
 
 router = APIRouter(tags=['nodes'])
@@ -27,12 +28,14 @@ async def read_nodes():
 @router.put('/nodes', dependencies=[Depends(check_oid_authentication)])
 async def upsert_node(body: Node) -> None:
     if hasattr(body, 'node_id') and body.node_id != None:
-        return await database.execute(update(nodes).where(nodes.c.node_id == body.node_id).\
+        node_id = await database.execute(update(nodes).where(nodes.c.node_id == body.node_id).\
             values({**body.dict(exclude_none=True, by_alias=True), nodes.c.updated_at: current_timestamp()}).\
             returning(nodes.c.node_id))
     else:
-        return await database.execute(insert(nodes).values(body.dict(exclude_none=True, by_alias=True)).\
+        node_id = await database.execute(insert(nodes).values(body.dict(exclude_none=True, by_alias=True)).\
             returning(nodes.c.node_id))
+    metadata_cache.invalidate()
+    return node_id
 
 @router.get('/node/type_options')
 @router.get('/node/type_options/{search_term}')
@@ -85,6 +88,7 @@ async def delete_node(id: int) -> None:
     except ForeignKeyViolationError as e:
         raise HTTPException(status_code=409, detail=str(e))
     else:
+        metadata_cache.invalidate()
         return True
 
 # ----------------------------
@@ -99,26 +103,12 @@ async def list_viz_nodes(
     List all deployed nodes
     '''
 
-    query = select(deployments.alias('d').outerjoin(nodes.alias('n'))).\
-        set_label_style(LABEL_STYLE_TABLENAME_PLUS_COL)
-
-    # define time range criteria
-    if time_from and time_to:
-        query = query.where(text("n.type != 'Test'"), text("d.period && tstzrange(:time_from, :time_to)").bindparams(time_from=time_from, time_to=time_to))
-    elif time_from:
-        query = query.where(text("n.type != 'Test'"), text("d.period && tstzrange(:time_from, 'infinity')").bindparams(time_from=time_from))
-    elif time_to:
-        query = query.where(text("n.type != 'Test'"), text("d.period && tstzrange('-infinity', :time_to)").bindparams(time_to=time_to))
-    else:
-        query = query.where(text("n.type != 'Test'"))
-
-    result = await database.fetch_all(query)
     return [{
-        'id': r['n_node_id'],
-        'name': r['n_node_label'],
-        'location': r['d_location'],
-        'location_description': r['d_description'],
-        'type': r['n_type'],
-        'platform': r['n_platform'],
-        'description': r['n_description'],
-    } for r in result]
+        'id': n['node_id'],
+        'name': n['node_label'],
+        'location': d['location'],
+        'location_description': d['description'],
+        'type': n['type'],
+        'platform': n['platform'],
+        'description': n['description'],
+    } for d, n in await metadata_cache.deployed(time_from, time_to) if n != None and n['type'] != None and n['type'] != 'Test']
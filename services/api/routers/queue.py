@@ -1,11 +1,31 @@
-from api.config import crd
+import asyncio
+import json
+import math
+from typing import List, Optional, Union
+
+from api.cache import metadata_cache
+from api.config import crd, queue_progress_interval, queue_progress_keepalive
 from api.database import database
-from api.dependencies import check_authentication
-from api.models import QueueInputDefinition, QueueUpdateDefinition
-from api.tables import birdnet_input, tasks
+from api.dependencies import check_authentication, security
+from api.jobs import queue_jobs_runner
+from api.listener import queue_progress_listener
+from api.models import (
+    ClaimedTask, ConfigQuota, NodeWeight, NodeWeightUpdate, QueueInputDefinition,
+    QueueJob, QueueOperationResult, QueueSelection, QueueUpdateDefinition,
+    TaskClaimRequest, TaskCompletion, TaskCompletionResult
+)
+from api.tables import (
+    birdnet_input, configs, node_weights, nodes, queue_durations, queue_progress,
+    queue_stats, tasks
+)
 
-from fastapi import APIRouter, Depends
-from sqlalchemy.sql import insert, func, select, text
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Float, Integer
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.sql import (
+    and_, any_, bindparam, case, cast, insert, func, select, text, tuple_, update
+)
 from sqlalchemy.sql.functions import current_timestamp
 
 router = APIRouter(tags=['queue'])
@@ -14,52 +34,73 @@ router = APIRouter(tags=['queue'])
 # QUEUE MANAGER
 # ------------------------------------------------------------------------------
 
-@router.get('/queue/progress/')
-async def read_progress():
-    query = select(birdnet_input.c.node_label, tasks.c.state,
-            func.sum(birdnet_input.c.file_size).label('size'),
-            func.count(birdnet_input.c.file_id).label('count')).\
-        outerjoin(tasks).\
-        where(birdnet_input.c.sample_rate == 48000, birdnet_input.c.duration >= 3).\
-        group_by(tasks.c.state, birdnet_input.c.node_label).\
-        order_by(birdnet_input.c.node_label)
-    progess = await database.fetch_all(query)
+# task states, -1 for files without task
+queue_states = {-1: 'noqueue', 0: 'pending', 1: 'running', 2: 'complete', 3: 'failed', 4: 'paused'}
+
+async def progress_summary() -> list:
+    '''
+    Sum up the queue progress counters of the deployments per node
+    '''
+    records = await database.fetch_all(select(queue_progress).where(queue_progress.c.count > 0))
     node_progress = {}
-    for row in progess:
-        if row.node_label not in node_progress:
-            node_progress[row.node_label] = {
+    for row in records:
+        deployment = await metadata_cache.deployment(row['deployment_id'])
+        node = await metadata_cache.node_by_id(deployment['node_id']) if deployment != None else None
+        node_label = node['node_label'] if node != None else None
+        if node_label not in node_progress:
+            node_progress[node_label] = {
                 'size': 0,
                 'total_count': 0,
                 'total_pending': 0,
-
-                'noqueue': 0,  # None
-                'pending': 0,  # 0
-                'running': 0,  # 1
-                'complete': 0, # 2
-                'failed': 0,   # 3
-                'paused': 0,   # 4
+                **{state: 0 for state in queue_states.values()}
             }
+        progress = node_progress[node_label]
+        progress['size'] += row['size']
+        progress['total_count'] += row['count']
+        if row['state'] != 2:
+            progress['total_pending'] += row['count']
+        if row['state'] in queue_states:
+            progress[queue_states[row['state']]] += row['count']
+
+    return [{'node_label': node_label, **progress} for node_label, progress in
+        sorted(node_progress.items(), key=lambda i: (i[0] == None, i[0] or ''))]
+
+async def progress_events(request: Request):
+    '''
+    Send the queue progress on connect and after each change, at most once
+    per `queue_progress_interval` seconds
+    '''
+    async with queue_progress_listener.subscribe() as changed:
+        while not await request.is_disconnected():
+            try:
+                await asyncio.wait_for(changed.wait(), queue_progress_keepalive)
+            except asyncio.TimeoutError:
+                yield ': keep-alive\n\n'
+                continue
+            changed.clear()
+            yield f'event: progress\ndata: {json.dumps(await progress_summary())}\n\n'
+            await asyncio.sleep(queue_progress_interval)
 
-        node_progress[row.node_label]['size']  += row['size']
-        node_progress[row.node_label]['total_count']  += row['count']
+@router.get('/queue/progress/')
+async def read_progress():
+    '''
+    ## BirdNET queue progress per node
 
-        if row.state != 2:
-            node_progress[row.node_label]['total_pending']  += row['count']
+    Number and size of the audio files eligible for analysis per task state,
+    read from counters maintained by triggers on files and tasks.
+    '''
+    return await progress_summary()
 
-        if row.state == None:
-            node_progress[row.node_label]['noqueue']  = row['count']
-        elif row.state == 0:
-            node_progress[row.node_label]['pending']  = row['count']
-        elif row.state == 1:
-            node_progress[row.node_label]['running']  = row['count']
-        elif row.state == 2:
-            node_progress[row.node_label]['complete'] = row['count']
-        elif row.state == 3:
-            node_progress[row.node_label]['failed']   = row['count']
-        elif row.state == 4:
-            node_progress[row.node_label]['paused']   = row['count']
+@router.get('/queue/progress/stream')
+async def stream_progress(request: Request):
+    '''
+    ## BirdNET queue progress as server-sent events
 
-    return list(map(lambda i: {'node_label': i[0], **i[1]}, node_progress.items()))
+    Sends the progress as in `/queue/progress/` in a `progress` event on
+    connect and whenever it changes, keep-alive comments in between.
+    '''
+    return StreamingResponse(progress_events(request), media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @router.get('/queue/input/')
 async def read_input():
@@ -70,102 +111,421 @@ async def read_input():
     '''
     return await database.execute(query).fetchall()
 
-@router.post('/queue/input/', dependencies=[Depends(check_authentication)])
-async def queue_input(definition: QueueInputDefinition):
-
-    select_query = select(birdnet_input.c.file_id, 1, 0, current_timestamp()).\
-        outerjoin(tasks).\
-        where(birdnet_input.c.sample_rate == 48000, birdnet_input.c.duration >= 3,
-            tasks.c.state == None, birdnet_input.c.node_label == definition.node_label)
-    insert_query = insert(tasks).from_select(['file_id', 'config_id', 'state', 'scheduled_on'], select_query)
-    # 'on conflict do nothing' not implemented.
-    # not required here as the records are selected by the fact that they are absent.
-
-    return await database.execute(insert_query)
-
-@router.patch('/queue/input/', dependencies=[Depends(check_authentication)])
-async def queue_input(definition: QueueUpdateDefinition):
-
-    transition_query = text(f'''
-    update {crd.db.schema}.birdnet_tasks set state = :to_state
-    where task_id in (
-        select task_id from {crd.db.schema}.birdnet_tasks t
-        left outer join {crd.db.schema}.birdnet_input i on i.file_id = t.file_id
-        where t.state = :from_state and node_label = :node_label
-        for update of t skip locked
-    )
-    ''')
+# spacing of the priorities of a node with weight 1
+QUEUE_STRIDE = 1000
 
-    reset_query = text(f'''
-    update {crd.db.schema}.birdnet_tasks set state = 0
-    where task_id in (
-        select task_id from {crd.db.schema}.birdnet_tasks t
-        left outer join {crd.db.schema}.birdnet_input i on i.file_id = t.file_id
-        where node_label = :node_label
-        for update of t skip locked
-    )
-    ''')
+def node_weight(node_label: str):
+    '''
+    Queue weight of the node, 1 if not set
+    '''
+    return select(func.coalesce(func.max(node_weights.c.weight), 1)).\
+        select_from(node_weights.join(nodes)).\
+        where(nodes.c.node_label == node_label).\
+        scalar_subquery()
 
-    delete_failed_results_query = text(f'''
-    delete from {crd.db.schema}.birdnet_results
-    where task_id in (
-        select task_id from {crd.db.schema}.birdnet_tasks t
-        left outer join {crd.db.schema}.birdnet_input i on i.file_id = t.file_id
-        where t.state = 3 and node_label = :node_label
-    )
-    ''')
+def stride_priority(weight, order_by):
+    '''
+    Claim priority of tasks of one node, ranked by `order_by` and spaced by
+    `QUEUE_STRIDE / weight`, starting at the head of the pending tasks:
+    nodes share the workers in proportion to their weight (stride scheduling)
+    '''
+    pending = tasks.alias('pending')
+    head = select(func.coalesce(func.min(pending.c.priority), 0)).where(pending.c.state == 0).scalar_subquery()
+    return head + func.ceil(func.row_number().over(order_by=order_by) * QUEUE_STRIDE / weight)
+
+# files / tasks per statement of bulk queue operations
+QUEUE_CHUNK_SIZE = 5000
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# state transitions of the queue update actions: (from state, to state), None for any state
+queue_transitions = {
+    'pause': (0, 4),
+    'resume': (4, 0),
+    'reset_failed': (3, 0),
+    'reset_all': (None, 0),
+}
+
+async def selected_nodes(selection: QueueSelection) -> List[str]:
+    '''
+    Labels of the selected nodes, all nodes if none are selected
+    '''
+    node_labels = set(selection.node_labels)
+    if selection.node_label != None:
+        node_labels.add(selection.node_label)
+    if len(node_labels) == 0:
+        await metadata_cache.load()
+        return sorted(metadata_cache.nodes_by_label)
+    for node_label in node_labels:
+        if await metadata_cache.node(node_label) == None:
+            raise HTTPException(status_code=404, detail='Node not found: {}'.format(node_label))
+    return sorted(node_labels)
+
+def input_criteria(node_label: str, selection: QueueSelection) -> list:
+    '''
+    Files of the node eligible for BirdNET analysis in the selected time range
+    '''
+    criteria = [birdnet_input.c.sample_rate == 48000, birdnet_input.c.duration >= 3, birdnet_input.c.node_label == node_label]
+    if selection.time_from != None:
+        criteria.append(birdnet_input.c.time >= selection.time_from)
+    if selection.time_to != None:
+        criteria.append(birdnet_input.c.time < selection.time_to)
+    return criteria
 
-    delete_results_query = text(f'''
-    delete from {crd.db.schema}.birdnet_results
-    where task_id in (
-        select task_id from {crd.db.schema}.birdnet_tasks t
-        left outer join {crd.db.schema}.birdnet_input i on i.file_id = t.file_id
-        where node_label = :node_label
+async def input_steps(definition: QueueInputDefinition):
+    '''
+    Queue the selected files node by node in chunks of `QUEUE_CHUNK_SIZE`,
+    newest first, yielding the number of queued files per chunk. Priorities
+    continue over the chunks of a node as in `stride_priority`.
+    '''
+    queued = tasks.alias('queued')
+    unqueued = birdnet_input.outerjoin(queued, and_(queued.c.file_id == birdnet_input.c.file_id, queued.c.config_id == definition.config_id))
+    head = await database.fetch_val(select(func.coalesce(func.min(tasks.c.priority), 0)).where(tasks.c.state == 0))
+    for node_label in await selected_nodes(definition):
+        criteria = [*input_criteria(node_label, definition), queued.c.task_id == None]
+        if definition.dry_run:
+            yield node_label, await database.fetch_val(select(func.count()).select_from(unqueued).where(*criteria))
+            continue
+        weight = await database.fetch_val(select(node_weight(node_label)))
+        rank = 0
+        last = None
+        while True:
+            keyset = [] if last == None else [tuple_(birdnet_input.c.time, birdnet_input.c.file_id) < last]
+            chunk = await database.fetch_all(select(birdnet_input.c.file_id, birdnet_input.c.time).\
+                select_from(unqueued).\
+                where(*criteria, *keyset).\
+                order_by(birdnet_input.c.time.desc(), birdnet_input.c.file_id.desc()).\
+                limit(QUEUE_CHUNK_SIZE))
+            if len(chunk) == 0:
+                break
+            await database.execute(insert(tasks).values([{
+                'file_id': r['file_id'],
+                'config_id': definition.config_id,
+                'state': 0,
+                'scheduled_on': current_timestamp(),
+                'priority': head + math.ceil((rank + i + 1) * QUEUE_STRIDE / weight),
+            } for i, r in enumerate(chunk)]))
+            rank += len(chunk)
+            last = (chunk[-1]['time'], chunk[-1]['file_id'])
+            yield node_label, len(chunk)
+
+async def update_steps(definition: QueueUpdateDefinition):
+    '''
+    Apply the state transition of the action to the selected tasks node by
+    node, in transactions of `QUEUE_CHUNK_SIZE` tasks, yielding the number
+    of updated tasks per chunk. Tasks locked by others (i.e. being claimed)
+    are skipped. Resets are run as jobs, see `api.jobs`, only counted here.
+    '''
+    from_state, to_state = queue_transitions[definition.action]
+    for node_label in await selected_nodes(definition):
+        criteria = input_criteria(node_label, definition)
+        if from_state != None:
+            criteria.append(tasks.c.state == from_state)
+        if definition.config_id != None:
+            criteria.append(tasks.c.config_id == definition.config_id)
+        if definition.dry_run:
+            yield node_label, await database.fetch_val(select(func.count()).select_from(tasks.join(birdnet_input)).where(*criteria))
+            continue
+        last = 0
+        while True:
+            async with database.transaction():
+                chunk = await database.fetch_all(select(tasks.c.task_id).\
+                    select_from(tasks.join(birdnet_input)).\
+                    where(*criteria, tasks.c.task_id > last).\
+                    order_by(tasks.c.task_id).\
+                    limit(QUEUE_CHUNK_SIZE).\
+                    with_for_update(of=tasks, skip_locked=True))
+                task_ids = [r['task_id'] for r in chunk]
+                if len(task_ids) == 0:
+                    break
+                selected = bindparam('task_ids', task_ids, type_=ARRAY(Integer))
+                await database.execute(update(tasks).where(tasks.c.task_id == any_(selected)).values(state=to_state))
+            last = task_ids[-1]
+            yield node_label, len(task_ids)
+
+async def progress_lines(steps, dry_run: bool):
+    nodes = {}
+    async for node_label, count in steps:
+        nodes[node_label] = nodes.get(node_label, 0) + count
+        yield json.dumps({'node_label': node_label, 'count': count, 'affected': sum(nodes.values())}) + '\n'
+    yield json.dumps({'affected': sum(nodes.values()), 'nodes': nodes, 'dry_run': dry_run}) + '\n'
+
+async def run_steps(steps, dry_run: bool, accept: Optional[str]):
+    '''
+    Run the steps of a bulk operation, streaming the progress as NDJSON if
+    accepted by the client, otherwise returning the summary when done
+    '''
+    if accept != None and NDJSON_MEDIA_TYPE in accept:
+        return StreamingResponse(progress_lines(steps, dry_run), media_type=NDJSON_MEDIA_TYPE)
+    nodes = {}
+    async for node_label, count in steps:
+        nodes[node_label] = nodes.get(node_label, 0) + count
+    return {'affected': sum(nodes.values()), 'nodes': nodes, 'dry_run': dry_run}
+
+@router.post('/queue/input/', response_model=QueueOperationResult, dependencies=[Depends(check_authentication)])
+async def queue_input(definition: QueueInputDefinition, accept: Optional[str] = Header(None)):
+    '''
+    ## Queue files for BirdNET analysis
+
+    Queues the eligible files (48 kHz, at least 3 seconds) of the selected
+    nodes and time range without task of the config. The tasks are
+    prioritized newest recording first and interleaved with the pending
+    tasks of other nodes according to the node weights.
+
+    The files are queued in chunks, requesting `application/x-ndjson` in the
+    `Accept` header streams the progress per chunk, followed by the summary.
+    With `dry_run` the files are only counted.
+    '''
+    return await run_steps(input_steps(definition), definition.dry_run, accept)
+
+@router.patch('/queue/input/', response_model=Union[QueueOperationResult, QueueJob], dependencies=[Depends(check_authentication)])
+async def update_queue(definition: QueueUpdateDefinition, accept: Optional[str] = Header(None)):
+    '''
+    ## Pause, resume or reset tasks
+
+    Applies the action to the tasks of the selected nodes, time range and
+    config in chunks, see `POST /queue/input/` for progress and `dry_run`.
+
+    `reset_failed` (failed tasks) and `reset_all` (tasks in any state) delete
+    the results of the tasks and return them to pending. Resets are started
+    as a job running in the background and the job is returned, see
+    `/queue/jobs/`.
+    '''
+    if definition.action in ['reset_failed', 'reset_all'] and not definition.dry_run:
+        selected = definition.node_label != None or len(definition.node_labels)
+        return await queue_jobs_runner.create(definition.action, {
+            'node_labels': await selected_nodes(definition) if selected else [],
+            'time_from': definition.time_from.isoformat() if definition.time_from != None else None,
+            'time_to': definition.time_to.isoformat() if definition.time_to != None else None,
+            'config_id': definition.config_id,
+        })
+    return await run_steps(update_steps(definition), definition.dry_run, accept)
+
+@router.get('/queue/jobs/', response_model=List[QueueJob])
+async def list_queue_jobs() -> List[QueueJob]:
+    '''
+    ## List the recent queue jobs, newest first
+    '''
+    return await queue_jobs_runner.list(100)
+
+@router.get('/queue/jobs/{job_id}', response_model=QueueJob)
+async def read_queue_job(job_id: int) -> QueueJob:
+    job = await queue_jobs_runner.get(job_id)
+    if job == None:
+        raise HTTPException(status_code=404, detail='Job not found')
+    return job
+
+@router.post('/queue/jobs/{job_id}/cancel', response_model=QueueJob, dependencies=[Depends(check_authentication)])
+async def cancel_queue_job(job_id: int) -> QueueJob:
+    '''
+    ## Cancel a pending or running queue job
+
+    The chunk in progress is rolled back, the job can be resumed later.
+    '''
+    job = await queue_jobs_runner.cancel(job_id)
+    if job == None:
+        if await queue_jobs_runner.get(job_id) == None:
+            raise HTTPException(status_code=404, detail='Job not found')
+        raise HTTPException(status_code=409, detail='Job is not pending or running')
+    return job
+
+@router.post('/queue/jobs/{job_id}/resume', response_model=QueueJob, dependencies=[Depends(check_authentication)])
+async def resume_queue_job(job_id: int) -> QueueJob:
+    '''
+    ## Resume a cancelled, interrupted or failed queue job
+
+    The job continues after the last completed chunk. Jobs without progress
+    for `queue_job_stale_after` seconds (i.e. their process died) can be
+    resumed as well.
+    '''
+    job = await queue_jobs_runner.resume(job_id)
+    if job == None:
+        if await queue_jobs_runner.get(job_id) == None:
+            raise HTTPException(status_code=404, detail='Job not found')
+        raise HTTPException(status_code=409, detail='Job is done or running')
+    return job
+
+@router.post('/queue/claim', response_model=List[ClaimedTask], dependencies=[Depends(check_authentication)])
+async def claim_tasks(body: TaskClaimRequest) -> List[ClaimedTask]:
+    '''
+    ## Claim pending BirdNET tasks
+
+    Leases up to `limit` pending tasks in order of priority and scheduling
+    and marks them running. Tasks locked by a concurrent claim are skipped,
+    each task is handed out to one worker only. Configs with a `max_running`
+    quota are claimed up to their quota of running tasks, claims of such
+    configs are serialized to count the running tasks reliably. Tasks not
+    completed within `lease` seconds return to pending.
+    '''
+    # lock the configs with a quota, the running tasks are counted after the
+    # concurrent claims have committed (no key update: task inserts proceed)
+    lock_query = select(configs.c.config_id).\
+        where(configs.c.max_running != None).\
+        order_by(configs.c.config_id).\
+        with_for_update(key_share=True)
+    claim_query = text(f'''
+    with available as (
+        select c.config_id, case when c.max_running is null then :limit else greatest(c.max_running - (
+            select count(*) from {crd.db.schema}.birdnet_tasks r where r.state = 1 and r.config_id = c.config_id
+        ), 0) end as available
+        from {crd.db.schema}.birdnet_configs c
+    ), candidates as (
+        select t.task_id, t.priority, t.scheduled_on
+        from available a
+        cross join lateral (
+            select task_id, priority, scheduled_on from {crd.db.schema}.birdnet_tasks t
+            where t.state = 0 and t.config_id = a.config_id
+            order by t.priority, t.scheduled_on, t.task_id
+            limit least(a.available, :limit)
+            for update skip locked
+        ) t
+    ), claimed as (
+        select task_id from candidates
+        order by priority, scheduled_on, task_id
+        limit :limit
+    ), leased as (
+        update {crd.db.schema}.birdnet_tasks t
+        set state = 1, pickup_on = now(), lease_until = now() + make_interval(secs => :lease)
+        from claimed
+        where t.task_id = claimed.task_id
+        returning t.task_id, t.file_id, t.config_id, t.pickup_on, t.lease_until
     )
+    select l.task_id, l.file_id, f.object_name, f.time, f.duration, l.config_id, c.config, l.pickup_on, l.lease_until
+    from leased l
+    join {crd.db.schema}.files_audio f on f.file_id = l.file_id
+    join {crd.db.schema}.birdnet_configs c on c.config_id = l.config_id
+    order by l.task_id
     ''')
+    async with database.transaction():
+        await database.fetch_all(lock_query)
+        records = await database.fetch_all(claim_query.bindparams(limit=body.limit, lease=body.lease))
+    return [{**r._mapping, 'config': json.loads(r['config']) if isinstance(r['config'], str) else r['config']} for r in records]
+
+@router.post('/queue/complete', response_model=TaskCompletionResult, dependencies=[Depends(check_authentication)])
+async def complete_tasks(body: List[TaskCompletion]) -> TaskCompletionResult:
+    '''
+    ## Complete claimed BirdNET tasks
+
+    Sets the state and end time of the tasks and stores the results of the
+    completed ones in one transaction. Tasks are matched by `task_id` and the
+    `pickup_on` of the claim, completions of expired or foreign leases are
+    rejected.
+    '''
+    update_query = f'''
+    update {crd.db.schema}.birdnet_tasks t
+    set state = c.state, end_on = now(), lease_until = null
+    from unnest($1::integer[], $2::timestamptz[], $3::integer[]) as c(task_id, pickup_on, state)
+    where t.task_id = c.task_id and t.state = 1 and t.pickup_on = c.pickup_on
+    returning t.task_id, t.file_id, t.state
+    '''
+    completions = {c.task_id: c for c in body}
+    async with database.connection() as connection:
+        async with connection.transaction():
+            raw = connection.raw_connection
+            updated = await raw.fetch(update_query,
+                [c.task_id for c in completions.values()],
+                [c.pickup_on for c in completions.values()],
+                [2 if c.state == 'complete' else 3 for c in completions.values()])
+            records = [(r['task_id'], r['file_id'], d.time_start, d.time_end, d.confidence, d.species)
+                for r in updated if r['state'] == 2 for d in completions[r['task_id']].results]
+            if len(records):
+                await raw.copy_records_to_table('birdnet_results', schema_name=crd.db.schema, records=records,
+                    columns=['task_id', 'file_id', 'time_start', 'time_end', 'confidence', 'species'])
+    completed = sorted(r['task_id'] for r in updated)
+    return {'completed': completed, 'rejected': sorted(set(completions) - set(completed))}
 
-    if definition.action == 'pause':
-        return await database.execute(transition_query.bindparams(from_state=0, to_state=4, node_label=definition.node_label))
-    elif definition.action == 'resume':
-        return await database.execute(transition_query.bindparams(from_state=4, to_state=0, node_label=definition.node_label))
-    elif definition.action == 'reset_failed':
-        await database.execute(delete_failed_results_query.bindparams(node_label=definition.node_label))
-        return await database.execute(transition_query.bindparams(from_state=3, to_state=0, node_label=definition.node_label))
-    elif definition.action == 'reset_all':
-        return # Not active, too dangerous
-        await database.execute(delete_results_query.bindparams(node_label=definition.node_label))
-        return await database.execute(reset_query.bindparams(node_label=definition.node_label))
+@router.get('/queue/weights', response_model=List[NodeWeight])
+async def read_node_weights() -> List[NodeWeight]:
+    '''
+    List the queue weights of nodes, nodes not listed have weight 1
+    '''
+    query = select(nodes.c.node_label, node_weights.c.weight).\
+        select_from(node_weights.join(nodes)).\
+        order_by(nodes.c.node_label)
+    return await database.fetch_all(query)
+
+@router.put('/queue/weights/{node_label}', response_model=NodeWeight, dependencies=[Depends(check_authentication)])
+async def update_node_weight(node_label: str, body: NodeWeightUpdate) -> NodeWeight:
+    '''
+    ## Set the queue weight of a node
+
+    A node with weight 2 is processed twice as fast as a node with weight 1
+    while both have pending tasks. The pending tasks of the node are
+    prioritized anew, starting at the head of the queue.
+    '''
+    node = await metadata_cache.node(node_label)
+    if node == None:
+        raise HTTPException(status_code=404, detail='Node not found')
+    upsert_query = pg_insert(node_weights).values(node_id=node['node_id'], weight=body.weight)
+    ranked = select(tasks.c.task_id, stride_priority(cast(body.weight, Float), birdnet_input.c.time.desc()).label('priority')).\
+        select_from(tasks.join(birdnet_input)).\
+        where(tasks.c.state == 0, birdnet_input.c.node_label == node_label).\
+        subquery()
+    async with database.transaction():
+        await database.execute(upsert_query.on_conflict_do_update(index_elements=['node_id'], set_={'weight': body.weight}))
+        await database.execute(update(tasks).where(tasks.c.task_id == ranked.c.task_id).values(priority=ranked.c.priority))
+    return {'node_label': node_label, 'weight': body.weight}
+
+@router.patch('/queue/configs/{config_id}', dependencies=[Depends(check_authentication)])
+async def update_config_quota(config_id: int, body: ConfigQuota):
+    '''
+    Set the quota of running tasks of a config for claims through `/queue/claim`
+    '''
+    query = update(configs).where(configs.c.config_id == config_id).\
+        values(max_running=body.max_running).\
+        returning(configs.c.config_id, configs.c.comment, configs.c.max_running)
+    record = await database.fetch_one(query)
+    if record == None:
+        raise HTTPException(status_code=404, detail='Config not found')
+    return record
 
 @router.get('/queue/detail/{node_label}')
-async def read_queue_detail(node_label: str):
+async def read_queue_detail(request: Request, node_label: str, refresh: bool = False):
+    '''
+    ## Statistics of the files, completed tasks and results of a node
 
-    # file stats
-    file_stats_query = text(f'''
-    select mode() within group (order by duration) as common_duration,
-    min(time) as min_time, max(time) as max_time
-    from {crd.db.schema}.birdnet_input
-    where node_label = :node_label and duration >= 3 and sample_rate = 48000
-    ''')
+    Summed up from the statistics per deployment maintained by triggers.
+    Minima and maxima are only widened by the triggers, `refresh` recomputes
+    the exact statistics of the node's deployments first, which may take a
+    while for nodes with many results. `refresh` requires authentication.
+    '''
+    if refresh:
+        await check_authentication(await security(request))
 
-    # task stats
-    task_stats_query = text(f'''
-    select avg(end_on - pickup_on) as avg_runtime, min(end_on - pickup_on) as min_runtime, max(end_on - pickup_on) as max_runtime,
-    min(scheduled_on) as min_scheduled_on, max(scheduled_on) as max_scheduled_on, min(end_on) as min_end_on, max(end_on) as max_end_on, sum(end_on - pickup_on) as total_runtime
-    from {crd.db.schema}.birdnet_tasks t
-    left outer join {crd.db.schema}.birdnet_input i on i.file_id = t.file_id
-    where state = 2 and node_label = :node_label and duration >= 3 and sample_rate = 48000
-    ''')
+    node = await metadata_cache.node(node_label)
+    deployment_ids = [d['deployment_id'] for d in await metadata_cache.node_deployments(node['node_id'])] if node != None else []
+    selected = bindparam('deployment_ids', deployment_ids, type_=ARRAY(Integer))
 
-    # result stats
-    result_stats_query = text(f'''
-    select count(result_id), count(distinct case when confidence > 0.9 then result_id end) as count_conf_09
-    from {crd.db.schema}.birdnet_results
-    left join {crd.db.schema}.birdnet_input on birdnet_input.file_id = birdnet_results.file_id
-    where node_label = :node_label and duration >= 3 and sample_rate = 48000
-    ''')
+    if refresh and len(deployment_ids):
+        await database.execute(text(f'select {crd.db.schema}.birdnet_queue_stats_refresh(:deployment_ids)').bindparams(selected))
+
+    # the most common duration, ties resolved to the shortest as by mode()
+    common_duration = select(queue_durations.c.duration).\
+        where(queue_durations.c.deployment_id == any_(selected)).\
+        group_by(queue_durations.c.duration).\
+        having(func.sum(queue_durations.c.count) > 0).\
+        order_by(func.sum(queue_durations.c.count).desc(), queue_durations.c.duration).\
+        limit(1).scalar_subquery()
+
+    stats = await database.fetch_one(select(
+        common_duration.label('common_duration'),
+        func.min(queue_stats.c.time_min).label('min_time'),
+        func.max(queue_stats.c.time_max).label('max_time'),
+        (func.sum(queue_stats.c.runtime_sum) / func.nullif(func.sum(queue_stats.c.tasks_done), 0)).label('avg_runtime'),
+        func.min(queue_stats.c.runtime_min).label('min_runtime'),
+        func.max(queue_stats.c.runtime_max).label('max_runtime'),
+        func.min(queue_stats.c.scheduled_on_min).label('min_scheduled_on'),
+        func.max(queue_stats.c.scheduled_on_max).label('max_scheduled_on'),
+        func.min(queue_stats.c.end_on_min).label('min_end_on'),
+        func.max(queue_stats.c.end_on_max).label('max_end_on'),
+        case((func.sum(queue_stats.c.tasks_done) > 0, func.sum(queue_stats.c.runtime_sum))).label('total_runtime'),
+        func.coalesce(func.sum(queue_stats.c.results), 0).label('count'),
+        func.coalesce(func.sum(queue_stats.c.results_conf_09), 0).label('count_conf_09'),
+    ).where(queue_stats.c.deployment_id == any_(selected)))
 
-    file_stats = await database.fetch_one(file_stats_query.bindparams(node_label = node_label))
-    task_stats = await database.fetch_one(task_stats_query.bindparams(node_label = node_label))
-    result_stats = await database.fetch_one(result_stats_query.bindparams(node_label = node_label))
+    file_stats = {k: stats[k] for k in ['common_duration', 'min_time', 'max_time']}
+    task_stats = {k: stats[k] for k in ['avg_runtime', 'min_runtime', 'max_runtime', 'min_scheduled_on',
+        'max_scheduled_on', 'min_end_on', 'max_end_on', 'total_runtime']}
+    result_stats = {k: stats[k] for k in ['count', 'count_conf_09']}
 
     return { 'node_label': node_label, 'file_stats': file_stats, 'task_stats': task_stats, 'result_stats': result_stats }
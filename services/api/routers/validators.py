@@ -1,12 +1,18 @@
-from api.config import crd
+from datetime import datetime, timezone
+from typing import List
+
+from api.cache import metadata_cache
 from api.database import database
 from api.dependencies import to_inclusive_range, check_oid_authentication
-from api.models import DeploymentRequest, ValidationResult, NodeValidationRequest, Tag, ImageValidationResponse, ImageValidationRequest
-from api.tables import deployments, nodes, tags
+from api.models import INGEST_CHUNK_SIZE, DeploymentRequest, ValidationResult, NodeValidationRequest, Tag, ImageValidationResponse, ImageValidationRequest
+from api.tables import deployments, files_image, nodes, tags
 
 from asyncpg.exceptions import ExclusionViolationError
 from fastapi import APIRouter, Depends
-from sqlalchemy.sql import select, text
+from pydantic import conlist
+from sqlalchemy import String
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import any_, bindparam, or_, select, text
 
 router = APIRouter(tags=['validators'])
 
@@ -68,57 +74,56 @@ async def validate_tag(body: Tag) -> ValidationResult:
     return True if r == None else False
 
 
-@router.post('/validate/image', dependencies=[Depends(check_oid_authentication)], response_model=ImageValidationResponse, tags=['ingest'])
-async def check_image(body: ImageValidationRequest) -> None:
+def image_object_name(node_label: str, timestamp: datetime, extension: str = '.jpg') -> str:
+    '''
+    Object name of an image: `{node_label}/{YYYY-mm-DD}/{HH}/{node_label}_{YYYY-mm-DDTHH-MM-SSZ}{extension}`,
+    the timestamp in UTC (naive timestamps are taken as UTC)
+    '''
+    ts = timestamp.astimezone(timezone.utc) if timestamp.tzinfo != None else timestamp
+    return f"{node_label}/{ts.strftime('%Y-%m-%d/%H')}/{node_label}_{ts.strftime('%Y-%m-%dT%H-%M-%SZ')}{extension}"
 
-    duplicate_query = text(f'''
-    WITH n AS (
-        SELECT :sha256 as sha256,
-        :node_label ||'/'||to_char(:timestamp at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, timestamp)
-        || :node_label ||'_'||to_char(:timestamp at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||:extension -- file_name (node_label, timestamp, extension)
-        as object_name
-    )
-    SELECT f.sha256 = n.sha256 as hash_match,
-        f.object_name = n.object_name as object_name_match,
-        n.object_name as object_name
-    from {crd.db.schema}.files_image f, n
-    where (f.sha256 = n.sha256 or f.object_name = n.object_name)
-    ''').bindparams(sha256=body.sha256, node_label=body.node_label, timestamp=body.timestamp, extension='.jpg')
+async def validate_images(images: List[ImageValidationRequest]) -> List[ImageValidationResponse]:
+    '''
+    Check images for duplicates by hash or object name in one query,
+    and resolve the deployment covering each timestamp from the metadata cache
+    '''
+    object_names = [image_object_name(image.node_label, image.timestamp) for image in images]
+    hashes = [image.sha256 for image in images]
+    duplicates = await database.fetch_all(select(files_image.c.sha256, files_image.c.object_name).\
+        where(or_(
+            files_image.c.sha256 == any_(bindparam('hashes', hashes, type_=ARRAY(String))),
+            files_image.c.object_name == any_(bindparam('object_names', object_names, type_=ARRAY(String)))
+        )))
+    duplicate_hashes = {d['sha256'] for d in duplicates}
+    duplicate_object_names = {d['object_name'] for d in duplicates}
 
-    # print(str(query.compile(compile_kwargs={"literal_binds": True})))
-    duplicate_result = await database.fetch_one(duplicate_query)
-
-    object_name = None
-    if duplicate_result == None:
-        object_name_query = text('''
-        SELECT :node_label ||'/'||to_char(:timestamp at time zone 'UTC', 'YYYY-mm-DD/HH24/') -- file_path (node_label, timestamp)
-        || :node_label ||'_'||to_char(:timestamp at time zone 'UTC', 'YYYY-mm-DD"T"HH24-MI-SS"Z"')||:extension -- file_name (node_label, timestamp, extension)
-        as object_name
-        ''').bindparams(node_label=body.node_label, timestamp=body.timestamp, extension='.jpg')
-        object_name_result = await database.fetch_one(object_name_query)
-        object_name = object_name_result._mapping['object_name']
-    else:
-        object_name = duplicate_result._mapping['object_name']
+    validated = []
+    for image, object_name in zip(images, object_names):
+        deployment = await metadata_cache.deployment_at(image.node_label, image.timestamp)
+        validated.append({
+            'hash_match': image.sha256 in duplicate_hashes,
+            'object_name_match': object_name in duplicate_object_names,
+            'object_name': object_name,
+            'node_deployed': deployment != None,
+            'deployment_id': None if deployment == None else deployment['deployment_id'],
+        })
+    return validated
 
-    deployment_query = select(deployments.c.deployment_id).join(nodes).\
-        where(nodes.c.node_label == body.node_label, text('period @> :timestamp ::timestamptz').bindparams(timestamp=body.timestamp))
-    deployment_result = await database.fetch_one(deployment_query)
+@router.post('/validate/image', dependencies=[Depends(check_oid_authentication)], response_model=ImageValidationResponse, tags=['ingest'])
+async def check_image(body: ImageValidationRequest) -> None:
+    '''
+    Validation passes if neither hash nor object name match an existing image
+    and the node is deployed at the time of capture
+    '''
+    return (await validate_images([body]))[0]
 
-    if duplicate_result == None:
-        if deployment_result:
-            return { # no duplicate, deployed: validation passed
-                'hash_match': False, 'object_name_match': False, 'object_name': object_name,
-                **deployment_result._mapping, 'node_deployed': True }
-        else:
-            return { # no duplicate, NOT deployed: validation failed
-                'hash_match': False, 'object_name_match': False, 'object_name': object_name,
-                'deployment_id': None, 'node_deployed': False }
-    else:
-        if deployment_result:
-            return { # DUPLICATE, deployed: validation failed
-                **duplicate_result._mapping,
-                **deployment_result._mapping, 'node_deployed': True }
-        else:
-            return { # DUPLICATE, NOT deployed: validation failed
-                **duplicate_result._mapping,
-                'deployment_id': None, 'node_deployed': False }
+@router.post('/validate/images', dependencies=[Depends(check_oid_authentication)], response_model=List[ImageValidationResponse], tags=['ingest'])
+async def check_images(body: conlist(ImageValidationRequest, max_items=INGEST_CHUNK_SIZE)) -> List[ImageValidationResponse]:
+    '''
+    Validate a batch of images, see `/validate/image`.
+    A batch holds up to 1000 images, as one statement of `/ingest/images`.
+    The results are listed in the order of the request.
+    '''
+    if len(body) == 0:
+        return []
+    return await validate_images(body)
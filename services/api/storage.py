@@ -0,0 +1,58 @@
+import asyncio
+import os
+from typing import Optional
+
+from api.config import crd, storage_connect_timeout, storage_read_timeout
+
+import certifi
+import urllib3
+from minio import Minio
+from starlette.concurrency import run_in_threadpool
+
+# ------------------------------------------------------------------------------
+# S3 STORAGE CLIENT
+# ------------------------------------------------------------------------------
+
+client = None
+
+def storage() -> Minio:
+    '''
+    MinIO client, created on first use
+    '''
+    global client
+    if client == None:
+        client = Minio(
+            crd.minio.host,
+            access_key=crd.minio.access_key,
+            secret_key=crd.minio.secret_key,
+            region=getattr(crd.minio, 'region', None),
+            http_client=urllib3.PoolManager(
+                timeout=urllib3.Timeout(connect=storage_connect_timeout, read=storage_read_timeout),
+                maxsize=32,
+                cert_reqs='CERT_REQUIRED',
+                ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+                retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+            ),
+        )
+    return client
+
+async def check_storage(timeout: float) -> Optional[str]:
+    '''
+    Check that the bucket is reachable, returns the error if not
+    '''
+    try:
+        exists = await asyncio.wait_for(run_in_threadpool(storage().bucket_exists, crd.minio.bucket), timeout)
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return None if exists else f'Bucket {crd.minio.bucket} does not exist.'
+
+async def probe_storage(retries: int = 5, delay: float = 2):
+    '''
+    Report storage problems at startup without delaying it
+    '''
+    for attempt in range(retries):
+        error = await check_storage(storage_connect_timeout)
+        if error == None:
+            return
+        print(f'Storage not ready ({attempt + 1}/{retries}): {error}')
+        await asyncio.sleep(delay * 2 ** attempt)
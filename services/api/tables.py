@@ -4,7 +4,7 @@ from api.config import crd
 from api.dependencies import GeometryPoint
 
 from sqlalchemy import ForeignKey
-from sqlalchemy.dialects.postgresql import TSTZRANGE
+from sqlalchemy.dialects.postgresql import JSONB, TSTZRANGE
 
 metadata = sqlalchemy.MetaData(schema=crd.db.schema)
 
@@ -30,7 +30,55 @@ results = sqlalchemy.Table(
     sqlalchemy.Column('time_start',   sqlalchemy.REAL       , nullable=False),
     sqlalchemy.Column('time_end',     sqlalchemy.REAL       , nullable=False),
     sqlalchemy.Column('confidence',   sqlalchemy.REAL       , nullable=False),
-    sqlalchemy.Column('species',      sqlalchemy.String(255), nullable=False)
+    sqlalchemy.Column('species',      sqlalchemy.String(255), nullable=False),
+    sqlalchemy.Column('time',         sqlalchemy.TIMESTAMP  , nullable=False)
+)
+
+species_rollup = sqlalchemy.Table(
+    'birdnet_species_rollup',
+    metadata,
+    sqlalchemy.Column('species',           sqlalchemy.String(255), primary_key=True),
+    sqlalchemy.Column('day',               sqlalchemy.Date       , primary_key=True),
+    sqlalchemy.Column('deployment_id',     sqlalchemy.Integer    , primary_key=True),
+    sqlalchemy.Column('confidence_bucket', sqlalchemy.SmallInteger, primary_key=True),
+    sqlalchemy.Column('count',             sqlalchemy.Integer    , nullable=False),
+    sqlalchemy.Column('time_min',          sqlalchemy.TIMESTAMP  , nullable=False),
+    sqlalchemy.Column('time_max',          sqlalchemy.TIMESTAMP  , nullable=False)
+)
+
+queue_progress = sqlalchemy.Table(
+    'birdnet_queue_progress',
+    metadata,
+    sqlalchemy.Column('deployment_id', sqlalchemy.Integer   , primary_key=True),
+    sqlalchemy.Column('state',         sqlalchemy.Integer   , primary_key=True), # -1: not queued
+    sqlalchemy.Column('count',         sqlalchemy.Integer   , nullable=False),
+    sqlalchemy.Column('size',          sqlalchemy.BigInteger, nullable=False)
+)
+
+queue_stats = sqlalchemy.Table(
+    'birdnet_queue_stats',
+    metadata,
+    sqlalchemy.Column('deployment_id',    sqlalchemy.Integer  , primary_key=True),
+    sqlalchemy.Column('time_min',         sqlalchemy.TIMESTAMP, nullable=True),
+    sqlalchemy.Column('time_max',         sqlalchemy.TIMESTAMP, nullable=True),
+    sqlalchemy.Column('tasks_done',       sqlalchemy.Integer  , nullable=False),
+    sqlalchemy.Column('runtime_sum',      sqlalchemy.Interval , nullable=False),
+    sqlalchemy.Column('runtime_min',      sqlalchemy.Interval , nullable=True),
+    sqlalchemy.Column('runtime_max',      sqlalchemy.Interval , nullable=True),
+    sqlalchemy.Column('scheduled_on_min', sqlalchemy.TIMESTAMP, nullable=True),
+    sqlalchemy.Column('scheduled_on_max', sqlalchemy.TIMESTAMP, nullable=True),
+    sqlalchemy.Column('end_on_min',       sqlalchemy.TIMESTAMP, nullable=True),
+    sqlalchemy.Column('end_on_max',       sqlalchemy.TIMESTAMP, nullable=True),
+    sqlalchemy.Column('results',          sqlalchemy.Integer  , nullable=False),
+    sqlalchemy.Column('results_conf_09',  sqlalchemy.Integer  , nullable=False)
+)
+
+queue_durations = sqlalchemy.Table(
+    'birdnet_queue_durations',
+    metadata,
+    sqlalchemy.Column('deployment_id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('duration',      sqlalchemy.Float  , primary_key=True),
+    sqlalchemy.Column('count',         sqlalchemy.Integer, nullable=False)
 )
 
 species = sqlalchemy.Table(
@@ -52,6 +100,7 @@ species_day = sqlalchemy.Table(
 results_file_taxonomy = sqlalchemy.Table(
     'birdnet_inferred_species_file_taxonomy',
     metadata,
+    sqlalchemy.Column('result_id',   sqlalchemy.Integer),
     sqlalchemy.Column('species',     sqlalchemy.String(255)),
     sqlalchemy.Column('location',    GeometryPoint),
     sqlalchemy.Column('confidence',  sqlalchemy.REAL),
@@ -104,9 +153,46 @@ tasks = sqlalchemy.Table(
     sqlalchemy.Column('pickup_on',      sqlalchemy.TIMESTAMP  , nullable=False),
     sqlalchemy.Column('end_on',         sqlalchemy.TIMESTAMP  , nullable=False),
     sqlalchemy.Column('batch_id',       sqlalchemy.Integer,     nullable=False),
+    sqlalchemy.Column('lease_until',    sqlalchemy.TIMESTAMP  , nullable=True),
+    sqlalchemy.Column('priority',       sqlalchemy.BigInteger , nullable=False),
     schema=crd.db.schema
 )
 
+configs = sqlalchemy.Table(
+    'birdnet_configs',
+    metadata,
+    sqlalchemy.Column('config_id',   sqlalchemy.Integer  , primary_key=True),
+    sqlalchemy.Column('config',      JSONB               , nullable=False),
+    sqlalchemy.Column('comment',     sqlalchemy.Text     , nullable=True),
+    sqlalchemy.Column('max_running', sqlalchemy.Integer  , nullable=True),
+    sqlalchemy.Column('created_at',  sqlalchemy.TIMESTAMP, nullable=False),
+    sqlalchemy.Column('updated_at',  sqlalchemy.TIMESTAMP, nullable=False)
+)
+
+queue_jobs = sqlalchemy.Table(
+    'birdnet_queue_jobs',
+    metadata,
+    sqlalchemy.Column('job_id',          sqlalchemy.Integer   , primary_key=True),
+    sqlalchemy.Column('action',          sqlalchemy.String(32), nullable=False),
+    sqlalchemy.Column('selection',       JSONB                , nullable=False),
+    sqlalchemy.Column('state',           sqlalchemy.String(16), nullable=False),
+    sqlalchemy.Column('last_task_id',    sqlalchemy.Integer   , nullable=False),
+    sqlalchemy.Column('total',           sqlalchemy.Integer   , nullable=True),
+    sqlalchemy.Column('processed',       sqlalchemy.Integer   , nullable=False),
+    sqlalchemy.Column('results_deleted', sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column('error',           sqlalchemy.Text      , nullable=True),
+    sqlalchemy.Column('created_at',      sqlalchemy.TIMESTAMP , nullable=False),
+    sqlalchemy.Column('updated_at',      sqlalchemy.TIMESTAMP , nullable=False),
+    sqlalchemy.Column('finished_at',     sqlalchemy.TIMESTAMP , nullable=True)
+)
+
+node_weights = sqlalchemy.Table(
+    'birdnet_node_weights',
+    metadata,
+    sqlalchemy.Column('node_id', None           , sqlalchemy.ForeignKey('nodes.node_id'), primary_key=True),
+    sqlalchemy.Column('weight',  sqlalchemy.REAL, nullable=False)
+)
+
 nodes = sqlalchemy.Table(
     'nodes',
     metadata,
@@ -199,6 +285,17 @@ files_image = sqlalchemy.Table(
     sqlalchemy.Column('updated_at',     sqlalchemy.TIMESTAMP(timezone=True),  nullable=False),
 )
 
+files_image_derived = sqlalchemy.Table(
+    'files_image_derived',
+    metadata,
+    sqlalchemy.Column('file_id',        sqlalchemy.ForeignKey('files_image.file_id'), primary_key=True),
+    sqlalchemy.Column('size',           sqlalchemy.SmallInteger,              primary_key=True),
+    sqlalchemy.Column('object_name',    sqlalchemy.Text,                      nullable=False),
+    sqlalchemy.Column('file_size',      sqlalchemy.Integer,                   nullable=False),
+    sqlalchemy.Column('resolution',     sqlalchemy.ARRAY(sqlalchemy.Integer), nullable=False),
+    sqlalchemy.Column('created_at',     sqlalchemy.TIMESTAMP(timezone=True),  nullable=False),
+)
+
 files_entry = sqlalchemy.Table(
     'files_entry',
     metadata,
@@ -231,3 +328,32 @@ data_env = sqlalchemy.Table(
     sqlalchemy.Column('moisture', sqlalchemy.Float, nullable=False),
     sqlalchemy.Column('voltage', sqlalchemy.Float, nullable=False),
 )
+
+def sensordata_aggregate(name: str, columns: list):
+    '''
+    Continuous aggregate of sensor data, holding sum, count, minimum and
+    maximum of each value column per deployment and time bucket
+    '''
+    aggregates = []
+    for column, type in columns:
+        aggregates.extend([
+            sqlalchemy.Column(f'{column}_sum', type),
+            sqlalchemy.Column(f'{column}_count', sqlalchemy.BigInteger),
+            sqlalchemy.Column(f'{column}_min', type),
+            sqlalchemy.Column(f'{column}_max', type),
+        ])
+    return sqlalchemy.Table(
+        name,
+        metadata,
+        sqlalchemy.Column('time', sqlalchemy.TIMESTAMP, nullable=False),
+        sqlalchemy.Column('deployment_id', None, ForeignKey(deployments.c.deployment_id)),
+        *aggregates
+    )
+
+# continuous aggregates: sensordata_{env,pax}_{hourly,daily}
+env_aggregate_columns = [('temperature', sqlalchemy.Float), ('humidity', sqlalchemy.Float), ('moisture', sqlalchemy.Float), ('voltage', sqlalchemy.Float)]
+pax_aggregate_columns = [('pax', sqlalchemy.BigInteger), ('voltage', sqlalchemy.Float)]
+data_env_hourly = sensordata_aggregate('sensordata_env_hourly', env_aggregate_columns)
+data_env_daily = sensordata_aggregate('sensordata_env_daily', env_aggregate_columns)
+data_pax_hourly = sensordata_aggregate('sensordata_pax_hourly', pax_aggregate_columns)
+data_pax_daily = sensordata_aggregate('sensordata_pax_daily', pax_aggregate_columns)
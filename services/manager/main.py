@@ -60,7 +60,13 @@ class NodeNotDeployedException(BaseException):
 
 DATABASE_URL = f'postgresql://{crd.db.user}:{crd.db.password}@{crd.db.host}:{crd.db.port}/{crd.db.database}'
 print(DATABASE_URL)
-database = databases.Database(DATABASE_URL, min_size=5, max_size=10)
+database = databases.Database(
+    DATABASE_URL,
+    min_size=getattr(crd.db, 'pool_min_size', 5),
+    max_size=getattr(crd.db, 'pool_max_size', 10),
+    statement_cache_size=getattr(crd.db, 'statement_cache_size', 100),
+    server_settings={'statement_timeout': str(getattr(crd.db, 'statement_timeout', 0))},
+)
 
 tags_metadata = [
     {